@@ -1,41 +1,39 @@
-def bresenham_line(origin, pos):
-    line = []
+import bisect
+
+import numpy as np
 
+def bresenham_line(origin, pos):
+    """
+    Points of the line from origin to pos as an (n, 2) array of (x, y).
+    """
     x0, y0 = origin[0], origin[1]
     x1, y1 = pos[0], pos[1]
 
     dx = abs(x1 - x0)
     dy = abs(y1 - y0)
 
-    x, y = x0, y0
     sx = -1 if x0 > x1 else 1
     sy = -1 if y0 > y1 else 1
 
+    # the minor axis steps once the error term (starting at half the major length) goes negative,
+    # so after i major steps it has stepped ceil((2*i*minor - major) / (2*major)) times
     if dx > dy:
-        err = dx / 2.0
-        while x != x1:
-            line.append((x, y))
-            err -= dy
-            if err < 0:
-                y += sy
-                err += dx
-            x += sx
+        i = np.arange(dx + 1)
+        steps = np.maximum(0, -((dx - 2 * i * dy) // (2 * dx)))
+        xs = x0 + sx * i
+        ys = y0 + sy * steps
     else:
-        err = dy / 2.0
-        while y != y1:
-            line.append((x, y))
-            err -= dx
-            if err < 0:
-                x += sx
-                err += dy
-            y += sy
-    line.append((x, y))
-
-    return line
-
+        i = np.arange(dy + 1)
+        steps = np.maximum(0, -((dy - 2 * i * dx) // (2 * dy))) if dy > 0 else i
+        xs = x0 + sx * steps
+        ys = y0 + sy * i
 
+    return np.column_stack((xs, ys))
 
 def ellipse(origin, end):
+    """
+    Outline of the ellipse inside the box from origin to end as an (n, 2) array of unique (x, y).
+    """
     path = []
 
     mid = (round((end[0]-origin[0])/2), round((end[1]-origin[1])/2))
@@ -44,116 +42,230 @@ def ellipse(origin, end):
     xc, yc = origin[0] + mid[0], origin[1] + mid[1]
     x = 0
     y = ry
-    
+
     if ry == 0:
         left = min(origin[0], end[0])
         right = max(origin[0], end[0])
         for i in range(left, right):
-            path.append((i, origin[1] + mid[1]))
+            path.append((i, yc))
     else:
-        d1 = ((ry * ry) - (rx * rx * ry) + (0.25 * rx * rx))
-        dx = 2 * ry * ry * x
-        dy = 2 * rx * rx * y
+        # midpoint algorithm with the decision terms scaled by 4 to stay in integers
+        rx2, ry2 = rx * rx, ry * ry
+        d1 = 4 * ry2 - 4 * rx2 * ry + rx2
+        dx = 2 * ry2 * x
+        dy = 2 * rx2 * y
 
         while (dx < dy):
-            path.append((x + xc, y + yc))
-            path.append((-x + xc, y + yc))
-            path.append((x + xc, -y + yc))
-            path.append((-x + xc, -y + yc))
+            path.append((x, y))
 
             if (d1 < 0):
                 x += 1
-                dx = dx + (2 * ry * ry)
-                d1 = d1 + dx + (ry * ry)
+                dx = dx + (2 * ry2)
+                d1 = d1 + 4 * (dx + ry2)
             else:
                 x += 1
                 y -= 1
-                dx = dx + (2 * ry * ry)
-                dy = dy - (2 * rx * rx)
-                d1 = d1 + dx - dy + (ry * ry)
+                dx = dx + (2 * ry2)
+                dy = dy - (2 * rx2)
+                d1 = d1 + 4 * (dx - dy + ry2)
 
-        d2 = (((ry * ry) * ((x + 0.5) * (x + 0.5))) + ((rx * rx) * ((y - 1) * (y - 1))) - (rx * rx * ry * ry))
+        d2 = ry2 * (2 * x + 1) * (2 * x + 1) + 4 * rx2 * (y - 1) * (y - 1) - 4 * rx2 * ry2
 
         while (y >= 0):
-            path.append((x + xc, y + yc))
-            path.append((-x + xc, y + yc))
-            path.append((x + xc, -y + yc))
-            path.append((-x + xc, -y + yc))
+            path.append((x, y))
 
             if (d2 > 0):
                 y -= 1
-                dy = dy - (2 * rx * rx)
-                d2 = d2 + (rx * rx) - dy
+                dy = dy - (2 * rx2)
+                d2 = d2 + 4 * (rx2 - dy)
             else:
                 y -= 1
                 x += 1
-                dx = dx + (2 * ry * ry)
-                dy = dy - (2 * rx * rx)
-                d2 = d2 + dx - dy + (rx * rx)
+                dx = dx + (2 * ry2)
+                dy = dy - (2 * rx2)
+                d2 = d2 + 4 * (dx - dy + rx2)
+
+        # mirror the first quadrant into the other three
+        quadrant = np.array(path, dtype=np.int64).reshape(-1, 2)
+        path = np.concatenate([quadrant * (sx, sy) for sx in (1, -1) for sy in (1, -1)]) + (xc, yc)
+
+    return np.unique(np.array(path, dtype=np.int64).reshape(-1, 2), axis=0)
+
+def filled_ellipse(origin, end):
+    """
+    The ellipse from origin to end including its inside, as (y, x0, x1) spans with x1 exclusive.
+    """
+    return _outline_to_spans(ellipse(origin, end))
 
-    return path
+def filled_rectangle(origin, end):
+    """
+    The rectangle from origin to end including its inside, as (y, x0, x1) spans with x1 exclusive.
+    """
+    x0, x1 = min(origin[0], end[0]), max(origin[0], end[0])
+    y0, y1 = min(origin[1], end[1]), max(origin[1], end[1])
 
-def flood_fill(origin, canvas):
+    return [(y, x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+def flood_fill(origin, fillable):
     """
     "Paint bucket tool"
+
+    Scanline fill from origin (x, row) over the True cells of the (height, width) fillable
+    mask, rows counted from the top of the buffer. Returns the filled area as (row, x0, x1)
+    spans with x1 exclusive. Visited runs are kept in a separate mask.
+    """
+    spans = []
+
+    height = fillable.shape[0]
+    x, y = origin[0], origin[1]
+
+    runs = {}      # row -> (starts, ends) of its fillable runs, built when the row is first reached
+    visited = {}   # row -> visited mask over the runs of that row
+
+    def row_runs(row):
+        if not row in runs:
+            starts, ends = _runs(fillable[row])
+            runs[row] = (starts, ends)
+            visited[row] = [False] * len(starts)
+        return runs[row]
+
+    starts, _ = row_runs(y)
+    runList = [(y, bisect.bisect_right(starts, x) - 1)]   # a list of runs to fill
+
+    while runList:
+        row, index = runList.pop()
+        if visited[row][index]:
+            continue
+        visited[row][index] = True
+
+        starts, ends = runs[row]
+        x0, x1 = starts[index], ends[index]
+        spans.append((row, x0, x1))
+
+        # queue every run above and below that touches this one
+        for nextRow in (row - 1, row + 1):
+            if 0 <= nextRow < height:
+                nextStarts, nextEnds = row_runs(nextRow)
+                first = bisect.bisect_right(nextEnds, x0)
+                last = bisect.bisect_left(nextStarts, x1)
+                for nextIndex in range(first, last):
+                    if not visited[nextRow][nextIndex]:
+                        runList.append((nextRow, nextIndex))
+
+    return spans
+
+def polygon(points):
+    """
+    Filled polygon through the given (x, y) vertices, as (y, x0, x1) spans with x1 exclusive.
+    The inside follows the even-odd rule and the edges are always included.
     """
-    area = []
-
-    posList = []                                                    # a list for possible fillable positions
-    canvasCopy = canvas.copy()
-    posList.append((origin[0], len(canvasCopy) - 1 - origin[1]))    # add the clicked position to the list
-    prevColor = canvasCopy[origin[1]][origin[0]]                    # check the original color that will be recolored
-    newColor = [x+1 for x in prevColor]
-
-    while posList:
-        pos = posList.pop()   # take one position out of the list
-        if canvasCopy[pos[1]][pos[0]] == prevColor:
-            area.append((pos[0], len(canvasCopy) - 1 - pos[1]))
-            canvasCopy[pos[1]][pos[0]] = newColor
-
-            # check pos from upside
-            x, y = pos[0], pos[1] - 1
-            if y >= 0 and x >= 0 and y < len(canvasCopy) and x < len(canvasCopy[pos[1]]):
-                if canvasCopy[y][x] == prevColor:
-                    posList.append((x, y))
-
-            # check pos from downside
-            y = pos[1] + 1
-            if y >= 0 and x >= 0 and y < len(canvasCopy) and x < len(canvasCopy[pos[1]]):
-                if canvasCopy[y][x] == prevColor:
-                    posList.append((x, y))
-
-            # check pos from left side
-            x, y = pos[0] - 1, pos[1]
-            if y >= 0 and x >= 0 and y < len(canvasCopy) and x < len(canvasCopy[pos[1]]):
-                if canvasCopy[y][x] == prevColor:
-                    posList.append((x, y))
-
-            # check pos from right side
-            x = pos[0] + 1
-            if y >= 0 and x >= 0 and y < len(canvasCopy) and x < len(canvasCopy[pos[1]]):
-                if canvasCopy[y][x] == prevColor:
-                    posList.append((x, y))
-
-    return area
+    vertices = np.array(points, dtype=np.int64).reshape(-1, 2)
+    if len(vertices) == 0:
+        return []
+
+    left, bottom = vertices.min(axis=0)
+    right, top = vertices.max(axis=0)
+    area = np.zeros((top - bottom + 1, right - left + 1), dtype=bool)   # row 0 is the lowest y
+
+    # inside: cells whose center lies between an odd number of edge crossings on its row
+    for y in range(bottom, top + 1):
+        crossings = []
+        for i in range(len(vertices)):
+            (ax, ay), (bx, by) = vertices[i - 1], vertices[i]
+            if min(ay, by) <= y < max(ay, by):
+                # x of the crossing, rounded up: cells starting from it are right of the edge
+                crossings.append(-((-(ax * (by - ay) + (y - ay) * (bx - ax))) // (by - ay)))
+        crossings.sort()
+        for start, stop in zip(crossings[0::2], crossings[1::2]):
+            area[y - bottom, start - left:stop - left + 1] = True
+
+    # edges
+    for i in range(len(vertices)):
+        line = bresenham_line(vertices[i - 1], vertices[i])
+        area[line[:, 1] - bottom, line[:, 0] - left] = True
+
+    spans = []
+    for row in range(area.shape[0]):
+        starts, ends = _runs(area[row])
+        spans.extend((int(bottom) + row, int(left) + x0, int(left) + x1) for x0, x1 in zip(starts, ends))
+
+    return spans
+
+def polyline(origin, points):
+    """
+    Connected lines from origin through every point, as an (n, 2) array of (x, y).
+    """
+    segments = []
+    for point in points:
+        segments.append(bresenham_line(origin, point))
+        origin = point
+    return np.concatenate(segments) if segments else np.zeros((0, 2), dtype=np.int64)
 
 def rectangle(origin, end):
-    path = []
+    """
+    Outline of the rectangle from origin to end as an (n, 2) array of unique (x, y).
+    """
+    x0, x1 = min(origin[0], end[0]), max(origin[0], end[0])
+    y0, y1 = min(origin[1], end[1]), max(origin[1], end[1])
+
+    xs = np.arange(x0, x1 + 1)
+    ys = np.arange(y0 + 1, y1)
+
+    path = np.concatenate((
+        np.column_stack((xs, np.full(len(xs), y1))),        # top
+        np.column_stack((xs, np.full(len(xs), y0))),        # bottom
+        np.column_stack((np.full(len(ys), x0), ys)),        # left
+        np.column_stack((np.full(len(ys), x1), ys))))       # right
+
+    return np.unique(path, axis=0)
+
+def span_cells(spans):
+    """
+    Every cell of (y, x0, x1) spans as (ys, xs) arrays.
+    """
+    if not spans:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    spans = np.array(spans, dtype=np.int64).reshape(-1, 3)
+    lengths = spans[:, 2] - spans[:, 1]
+    ys = np.repeat(spans[:, 0], lengths)
+    # x0 of each cell's span plus its position within the span
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return ys, np.repeat(spans[:, 1], lengths) + offsets
+
+def subtract_spans(spans, other):
+    """
+    The parts of (y, x0, x1) spans not covered by the other spans.
+    """
+    byRow = {}
+    for y, x0, x1 in other:
+        byRow.setdefault(y, []).append((x0, x1))
+
+    result = []
+    for y, x0, x1 in spans:
+        pieces = [(x0, x1)]
+        for cut0, cut1 in byRow.get(y, ()):
+            pieces = [piece for start, stop in pieces
+                      for piece in ((start, min(stop, cut0)), (max(start, cut1), stop)) if piece[0] < piece[1]]
+        result.extend((y, start, stop) for start, stop in pieces)
 
-    corners = [(origin[0], origin[1]), (end[0], end[1]), (origin[0], end[1]), (end[0], origin[1])]
+    return result
 
-    x0 = min(corners, key = lambda t: t[0])[0]
-    y0 = max(corners, key = lambda t: t[1])[1]
-    
-    x1 = max(corners, key = lambda t: t[0])[0]
-    y1 = min(corners, key = lambda t: t[1])[1]
+def _outline_to_spans(points):
+    # one span per row from the leftmost to the rightmost outline point of that row
+    if len(points) == 0:
+        return []
 
-    for i in range(x0, x1+1):
-        path.append((i, y0))
-        path.append((i, y1))
+    ys, inverse = np.unique(points[:, 1], return_inverse=True)
+    left = np.full(len(ys), points[:, 0].max())
+    right = np.full(len(ys), points[:, 0].min())
+    np.minimum.at(left, inverse, points[:, 0])
+    np.maximum.at(right, inverse, points[:, 0])
 
-    for j in range(y1+1, y0):
-        path.append((x0, j))
-        path.append((x1, j))
+    return list(zip(ys.tolist(), left.tolist(), (right + 1).tolist()))
 
-    return path
+def _runs(row):
+    # start and end (exclusive) of every run of True cells in a boolean row
+    padded = np.concatenate(([False], row, [False]))
+    edges = np.flatnonzero(padded[1:] != padded[:-1]).tolist()
+    return edges[0::2], edges[1::2]
@@ -0,0 +1,165 @@
+import hashlib
+
+import constants as const
+from layers import Layer, LayerStack
+
+class TileStore():
+    """
+    Content-addressed tiles shared by all frames: identical tiles are kept once,
+    however many frames or layers use them. Stored tiles are never modified.
+    """
+    def __init__(self) -> None:
+        self.tiles = {}   # digest -> Tile
+        self.refs = {}    # digest -> number of users
+
+    def acquire(self, digest):
+        self.refs[digest] += 1
+
+    def put(self, tile):
+        # the store takes the tile over if its content is new, returns its digest
+        digest = hashlib.blake2b(b"".join(array.tobytes() for array in tile.arrays()), digest_size=16).digest()
+        if digest in self.refs:
+            self.refs[digest] += 1
+        else:
+            self.tiles[digest] = tile
+            self.refs[digest] = 1
+        return digest
+
+    def release(self, digest):
+        self.refs[digest] -= 1
+        if self.refs[digest] == 0:
+            del self.refs[digest]
+            del self.tiles[digest]
+
+    def size(self):
+        # bytes held by the unique tiles
+        return sum(array.nbytes for tile in self.tiles.values() for array in tile.arrays())
+
+class StoredSource():
+    """
+    The tiles of a frozen layer, as digests into a TileStore. Tiles still unchanged in the
+    source the layer was opened from (base, e.g. a project file) are left there and only
+    decompressed when accessed.
+    """
+    def __init__(self, store, digests, base=None, baseKeys=()) -> None:
+        self.store = store
+        self.digests = digests          # (tx, ty) -> digest
+        self.base = base
+        self.baseKeys = set(baseKeys)   # tiles read from base
+
+    def has_tile(self, tx, ty):
+        return (tx, ty) in self.digests or (tx, ty) in self.baseKeys
+
+    def load_tile(self, tx, ty):
+        if not (tx, ty) in self.digests:
+            return self.base.load_tile(tx, ty)
+        return tuple(array.copy() for array in self.store.tiles[self.digests[(tx, ty)]].arrays())
+
+    def tile_keys(self):
+        return list(self.digests) + [key for key in self.baseKeys if not key in self.digests]
+
+class Animation():
+    """
+    Frames, each a LayerStack. Only the current frame keeps its tiles in its pixel buffers,
+    the others are frozen into the shared TileStore and thawed tile by tile when accessed.
+    """
+    def __init__(self, frames) -> None:
+        self.frames = frames
+        self.currentIndex = 0
+        self.store = TileStore()
+        self.fps = const.ANIMATION_FPS
+
+    def add_frame(self):
+        # copy of the current frame right after it, which becomes current. Both share their tiles.
+        current = self.current()
+        self._freeze(current)
+
+        layers = []
+        for layer in current.layers:
+            source = layer.buffer.source
+            digests = dict(source.digests)
+            for digest in digests.values():
+                self.store.acquire(digest)
+
+            copy = Layer(layer.name, layer.buffer.new_like(source=StoredSource(self.store, digests, source.base,
+                                                                                 source.baseKeys)))
+            copy.visible, copy.opacity, copy.blendMode = layer.visible, layer.opacity, layer.blendMode
+            layers.append(copy)
+
+        stack = LayerStack(current.width, current.height, layers)
+        stack.activeIndex = current.activeIndex
+        stack.layerCount = current.layerCount
+        self.frames.insert(self.currentIndex + 1, stack)
+        self.currentIndex += 1
+        return stack
+
+    def compose(self, index):
+        # composite of a frame, freeze it again afterwards when it is not the current one
+        stack = self.frames[index]
+        stack.update()
+        return stack.composite
+
+    def current(self):
+        return self.frames[self.currentIndex]
+
+    def freeze(self, index):
+        if not index == self.currentIndex:
+            self._freeze(self.frames[index])
+
+    def remove_frame(self, index):
+        if len(self.frames) == 1:
+            return
+
+        stack = self.frames.pop(index)
+        for layer in stack.layers:
+            if isinstance(layer.buffer.source, StoredSource):
+                for digest in layer.buffer.source.digests.values():
+                    self.store.release(digest)
+
+        if index < self.currentIndex or self.currentIndex == len(self.frames):
+            self.currentIndex -= 1
+
+    def set_current(self, index):
+        if 0 <= index < len(self.frames) and not index == self.currentIndex:
+            previous = self.current()
+            self.currentIndex = index
+            self._freeze(previous)
+
+    def _freeze(self, stack):
+        """
+        Move the loaded tiles of every layer into the store and drop them from the layer.
+        Tiles that are the same as in the file the layer was opened from stay there, loaded
+        or not, so a frame is never decompressed just to be frozen.
+        """
+        for layer in stack.layers:
+            buffer = layer.buffer
+            source = buffer.source
+            if not buffer.tiles and isinstance(source, StoredSource):
+                continue
+
+            old = source.digests if isinstance(source, StoredSource) else {}
+            base = source.base if isinstance(source, StoredSource) else source
+            digests = {}
+            baseKeys = set()
+            for key in buffer.tile_keys():
+                if key in old and not key in buffer.tiles:
+                    digests[key] = old[key]
+                    self.store.acquire(old[key])
+                    continue
+
+                if not key in buffer.tiles or not base == None and not key in old \
+                and not key in buffer.modifiedTiles and base.has_tile(*key):
+                    baseKeys.add(key)   # unloaded, or loaded to be shown and unchanged since
+                    continue
+
+                tile = buffer.tiles[key]
+                if tile.mask.any():
+                    digests[key] = self.store.put(tile)
+
+            for digest in old.values():
+                self.store.release(digest)
+
+            buffer.tiles = {}
+            buffer.source = StoredSource(self.store, digests, base, baseKeys)
+
+        stack.reset_composite()
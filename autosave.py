@@ -0,0 +1,474 @@
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+
+import constants as const
+import project as proj
+from animation import StoredSource
+from layers import Layer, LayerStack
+from pixel_buffer import PixelBuffer, Tile
+
+# journal layout: header, then records. Tile records hold the tiles changed since the previous
+# checkpoint record, which closes them with the layers of every frame once all of them are
+# written. A record cut off by a crash fails its CRC, it and everything after it is ignored
+# when the journal is read back, as are tile records no checkpoint record closes.
+MAGIC = b"PIX31JNL"
+VERSION = 1
+HEADER = struct.Struct("<8sIIII")   # magic, version, width, height, tile size
+RECORD = struct.Struct("<BII")      # kind, payload length, CRC-32 of the payload
+TILE = struct.Struct("<III")        # layer id, tx, ty, then the compressed tile, empty when it was cleared
+CHECKPOINT = struct.Struct("<III")  # frame count, current frame, layer count, then per layer its id and
+LAYER_ID = struct.Struct("<I")      # a project.LAYER_HEADER, then the project path
+TILE_RECORD = 1
+CHECKPOINT_RECORD = 2
+
+_executor = None   # single background worker, so checkpoints are written one at a time in order
+_lockFile = None   # held open while this process uses its journal, see claim
+
+class JournalLayer():
+    """
+    A pixel buffer followed by the autosave: its id in the journal and the tiles changed
+    since they were last copied for a checkpoint.
+    """
+    def __init__(self, layerId, buffer, autosave) -> None:
+        self.layerId = layerId
+        self.buffer = buffer
+        self.autosave = autosave
+        self.dirtyTiles = set(buffer.tile_keys())   # a new layer is journaled completely
+        buffer.dirtyListeners.append(self.mark_dirty)
+
+    def close(self):
+        # stop following the buffer
+        self.buffer.dirtyListeners.remove(self.mark_dirty)
+
+    def mark_dirty(self, x0, y0, x1, y1):
+        size = self.buffer.tileSize
+        self.dirtyTiles.update((tx, ty) for ty in range(y0 // size, (y1 - 1) // size + 1)
+                               for tx in range(x0 // size, (x1 - 1) // size + 1))
+        self.autosave.unsaved = True
+
+    def snapshot(self, limit=None):
+        # (key, content) of up to limit dirty tiles, which are not dirty any more
+        keys = []
+        while self.dirtyTiles and (limit == None or len(keys) < limit):
+            keys.append(self.dirtyTiles.pop())
+        return [(key, tile_snapshot(self.buffer, key)) for key in keys]
+
+class Autosave():
+    """
+    Periodic checkpoints of every layer of every frame into a Journal, written on a background
+    thread. The UI thread only copies the tiles changed since the last checkpoint, at most
+    tileBudget of them each time; the others follow in the next calls, and the checkpoint
+    is only closed once they are all written. Until then the previous one stays the one a
+    crash restores. Nothing is written until a layer is edited after the last reset, a save
+    or a new canvas.
+    """
+    def __init__(self, path, tileBudget=const.AUTOSAVE_TILE_BUDGET) -> None:
+        self.path = path
+        self.tileBudget = tileBudget
+
+        self.layers = {}       # PixelBuffer -> JournalLayer
+        self.nextId = 0
+        self.unsaved = False   # set by the layers when they are edited
+        self.table = None      # layers of the last checkpoint
+        self.future = None     # the last task given to the worker
+        self.replaces = None   # journal restored from, removed once a complete checkpoint holds its work
+
+        self.journal = None    # only used on the worker thread
+
+    def checkpoint(self, animation, projectPath, tileBudget=-1):
+        """
+        Hand a checkpoint of the animation over to the worker, unless it is still writing the
+        last one or nothing changed. tileBudget -1 uses the autosave's, None copies every
+        changed tile. Returns the error of the last checkpoint when it failed; the journal
+        is started again then.
+        """
+        error = None
+        if not self.future == None:
+            if not self.future.done():
+                return None
+            error = self.future.exception()
+            if not error == None:
+                self.reset()
+                self.unsaved = True
+
+        table = self.track(animation)
+        if not self.unsaved:
+            return error
+
+        budget = self.tileBudget if tileBudget == -1 else tileBudget
+        tiles = []
+        for journalLayer in self.layers.values():
+            limit = None if budget == None else budget - len(tiles)
+            tiles += [(journalLayer.layerId, key, content) for key, content in journalLayer.snapshot(limit)]
+
+        complete = not any(journalLayer.dirtyTiles for journalLayer in self.layers.values())
+        if not tiles and table == self.table:
+            return error
+
+        checkpoint = None   # tiles only, the checkpoint follows with the last of them
+        replaces = None
+        if complete:
+            checkpoint = (len(animation.frames), animation.currentIndex, table, projectPath)
+            replaces = self.replaces
+            self.table = table
+            self.replaces = None
+
+        buffer = animation.current().layers[0].buffer
+        self.future = _submit(self.write, (buffer.width, buffer.height, buffer.tileSize), checkpoint, tiles,
+                              replaces)
+        return error
+
+    def close(self, animation, projectPath):
+        # a last checkpoint with every changed tile, written before this returns
+        if not self.future == None:
+            wait([self.future])
+        self.checkpoint(animation, projectPath, None)
+        _submit(self.close_journal).result()
+
+    def close_journal(self):
+        if not self.journal == None:
+            self.journal.file.close()
+            self.journal = None
+
+    def remove_journal(self, replaces=None):
+        self.close_journal()
+        for path in (self.path, replaces):
+            try:
+                if not path == None:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def reset(self, animation=None):
+        # forget the journal, after a save or when the canvas is replaced, and follow the layers of the animation
+        for journalLayer in self.layers.values():
+            journalLayer.close()
+        self.layers = {}
+        self.unsaved = False
+        self.table = None
+        self.future = _submit(self.remove_journal, self.replaces)
+        self.replaces = None
+
+        if not animation == None:
+            self.track(animation)
+
+    def track(self, animation):
+        """
+        Follow the layers of the animation that are new, stop following removed ones.
+        Returns the layers as a checkpoint lists them.
+        """
+        table = []
+        buffers = set()
+        for frame, stack in enumerate(animation.frames):
+            for layer in stack.layers:
+                if not layer.buffer in self.layers:
+                    self.layers[layer.buffer] = JournalLayer(self.nextId, layer.buffer, self)
+                    self.nextId += 1
+                buffers.add(layer.buffer)
+                table.append((self.layers[layer.buffer].layerId, frame, layer.name, layer.visible, layer.opacity,
+                              layer.blendMode))
+
+        for buffer in [buffer for buffer in self.layers if not buffer in buffers]:
+            self.layers.pop(buffer).close()
+        return tuple(table)
+
+    def write(self, header, checkpoint, tiles, replaces=None):
+        if self.journal == None:
+            self.journal = Journal(self.path, *header)
+        if checkpoint == None:
+            self.journal.write_tiles(tiles)
+            return
+
+        self.journal.write_checkpoint(checkpoint, tiles)
+        if not replaces == None:
+            try:
+                os.remove(replaces)
+            except FileNotFoundError:
+                pass
+
+class Journal():
+    """
+    The autosave file, only used on the worker thread. Every checkpoint appends the tiles it
+    changed, possibly over several writes, and is synced to disk before the next one starts.
+    The file is compacted to the latest version of every tile once more than half of it is
+    stale.
+    """
+    def __init__(self, path, width, height, tileSize) -> None:
+        self.path = path
+        self.width = width
+        self.height = height
+        self.tileSize = tileSize
+
+        self.entries = {}   # (layer id, tx, ty) -> (offset, length) of the latest blob of the tile
+        self.live = 0       # bytes of those blobs
+        self.pending = {}   # like entries, for tiles written since the last checkpoint record
+        self.lastCheckpoint = b""
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, "w+b")
+        self.file.write(HEADER.pack(MAGIC, VERSION, width, height, tileSize))
+        self.end = HEADER.size
+
+    def compact(self):
+        # rewrite the journal with the latest blob of every tile and the last checkpoint only
+        temporaryPath = self.path + ".tmp"
+        entries = {}
+        with open(temporaryPath, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, self.width, self.height, self.tileSize))
+            end = HEADER.size
+            for entry, (offset, length) in sorted(self.entries.items()):
+                self.file.seek(offset)
+                end += _write_record(f, TILE_RECORD, TILE.pack(*entry) + self.file.read(length))
+                entries[entry] = (end - length, length)
+            end += _write_record(f, CHECKPOINT_RECORD, self.lastCheckpoint)
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.file.close()
+        os.replace(temporaryPath, self.path)
+        self.file = open(self.path, "r+b")
+        self.file.seek(end)
+        self.end = end
+        self.entries = entries
+
+    def write_tiles(self, tiles):
+        # tile records of a checkpoint that is not complete yet
+        for layerId, key, content in tiles:
+            blob = encode_content(content)
+            entry = (layerId, *key)
+            if not blob and not entry in self.entries and not entry in self.pending:   # empty before and after
+                continue
+
+            self.end += _write_record(self.file, TILE_RECORD, TILE.pack(*entry) + blob)
+            self.pending[entry] = (self.end - len(blob), len(blob))
+        self.file.flush()
+
+    def write_checkpoint(self, checkpoint, tiles):
+        self.write_tiles(tiles)
+        for entry, (offset, length) in self.pending.items():
+            self.live -= self.entries.pop(entry, (0, 0))[1]
+            if length:
+                self.entries[entry] = (offset, length)
+                self.live += length
+        self.pending = {}
+
+        # tiles of removed layers are stale from now on
+        frameCount, currentIndex, table, projectPath = checkpoint
+        layerIds = set(row[0] for row in table)
+        for entry in [entry for entry in self.entries if not entry[0] in layerIds]:
+            self.live -= self.entries.pop(entry)[1]
+
+        self.lastCheckpoint = encode_checkpoint(frameCount, currentIndex, table, projectPath)
+        self.end += _write_record(self.file, CHECKPOINT_RECORD, self.lastCheckpoint)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+        live = HEADER.size + self.live + RECORD.size * (len(self.entries) + 1) + len(self.lastCheckpoint)
+        if self.end > 2 * live:
+            self.compact()
+
+class JournalSource():
+    """
+    The tiles of a layer restored from a journal, decompressed on request.
+    """
+    def __init__(self, blobs, tileSize) -> None:
+        self.blobs = blobs   # (tx, ty) -> compressed tile
+        self.tileSize = tileSize
+
+    def blob(self, tx, ty):
+        return self.blobs[(tx, ty)]
+
+    def has_tile(self, tx, ty):
+        return (tx, ty) in self.blobs
+
+    def load_tile(self, tx, ty):
+        return proj.decode_tile(self.blobs[(tx, ty)], self.tileSize)
+
+    def tile_keys(self):
+        return list(self.blobs)
+
+def decode_checkpoint(payload):
+    frameCount, currentIndex, layerCount = CHECKPOINT.unpack_from(payload)
+    offset = CHECKPOINT.size
+    table = []
+    for _ in range(layerCount):
+        layerId, = LAYER_ID.unpack_from(payload, offset)
+        frame, name, visible, opacity, blendMode = proj.LAYER_HEADER.unpack_from(payload, offset + LAYER_ID.size)
+        table.append((layerId, frame, name.rstrip(b"\0").decode("utf-8", "ignore"), visible, opacity,
+                      proj.BLEND_MODE_NAMES[blendMode]))
+        offset += LAYER_ID.size + proj.LAYER_HEADER.size
+    return frameCount, currentIndex, table, payload[offset:].decode("utf-8")
+
+def encode_checkpoint(frameCount, currentIndex, table, projectPath):
+    parts = [CHECKPOINT.pack(frameCount, currentIndex, len(table))]
+    for layerId, frame, name, visible, opacity, blendMode in table:
+        parts.append(LAYER_ID.pack(layerId))
+        parts.append(proj.LAYER_HEADER.pack(frame, name.encode("utf-8")[:64], visible, opacity,
+                                            proj.BLEND_MODE_NAMES.index(blendMode)))
+    parts.append(projectPath.encode("utf-8"))
+    return b"".join(parts)
+
+def encode_content(content):
+    # a tile_snapshot as the blob the journal stores, empty for an empty tile
+    if content == None:
+        return b""
+    if isinstance(content, bytes):
+        return content
+    return proj.encode_tile(content) if content.mask.any() else b""
+
+def read_journal(path):
+    """
+    The state of the last complete checkpoint of a journal: (width, height, tile size,
+    (frame count, current frame, layers, project path), tiles), where tiles maps
+    (layer id, tx, ty) to the compressed tiles. None when there is no complete checkpoint.
+    """
+    with open(path, "rb") as f:
+        data = f.read(HEADER.size)
+        if len(data) < HEADER.size:
+            return None
+        magic, version, width, height, tileSize = HEADER.unpack(data)
+        if not magic == MAGIC or not version == VERSION:
+            return None
+
+        tiles = {}
+        pending = {}   # tiles of a checkpoint whose record has not been read yet
+        checkpoint = None
+        while True:
+            data = f.read(RECORD.size)
+            if len(data) < RECORD.size:
+                break
+            kind, length, crc = RECORD.unpack(data)
+            payload = f.read(length)
+            if len(payload) < length or not zlib.crc32(payload) == crc:
+                break
+
+            if kind == TILE_RECORD:
+                pending[TILE.unpack_from(payload)] = payload[TILE.size:]
+            elif kind == CHECKPOINT_RECORD:
+                tiles.update(pending)
+                pending = {}
+                checkpoint = decode_checkpoint(payload)
+
+    if checkpoint == None:
+        return None
+    return width, height, tileSize, checkpoint, tiles
+
+def recover(path):
+    """
+    The frames of the last complete checkpoint of a journal, each a LayerStack whose tiles are
+    decompressed on request, as (frames, current frame, project path). None when there is
+    nothing to restore.
+    """
+    journal = read_journal(path)
+    if journal == None:
+        return None
+    width, height, tileSize, (frameCount, currentIndex, table, projectPath), tiles = journal
+
+    blobs = {}   # layer id -> (tx, ty) -> compressed tile
+    for (layerId, tx, ty), blob in tiles.items():
+        if blob:
+            blobs.setdefault(layerId, {})[(tx, ty)] = blob
+
+    frames = [[] for _ in range(frameCount)]
+    for layerId, frame, name, visible, opacity, blendMode in table:
+        source = JournalSource(blobs.get(layerId, {}), tileSize)
+        layer = Layer(name, PixelBuffer(width, height, tileSize=tileSize, source=source))
+        layer.visible = visible
+        layer.opacity = opacity
+        layer.blendMode = blendMode
+        frames[frame].append(layer)
+
+    return [LayerStack(width, height, layers) for layers in frames], currentIndex, projectPath
+
+def claim(path):
+    """
+    A journal path no other running instance uses: path, or path with -2, -3, ... added while
+    those are taken. The claim is a lock on the journal's .lock file, which the system
+    releases when the process ends, crashed or not, so the next instance finds the journal
+    again.
+    """
+    global _lockFile
+    root, extension = os.path.splitext(path)
+    number = 1
+    while True:
+        journalPath = path if number == 1 else f"{root}-{number}{extension}"
+        try:
+            os.makedirs(os.path.dirname(journalPath), exist_ok=True)
+            f = open(journalPath + ".lock", "a+b")
+        except OSError:
+            return journalPath   # not writable, autosave reports it with the first checkpoint
+        if _lock(f):
+            _lockFile = f
+            return journalPath
+        f.close()
+        number += 1
+
+def set_aside(path):
+    """
+    Move the journal the last session left behind out of the way of this session's one.
+    A journal restored from before stays when the last session did not get to a complete
+    checkpoint. Returns the path it can be restored from, None when there is nothing to restore.
+    """
+    recoveryPath = path + ".recover"
+    try:
+        if os.path.getsize(path) > HEADER.size \
+        and (not os.path.exists(recoveryPath) or not read_journal(path) == None):
+            os.replace(path, recoveryPath)
+        else:
+            os.remove(path)
+    except OSError:
+        pass
+    return recoveryPath if os.path.exists(recoveryPath) else None
+
+def tile_snapshot(buffer, key):
+    """
+    Content of a tile that stays the same while the worker encodes it: the compressed blob of
+    an unloaded project or journal tile, a stored Tile (never modified), a copy of a loaded
+    tile, or None for no tile.
+    """
+    tile = buffer.tiles.get(key)
+    source = buffer.source
+    if tile == None and not source == None and source.has_tile(*key):
+        if isinstance(source, StoredSource) and not key in source.digests:
+            source = source.base   # unchanged since the frame was opened
+        if isinstance(source, (proj.LayerSource, JournalSource)):
+            return bytes(source.blob(*key))
+        tile = source.store.tiles[source.digests[key]] if isinstance(source, StoredSource) else None
+        if isinstance(tile, Tile):
+            return tile
+        if tile == None:
+            tile = buffer.make_tile(*source.load_tile(*key))
+
+    if tile == None:
+        return None
+    return Tile(buffer.tileSize, np.array(tile.pixels), np.array(tile.mask))
+
+def _lock(f):
+    # exclusive lock on the file without waiting, False when another process holds it
+    try:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
+def _submit(function, *args):
+    global _executor
+    if _executor == None:
+        _executor = ThreadPoolExecutor(max_workers=1)
+    return _executor.submit(function, *args)
+
+def _write_record(f, kind, payload):
+    # bytes written
+    f.write(RECORD.pack(kind, len(payload), zlib.crc32(payload)))
+    f.write(payload)
+    return RECORD.size + len(payload)
@@ -0,0 +1,131 @@
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from PIL import Image
+
+import algorithms as algo
+import constants as const
+import export as exp
+import palette_manager as palet
+
+IMAGE_EXTENSIONS = (".png", ".gif", ".bmp", ".tga")
+
+_palettes = {}   # palette file -> colors, per worker process
+
+def fill(matrix, x, y, color):
+    # paint bucket at (x, y), row 0 at the top like in the image file
+    height, width = matrix.shape[:2]
+    if not (0 <= x < width and 0 <= y < height):
+        return
+
+    if matrix[y, x, 3] == 0:
+        fillable = matrix[:, :, 3] == 0
+    else:
+        fillable = np.all(matrix == matrix[y, x], axis=2)
+
+    for row, x0, x1 in algo.flood_fill((x, y), fillable):
+        matrix[row, x0:x1] = color
+
+def load_palette(path):
+    if not path in _palettes:
+        _palettes[path] = palet.read_hex_to_rgb(path)
+    return _palettes[path]
+
+def parse_color(text):
+    # RRGGBB or RRGGBBAA
+    text = text.lstrip("#")
+    if not len(text) in (6, 8):
+        raise ValueError(f"invalid color: {text}")
+    color = tuple(int(text[i:i + 2], 16) for i in range(0, len(text), 2))
+    return color if len(color) == 4 else color + (255,)
+
+def process_image(path, outputPath, options):
+    """
+    Apply the operations to one image file and write the result. Runs in a worker process.
+    """
+    matrix = np.array(Image.open(path).convert("RGBA"))
+    matrix[matrix[:, :, 3] == 0] = 0   # empty pixels are (0, 0, 0, 0) everywhere in pix31
+
+    for x, y, color in options.fills:
+        fill(matrix, x, y, color)
+
+    for old, new in options.recolors:
+        matrix[np.all(matrix == old, axis=2)] = new
+
+    palette = None
+    if not options.palette == None:
+        palette = load_palette(options.palette)
+        indices = exp.palette_indices(matrix, palette, options.metric)
+        colors = np.array(list(palette) + [(0, 0, 0, 0)], dtype=np.uint8)
+        matrix[:, :, :3] = colors[indices][:, :, :3]   # the image's alpha stays, empty pixels stay empty
+
+    target = exp.ExportTarget(options.format, options.scale, options.indexed, const.EXPORT_COMPRESS_LEVEL)
+    os.makedirs(os.path.dirname(outputPath) or ".", exist_ok=True)
+    exp.write_target(matrix, target, outputPath, palette)
+    return outputPath
+
+def find_images(inputDirectory):
+    for directory, _, filenames in os.walk(inputDirectory):
+        for filename in sorted(filenames):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.join(directory, filename)
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(prog=f"{const.APP_NAME}-batch",
+                                     description="Apply pix31 operations to every image in a directory.")
+    parser.add_argument("input", help="directory with the images, searched recursively")
+    parser.add_argument("output", help="directory the results are written to, with the same layout")
+    parser.add_argument("--fill", nargs=3, action="append", default=[], metavar=("X", "Y", "COLOR"),
+                        help="paint bucket at X, Y (0, 0 is the top left pixel) with COLOR (RRGGBB[AA])")
+    parser.add_argument("--recolor", nargs=2, action="append", default=[], metavar=("OLD", "NEW"),
+                        help="replace every pixel of color OLD with NEW")
+    parser.add_argument("--palette", help=".hex palette every color is mapped to")
+    parser.add_argument("--metric", default="rgb", choices=("rgb", "perceptual"),
+                        help="color distance used by --palette")
+    parser.add_argument("--scale", type=int, default=1, help="integer nearest-neighbour scale")
+    parser.add_argument("--format", default="PNG", choices=("PNG", "GIF"))
+    parser.add_argument("--indexed", action="store_true", help="write palette images, needs --palette")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="worker processes")
+    arguments = parser.parse_args()
+
+    try:
+        arguments.fills = [(int(x), int(y), parse_color(color)) for x, y, color in arguments.fill]
+        arguments.recolors = [(parse_color(old), parse_color(new)) for old, new in arguments.recolor]
+    except ValueError as error:
+        parser.error(str(error))
+    if arguments.scale < 1:
+        parser.error("scale must be at least 1")
+    if (arguments.indexed or arguments.format == "GIF") and arguments.palette == None:
+        parser.error("indexed and GIF output need --palette")
+
+    return arguments
+
+def run(arguments):
+    # returns the number of images that failed
+    paths = list(find_images(arguments.input))
+    target = exp.ExportTarget(arguments.format, indexed=arguments.indexed)
+    failed = 0
+
+    with ProcessPoolExecutor(max_workers=max(arguments.jobs, 1)) as pool:
+        futures = {}
+        for path in paths:
+            name = os.path.splitext(os.path.relpath(path, arguments.input))[0]
+            outputPath = os.path.join(arguments.output, name + "." + target.format.lower())
+            futures[pool.submit(process_image, path, outputPath, arguments)] = path
+
+        # report every image as soon as it is done, in whatever order the workers finish
+        for done, future in enumerate(as_completed(futures), 1):
+            error = future.exception()
+            if error == None:
+                print(f"[{done}/{len(paths)}] {futures[future]} -> {future.result()}", flush=True)
+            else:
+                failed += 1
+                print(f"[{done}/{len(paths)}] {futures[future]} failed: {error}", file=sys.stderr, flush=True)
+
+    return failed
+
+if __name__ == "__main__":
+    sys.exit(1 if run(parse_arguments()) > 0 else 0)
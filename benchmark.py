@@ -0,0 +1,159 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import types
+
+import numpy as np
+import pyglet
+
+pyglet.options["shadow_window"] = False   # main imports pyglet windows, no display is needed to time the canvas
+
+import algorithms as algo
+import constants as const
+import export as exp
+import main
+
+SIZES = (64, 256, 1024, 4096)
+COLOR = (200, 40, 40, 255)
+
+def bench_algorithms(size):
+    end = (size - 1, size - 1)
+    yield "algorithms.bresenham_line", None, lambda: algo.bresenham_line((0, 0), end)
+    yield "algorithms.ellipse", None, lambda: algo.ellipse((0, 0), end)
+    yield "algorithms.rectangle", None, lambda: algo.rectangle((0, 0), end)
+
+    # the inside of an ellipse outline, so the fill has to follow a curved border
+    fillable = np.ones((size, size), dtype=bool)
+    outline = np.clip(algo.ellipse((0, 0), end), 0, size - 1)
+    fillable[outline[:, 1], outline[:, 0]] = False
+    yield "algorithms.flood_fill", None, lambda: algo.flood_fill((size // 2, size // 2), fillable)
+
+def bench_canvas(size):
+    canvas = main.Canvas(size, size)
+    points = [tuple(point) for point in np.random.default_rng(31).integers(0, size, (10000, 2))]
+
+    def add_pixels():
+        for point in points:
+            canvas.add_pixel(point, COLOR, "pixel")
+    yield "Canvas.add_pixel x10000", None, add_pixels
+
+    # Window.apply_preview and clear_preview only use the canvas of the window
+    window = types.SimpleNamespace(canvas=canvas)
+
+    def draw_preview():
+        canvas.clear_preview()
+        canvas.beginningPos = [0, 0]
+        canvas.endPos = [size - 1, size - 1]
+        canvas.draw_rectangle(COLOR, filled=True)
+
+    yield "Window.apply_preview", draw_preview, lambda: main.Window.apply_preview(window)
+    yield "Window.clear_preview", draw_preview, lambda: main.Window.clear_preview(window)
+
+def bench_export(size):
+    matrix = np.zeros((size, size, 4), dtype=np.uint8)
+    matrix[size // 4:size // 2, :] = COLOR
+    matrix[:, size // 4:size // 2] = (40, 40, 200, 255)
+
+    def export():
+        path = exp.export_image(matrix, size, size)
+        os.remove(path)   # keeps the file name the same on every run
+    yield "export.export_image", None, export
+
+BENCHMARKS = (bench_algorithms, bench_canvas, bench_export)
+
+def measure(setup, function, minTime, minRepeat, maxRepeat):
+    # seconds of every run, setup is not timed
+    times = []
+    start = time.perf_counter()
+    while len(times) < minRepeat or (time.perf_counter() - start < minTime and len(times) < maxRepeat):
+        if not setup == None:
+            setup()
+        t0 = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - t0)
+    return times
+
+def run(arguments):
+    results = {}
+    for size in arguments.sizes:
+        for benchmark in BENCHMARKS:
+            for name, setup, function in benchmark(size):
+                key = f"{name}[{size}]"
+                if not arguments.filter == None and not arguments.filter in key:
+                    continue
+
+                times = measure(setup, function, arguments.min_time, arguments.min_repeat, arguments.max_repeat)
+                results[key] = {"best": min(times), "median": statistics.median(times), "runs": len(times)}
+                print(f"{key:44} {min(times) * 1000:10.3f} ms  (median {statistics.median(times) * 1000:.3f} ms, "
+                      f"{len(times)} runs)", file=sys.stderr, flush=True)
+    return results
+
+def compare(results, baseline, tolerance, floor):
+    """
+    Names of the benchmarks whose best time is more than tolerance (a fraction) slower than
+    in the baseline. Differences below floor seconds are noise and never count.
+    """
+    regressions = []
+    for key, result in results.items():
+        old = baseline.get(key)
+        if old == None:
+            continue
+
+        ratio = result["best"] / old["best"]
+        regressed = ratio > 1 + tolerance and result["best"] - old["best"] > floor
+        if regressed:
+            regressions.append(key)
+        print(f"{key:44} {ratio:6.2f}x{'  REGRESSION' if regressed else ''}", file=sys.stderr)
+    return regressions
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(prog=f"{const.APP_NAME}-benchmark",
+                                     description="Time pix31 algorithms, canvas operations and export headless.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="square canvas sizes")
+    parser.add_argument("--filter", help="only run benchmarks whose name contains this")
+    parser.add_argument("--output", help="write the results as JSON to this file instead of stdout")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="fraction a benchmark may be slower than the baseline before it fails")
+    parser.add_argument("--floor", type=float, default=0.0002,
+                        help="seconds a benchmark may be slower than the baseline regardless of the tolerance")
+    parser.add_argument("--min-time", type=float, default=0.5, help="seconds each benchmark is repeated for")
+    parser.add_argument("--min-repeat", type=int, default=3)
+    parser.add_argument("--max-repeat", type=int, default=200)
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    arguments = parse_arguments()
+
+    baseline = None
+    if not arguments.baseline == None:
+        with open(arguments.baseline) as f:
+            baseline = json.load(f)["results"]
+
+    with tempfile.TemporaryDirectory() as directory:
+        exp.EXPORT_DIRECTORY = directory
+        results = run(arguments)
+
+    document = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "results": results,
+    }
+    text = json.dumps(document, indent=1, sort_keys=True)
+    if arguments.output == None:
+        print(text)
+    else:
+        with open(arguments.output, "w") as f:
+            f.write(text + "\n")
+
+    if not baseline == None:
+        regressions = compare(results, baseline, arguments.tolerance, arguments.floor)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) slower than the baseline: {', '.join(regressions)}", file=sys.stderr)
+            sys.exit(1)
@@ -0,0 +1,101 @@
+import functools
+
+import numpy as np
+
+import constants as const
+
+SHAPES = ("square", "circle", "custom")
+
+class Brush():
+    """
+    Stamp of the pencil and the eraser: a (height, width) bool mask centered on the cursor.
+    Square and circle stamps are computed once per size and shared, a custom stamp is any
+    mask, e.g. the shape of the copied selection.
+    """
+    def __init__(self, shape="square", size=1, mask=None) -> None:
+        self.shape = shape
+        self.size = size
+        self.mask = stamp_mask(shape, size) if mask is None else mask
+
+    def cover(self, xs, ys, width, height):
+        """
+        Every cell under the stamp at the (x, y) points of a path, as a bool block and the
+        position of its top left cell, clipped to a width x height buffer. None when the
+        path stays outside. Each cell is set once, however many stamps overlap on it.
+        """
+        stampHeight, stampWidth = self.mask.shape
+        left, top = int(xs.min()) - stampWidth // 2, int(ys.min()) - stampHeight // 2
+        right, bottom = int(xs.max()) - stampWidth // 2 + stampWidth, int(ys.max()) - stampHeight // 2 + stampHeight
+
+        clipLeft, clipTop = max(left, 0), max(top, 0)
+        clipRight, clipBottom = min(right, width), min(bottom, height)
+        if clipLeft >= clipRight or clipTop >= clipBottom:
+            return None
+
+        # top left corner of every stamp in the block, each point once
+        blockWidth = right - left
+        corners = np.unique((ys - ys.min()) * blockWidth + (xs - xs.min()))
+        cornerYs, cornerXs = np.divmod(corners, blockWidth)
+
+        # paste the stamp at every point, or shift the whole path by every stamp cell, whichever loops less
+        block = np.zeros((bottom - top, blockWidth), dtype=bool)
+        if len(corners) <= np.count_nonzero(self.mask):
+            for x, y in zip(cornerXs.tolist(), cornerYs.tolist()):
+                block[y:y + stampHeight, x:x + stampWidth] |= self.mask
+        else:
+            for dy, dx in zip(*np.nonzero(self.mask)):
+                block[cornerYs + dy, cornerXs + dx] = True
+
+        return block[clipTop - top:clipBottom - top, clipLeft - left:clipRight - left], clipLeft, clipTop
+
+    def resized(self, size):
+        # the same shape at another size, custom stamps keep their mask
+        if self.shape == "custom":
+            return self
+        return Brush(self.shape, min(max(size, 1), const.BRUSH_SIZE_MAX))
+
+class StrokeCoverage():
+    """
+    The cells a stroke has painted so far, as one bitmap per block of tileSize cells it reached.
+    """
+    def __init__(self, tileSize=256) -> None:
+        self.tileSize = tileSize
+        self.tiles = {}   # (tx, ty) -> (tileSize, tileSize) bool array
+
+    def claim(self, block, x0, y0):
+        # the cells of a bool block at (x0, y0) the stroke had not painted yet, marked as painted now
+        block = block.copy()
+        height, width = block.shape
+        size = self.tileSize
+
+        for ty in range(y0 // size, (y0 + height - 1) // size + 1):
+            for tx in range(x0 // size, (x0 + width - 1) // size + 1):
+                left, right = max(x0, tx * size), min(x0 + width, tx * size + size)
+                top, bottom = max(y0, ty * size), min(y0 + height, ty * size + size)
+
+                part = block[top - y0:bottom - y0, left - x0:right - x0]
+                if not part.any():
+                    continue
+                if not (tx, ty) in self.tiles:
+                    self.tiles[(tx, ty)] = np.zeros((size, size), dtype=bool)
+                covered = self.tiles[(tx, ty)][top - ty * size:bottom - ty * size, left - tx * size:right - tx * size]
+
+                part &= ~covered
+                covered |= part
+
+        return block
+
+@functools.lru_cache(maxsize=None)
+def stamp_mask(shape, size):
+    """
+    (size, size) bool mask of a square or circle stamp, cached and read-only.
+    """
+    if shape == "circle" and size > 2:
+        center = (size - 1) / 2
+        ys, xs = np.ogrid[:size, :size]
+        mask = (xs - center) ** 2 + (ys - center) ** 2 <= (size / 2) ** 2 - 0.5
+    else:
+        mask = np.ones((size, size), dtype=bool)
+
+    mask.setflags(write=False)
+    return mask
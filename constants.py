@@ -1,6 +1,20 @@
+import os
+
 APP_NAME = "pix31"
 
 APP_ICON_PATH = "./icons/favicon.ico"
+ICON_PATHS = {"pencil": "./icons/pencil.png", "eraser": "./icons/eraser.png", "dropper": "./icons/dropper.png",
+              "line": "./icons/line.png", "rectangle": "./icons/rect.png", "ellipse": "./icons/ellipse.png",
+              "fill": "./icons/paint-bucket.png", "select": "./icons/select.png", "wand": "./icons/wand.png",
+              "app": APP_ICON_PATH}
+
+CACHE_DIRECTORY = os.path.join(os.environ.get("LOCALAPPDATA") or os.path.expanduser("~/.cache"), "pix31")
+ICON_ATLAS_CACHE = os.path.join(CACHE_DIRECTORY, "icons.npz")
+THUMBNAIL_CACHE = os.path.join(CACHE_DIRECTORY, "thumbnails")
+THUMBNAIL_SIZE = 128            # power of two, larger side of project thumbnails
+AUTOSAVE_JOURNAL = os.path.join(CACHE_DIRECTORY, "autosave.journal")
+AUTOSAVE_INTERVAL = 5           # seconds between autosave checkpoints
+AUTOSAVE_TILE_BUDGET = 512      # changed tiles copied per checkpoint, the rest follow in the next ones
 
 WINDOW_START_WIDTH = 960
 WINDOW_START_HEIGHT = 540
@@ -23,5 +37,30 @@ ZOOM_LIMIT_HIGH = 2
 
 CANVAS_BACKGROUND_COLOR = (255, 255, 255, 255)
 
-CANVAS_SIZE_X = 64
+GRID_COLOR = (0, 0, 0, 40)
+GRID_TILE_COLOR = (0, 0, 0, 120)
+GRID_TILE_SIZES = (8, 16, 32)   # custom tile grids, cycled with shift+G
+GRID_MIN_SPACING = 4            # screen pixels, closer grid lines are not drawn
+
+SELECTION_COLOR = (0, 120, 255, 255)
+
+BRUSH_SIZE_MAX = 64
+
+CANVAS_SIZE_X = 64              # default size, another one can be given on the command line
 CANVAS_SIZE_Y = 64
+CANVAS_SIZE_MAX = 16384
+
+EXPORT_COMPRESS_LEVEL = 9       # zlib level for PNG targets of the full export, 0-9
+EXPORT_SCALES = (2, 4, 8)       # extra nearest-neighbour upscales written by the full export
+
+HISTORY_MEMORY_BUDGET = 64 * 1024 * 1024   # bytes of compressed undo/redo history
+
+TILE_SIZE = 64                  # side of the square tiles the canvas is stored in
+RENDER_CHUNK_SIZE = 512         # side of the square textures the canvas is drawn with
+
+PROJECT_EXTENSION = ".pix31"
+IMPORT_BAND_HEIGHT = 256        # rows of an imported image converted to RGBA at a time
+
+ANIMATION_FPS = 12
+ONION_SKIN_FRAMES = 1           # frames shown before and after the current one
+ONION_SKIN_OPACITY = 72         # 0-255
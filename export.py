@@ -1,21 +1,152 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 from PIL import Image
 
+import palette_manager as palet
+from pixel_buffer import PixelBuffer
+
+EXPORT_DIRECTORY = "./images"
+
+_executor = None   # single background worker, so exports are written one at a time in order
+
+class ExportTarget():
+    """
+    One output file of an export: format, nearest-neighbour scale, palette indexing and compression.
+    """
+    def __init__(self, format="PNG", scale=1, indexed=False, compressLevel=None) -> None:
+        self.format = format
+        self.scale = scale
+        self.indexed = indexed or format == "GIF"   # GIF can only store palette images
+        self.compressLevel = compressLevel
+
+    def filename(self, name):
+        suffix = ""
+        if self.indexed and not self.format == "GIF":
+            suffix += "_indexed"
+        if self.scale > 1:
+            suffix += "_x{}".format(self.scale)
+        return "{}{}.{}".format(name, suffix, self.format.lower())
+
 def export_image(matrix, width, height):
-    img = Image.new('RGBA', (width, height), 255)
+    # matrix is the canvas pixel buffer, an (height, width, 4) uint8 array
+    img = Image.frombytes("RGBA", (width, height), matrix.tobytes())
+
+    os.makedirs(EXPORT_DIRECTORY, exist_ok=True)
+
+    target = ExportTarget()
+    path = "{}/{}".format(EXPORT_DIRECTORY, target.filename(_free_name([target])))
+    img.save(path, "PNG")
+
+    return path
+
+def export_image_async(matrix, width, height, callback=None):
+    """
+    Export the matrix on a background thread. matrix is an array nothing writes to any more,
+    or a PixelBuffer snapshot, which is only read into one on the worker.
+    callback(path, error) is called from the worker thread when the file is written.
+    """
+    return _submit(export_image, matrix, callback, width, height)
+
+def export_targets(matrix, targets, palette=None):
+    """
+    Write every target from one (height, width, 4) snapshot, encoding the targets in parallel.
+    Indexed targets use the palette; pixels are matched to it once for all of them.
+    Returns the written paths in the order of the targets.
+    """
+    os.makedirs(EXPORT_DIRECTORY, exist_ok=True)
+    name = _free_name(targets)
+
+    indices = None
+    if any(target.indexed for target in targets):
+        if palette == None:
+            raise ValueError("indexed export needs a palette")
+        indices = palette_indices(matrix, palette)
 
-    # add pixels from the canvas matrix to the PNG
-    for y in range(0, height):
-        for x in range(0, width):
-            img.putpixel((x, y), matrix[y][x])
+    def save(target):
+        path = "{}/{}".format(EXPORT_DIRECTORY, target.filename(name))
+        write_target(matrix, target, path, palette, indices)
+        return path
 
+    # numpy and the PIL encoders release the GIL, so threads spread the encoding over the cores
+    with ThreadPoolExecutor(max_workers=min(len(targets), os.cpu_count() or 1)) as pool:
+        return list(pool.map(save, targets))
+
+def export_targets_async(matrix, targets, palette=None, callback=None):
+    """
+    Like export_image_async, for export_targets. callback gets the list of written paths.
+    """
+    return _submit(export_targets, matrix, callback, targets, palette)
+
+def palette_indices(matrix, palette, metric="rgb"):
+    """
+    Index of the closest palette color for every pixel, as a (height, width) uint8 array.
+    Empty pixels get the index len(palette).
+    """
+    if len(palette) > 255:
+        raise ValueError("indexed export supports at most 255 palette colors")
+
+    indices = palet.get_mapper(palette, metric).indices(matrix)
+    indices[matrix[:, :, 3] == 0] = len(palette)
+    return indices
+
+def upscale(matrix, factor):
+    # nearest-neighbour integer scale of the first two axes
+    if factor == 1:
+        return matrix
+    return matrix.repeat(factor, axis=0).repeat(factor, axis=1)
+
+def write_target(matrix, target, path, palette=None, indices=None):
+    """
+    Write a (height, width, 4) matrix to path as described by the target. Indexed targets
+    need the palette, and take the palette indices when they were already computed.
+    """
+    options = {}
+    if not target.compressLevel == None and target.format == "PNG":
+        options["compress_level"] = target.compressLevel
+
+    if target.indexed:
+        if palette == None:
+            raise ValueError("indexed export needs a palette")
+        if indices is None:
+            indices = palette_indices(matrix, palette)
+
+        data = upscale(indices, target.scale)
+        img = Image.frombytes("P", (data.shape[1], data.shape[0]), data.tobytes())
+        img.putpalette([c for color in palette for c in color[:3]] + [0, 0, 0])
+        options["transparency"] = len(palette)   # the extra last entry marks empty pixels
+    else:
+        data = upscale(matrix, target.scale)
+        img = Image.frombytes("RGBA", (data.shape[1], data.shape[0]), data.tobytes())
+
+    img.save(path, target.format, **options)
+
+def _free_name(targets):
+    # first "image", "image1", "image2", ... none of the targets would overwrite
     fCount = 0
-    for f in os.listdir("."):
-        if f.startswith("image"):      # check if filename already exists
-            fCount += 1                # calculate a number to filename if duplicate names
+    while True:
+        name = "image{}".format(fCount if fCount > 0 else "")
+        paths = ["{}/{}".format(EXPORT_DIRECTORY, target.filename(name)) for target in targets]
+        if not any(os.path.exists(path) for path in paths):
+            return name
+        fCount += 1
+
+def _submit(function, snapshot, callback, *args):
+    global _executor
+    if _executor == None:
+        _executor = ThreadPoolExecutor(max_workers=1)
+
+    def run():
+        matrix = snapshot
+        if isinstance(snapshot, PixelBuffer):
+            matrix, _ = snapshot.read(0, 0, snapshot.width, snapshot.height)
+        return function(matrix, *args)
+    future = _executor.submit(run)
 
-    if fCount == 0:
-        fCount = ""
+    if not callback == None:
+        def done(future):
+            error = future.exception()
+            callback(None if error else future.result(), error)
+        future.add_done_callback(done)
 
-    img.save("./images/image{}.png".format(fCount), "PNG")
+    return future
@@ -0,0 +1,130 @@
+import zlib
+from collections import deque
+
+import numpy as np
+
+class HistoryEntry():
+    """
+    The tiles one stroke changed: the arrays of every tile before and after the stroke,
+    kept zlib-compressed. An empty blob stands for no tile.
+    """
+    def __init__(self, buffer, tiles) -> None:
+        self.buffer = buffer   # the pixel buffer (layer) the stroke was drawn on
+        self.tiles = [(key, _compress(old), _compress(new)) for key, old, new in tiles]
+        self.size = sum(len(old) + len(new) for _, old, new in self.tiles)
+
+    def apply(self, state):
+        # write the "old" or the "new" side of the entry back into its buffer
+        template = self.buffer.make_tile().arrays()
+        for key, old, new in self.tiles:
+            self.buffer.restore_tile(key, _decompress(old if state == "old" else new, template))
+
+class StrokeRecorder():
+    """
+    Copies of the tiles written during one stroke, taken before the first write to each of
+    them, so the memory grows with the tiles a stroke reaches, not with the cells it writes.
+    """
+    def __init__(self) -> None:
+        self.tiles = {}   # (tx, ty) -> arrays of the tile before the stroke, None when there was none
+
+    def finish(self, buffer):
+        # an entry of the tiles that differ from their copies, None when nothing changed
+        empty = buffer.make_tile().arrays()
+        tiles = []
+        for key, old in self.tiles.items():
+            tile = buffer.get_tile(*key)
+            new = None if tile == None else tile.arrays()
+            if all(np.array_equal(a, b) for a, b in zip(empty if old == None else old, empty if new == None else new)):
+                continue
+            tiles.append((key, old, new))
+
+        if not tiles:
+            return None
+        return HistoryEntry(buffer, tiles)
+
+    def record(self, buffer, keys):
+        for key in keys:
+            if not key in self.tiles:
+                tile = buffer.get_tile(*key)
+                self.tiles[key] = None if tile == None else tuple(array.copy() for array in tile.arrays())
+
+class History():
+    """
+    Undo/redo stacks of per-stroke entries, limited to a memory budget in bytes.
+    The oldest entries are dropped when the budget is exceeded.
+    """
+    def __init__(self, budget) -> None:
+        self.budget = budget
+        self.undoStack = deque()
+        self.redoStack = []
+        self.size = 0   # compressed bytes held by both stacks
+
+        self.buffer = None
+        self.recorder = None
+
+    def begin(self, buffer):
+        # start recording a stroke on the buffer
+        if not self.recorder == None:
+            return
+
+        self.buffer = buffer
+        self.recorder = StrokeRecorder()
+        buffer.recorder = self.recorder
+
+    def end(self):
+        if self.recorder == None:
+            return
+
+        entry = self.recorder.finish(self.buffer)
+        self.buffer.recorder = None
+        self.recorder = None
+
+        if not entry == None:
+            self.push(entry)
+
+    def push(self, entry):
+        for old in self.redoStack:
+            self.size -= old.size
+        self.redoStack = []
+
+        self.undoStack.append(entry)
+        self.size += entry.size
+
+        # always keep the newest entry, even when it alone is over the budget
+        while self.size > self.budget and len(self.undoStack) > 1:
+            self.size -= self.undoStack.popleft().size
+
+    def redo(self):
+        if not self.recorder == None or not self.redoStack:
+            return False
+
+        entry = self.redoStack.pop()
+        entry.apply("new")
+        self.undoStack.append(entry)
+        return True
+
+    def undo(self):
+        if not self.recorder == None or not self.undoStack:
+            return False
+
+        entry = self.undoStack.pop()
+        entry.apply("old")
+        self.redoStack.append(entry)
+        return True
+
+def _compress(arrays):
+    if arrays == None:
+        return b""
+    return zlib.compress(b"".join(array.tobytes() for array in arrays), 1)
+
+def _decompress(data, template):
+    # arrays shaped like the ones of template, an empty tile of the buffer; None for no tile
+    if not data:
+        return None
+    data = zlib.decompress(data)
+    arrays = []
+    offset = 0
+    for array in template:
+        arrays.append(np.frombuffer(data, dtype=array.dtype, count=array.size, offset=offset).reshape(array.shape).copy())
+        offset += array.nbytes
+    return tuple(arrays)
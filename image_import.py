@@ -0,0 +1,73 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageSequence
+
+import constants as const
+from animation import Animation
+from layers import Layer, LayerStack
+from pixel_buffer import PixelBuffer
+
+_executor = None   # single background worker, like the one of the export
+
+def import_image(path):
+    """
+    Animation with one frame per frame of a PNG or GIF file. Frames after the first are
+    frozen as soon as they are read, so identical tiles of an animated GIF are kept once.
+    """
+    animation = None
+    name = os.path.splitext(os.path.basename(path))[0]
+
+    for buffer in read_frames(path):
+        stack = LayerStack(buffer.width, buffer.height, [Layer(name, buffer)])
+        if animation == None:
+            animation = Animation([stack])
+        else:
+            animation.frames.append(stack)
+            animation.freeze(len(animation.frames) - 1)
+
+    return animation
+
+def import_image_async(path, callback=None):
+    """
+    import_image on a background thread. callback(animation, error) is called from the worker thread.
+    """
+    global _executor
+    if _executor == None:
+        _executor = ThreadPoolExecutor(max_workers=1)
+
+    future = _executor.submit(import_image, path)
+
+    if not callback == None:
+        def done(future):
+            error = future.exception()
+            callback(None if error else future.result(), error)
+        future.add_done_callback(done)
+
+    return future
+
+def read_frames(path, bandHeight=const.IMPORT_BAND_HEIGHT):
+    """
+    Yield every frame of an image file as a PixelBuffer, one at a time. Each frame is
+    converted to RGBA in bands of rows, so besides the decoded frame only one band is
+    held as RGBA, and only the tiles with content are created.
+    """
+    with Image.open(path) as image:
+        width, height = image.size
+        if not (0 < width <= const.CANVAS_SIZE_MAX and 0 < height <= const.CANVAS_SIZE_MAX):
+            raise ValueError(f"{path} is larger than {const.CANVAS_SIZE_MAX} x {const.CANVAS_SIZE_MAX}")
+
+        for frame in ImageSequence.Iterator(image):
+            buffer = PixelBuffer(width, height)
+
+            for y0 in range(0, height, bandHeight):
+                band = np.asarray(frame.crop((0, y0, width, min(y0 + bandHeight, height))).convert("RGBA"))
+                mask = band[:, :, 3] > 0
+                pixels = np.where(mask[:, :, None], band, 0).astype(np.uint8)   # empty pixels are all zeros
+                buffer.write_rect(0, y0, pixels, mask)
+
+            buffer.modifiedTiles.clear()
+            buffer.pop_dirty_rect()
+            buffer.pop_dirty_tiles()
+            yield buffer
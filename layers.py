@@ -0,0 +1,205 @@
+import numpy as np
+
+from pixel_buffer import PixelBuffer, Tile
+
+# blend functions on float color arrays in 0.0-1.0: backdrop, source -> blended source color
+BLEND_MODES = {
+    "normal":   lambda cb, cs: cs,
+    "multiply": lambda cb, cs: cb * cs,
+    "screen":   lambda cb, cs: cb + cs - cb * cs,
+    "add":      lambda cb, cs: np.minimum(cb + cs, 1.0),
+    "darken":   np.minimum,
+    "lighten":  np.maximum,
+}
+
+class Layer():
+    def __init__(self, name, buffer) -> None:
+        self.name = name
+        self.buffer = buffer
+        self.visible = True
+        self.opacity = 1.0          # 0.0-1.0
+        self.blendMode = "normal"   # a key of BLEND_MODES
+
+class LayerStack():
+    """
+    Layers from bottom to top with a cached composite of the visible ones.
+    Only tiles touched by an edit or by a layer change are composed again. The composite
+    of the layers below the active one is cached per tile as well, so an edit on the active
+    layer does not blend the layers underneath it again.
+    """
+    def __init__(self, width, height, layers=None) -> None:
+        self.width = width
+        self.height = height
+
+        self.layers = layers if layers else [Layer("Layer 1", PixelBuffer(width, height))]
+        self.activeIndex = len(self.layers) - 1
+        self.layerCount = len(self.layers)   # used for default names of new layers
+
+        self.reset_composite()
+
+    def active(self):
+        return self.layers[self.activeIndex]
+
+    def add_layer(self, buffer=None):
+        # new layer right above the active one, which becomes active
+        self.layerCount += 1
+        layer = Layer(f"Layer {self.layerCount}", self.active().buffer.new_like() if buffer == None else buffer)
+        self.layers.insert(self.activeIndex + 1, layer)
+        self.set_active(self.activeIndex + 1)
+        self.staleTiles.update(layer.buffer.tile_keys())
+        return layer
+
+    def compose_tile(self, key):
+        size = self.composite.tileSize
+
+        if not key in self.belowTiles:
+            below = None
+            for layer in self.layers[:self.activeIndex]:
+                below = self.blend_layer(below, layer, key)
+            self.belowTiles[key] = below
+
+        tile = self.belowTiles[key]
+        if not tile == None:
+            tile = Tile(size, tile.pixels.copy(), tile.mask.copy())
+        for layer in self.layers[self.activeIndex:]:
+            tile = self.blend_layer(tile, layer, key)
+
+        if tile == None or not tile.mask.any():
+            self.composite.tiles.pop(key, None)
+        else:
+            self.composite.tiles[key] = tile
+
+        x0, y0 = key[0] * size, key[1] * size
+        self.composite.mark_dirty(x0, y0, min(x0 + size, self.width), min(y0 + size, self.height))
+
+    def blend_layer(self, base, layer, key):
+        # blend the key tile of a layer onto the base tile (None when empty), returns the result
+        if not layer.visible or layer.opacity <= 0:
+            return base
+
+        tile = layer.buffer.get_tile(*key)
+        if tile == None:
+            return base
+
+        # read once, indexed tiles resolve them on every access
+        tilePixels, tileMask = tile.pixels, tile.mask
+        if not tileMask.any():
+            return base
+        size = tilePixels.shape[0]
+
+        opaque = layer.opacity >= 1 and np.all(tilePixels[:, :, 3][tileMask] == 255)
+        if base == None and opaque:
+            return Tile(size, tilePixels.copy(), tileMask.copy())
+        if base == None:
+            base = Tile(size)
+
+        if opaque and layer.blendMode == "normal":
+            # plain overwrite, the common case
+            return Tile(size, np.where(tileMask[:, :, None], tilePixels, base.pixels), tileMask | base.mask)
+
+        alphaB = base.pixels[:, :, 3] / 255 * base.mask
+        alphaS = tilePixels[:, :, 3] / 255 * tileMask * layer.opacity
+        colorB = base.pixels[:, :, :3] / 255
+        colorS = tilePixels[:, :, :3] / 255
+        blended = BLEND_MODES[layer.blendMode](colorB, colorS)
+
+        # source-over compositing with the blended color where both layers have coverage
+        alpha = alphaS + alphaB * (1 - alphaS)
+        color = ((alphaS * (1 - alphaB))[:, :, None] * colorS
+                 + (alphaS * alphaB)[:, :, None] * blended
+                 + ((1 - alphaS) * alphaB)[:, :, None] * colorB)
+        color /= np.where(alpha > 0, alpha, 1)[:, :, None]
+
+        pixels = np.empty_like(base.pixels)
+        pixels[:, :, :3] = np.rint(color * 255)
+        pixels[:, :, 3] = np.rint(alpha * 255)
+        mask = pixels[:, :, 3] > 0
+        pixels[~mask] = 0
+        return Tile(size, pixels, mask)
+
+    def invalidate(self, keys, index):
+        # the tiles changed in the layer at index
+        self.staleTiles.update(keys)
+        if index < self.activeIndex:
+            for key in keys:
+                self.belowTiles.pop(key, None)
+
+    def move_layer(self, index, newIndex):
+        if not 0 <= newIndex < len(self.layers) or index == newIndex:
+            return
+
+        layer = self.layers.pop(index)
+        self.layers.insert(newIndex, layer)
+        if self.activeIndex == index:
+            self.activeIndex = newIndex
+
+        self.belowTiles = {}
+        self.staleTiles.update(layer.buffer.tile_keys())
+        self.staleTiles.update(self.layers[index].buffer.tile_keys())
+
+    def remove_layer(self, index):
+        if len(self.layers) == 1:
+            return
+
+        layer = self.layers.pop(index)
+        self.activeIndex = min(self.activeIndex, len(self.layers) - 1)
+        self.belowTiles = {}
+        self.staleTiles.update(layer.buffer.tile_keys())
+
+    def reset_composite(self):
+        # drop the composite, every tile with content is composed again on the next update
+        self.composite = PixelBuffer(self.width, self.height)
+        self.belowTiles = {}       # (tx, ty) -> Tile or None, composite of layers[:activeIndex]
+        self.staleTiles = set()    # composite tiles that have to be composed again
+        for layer in self.layers:
+            self.staleTiles.update(layer.buffer.tile_keys())
+
+    def snapshot(self):
+        """
+        The composite as a buffer of its own, for reading it on another thread. Composed tiles
+        are replaced and never written in place, so the copy shares them.
+        """
+        self.update()
+        snapshot = self.composite.new_like()
+        snapshot.tiles = dict(self.composite.tiles)
+        return snapshot
+
+    def set_active(self, index):
+        if 0 <= index < len(self.layers) and not index == self.activeIndex:
+            self.activeIndex = index
+            self.belowTiles = {}
+
+    def set_blend_mode(self, index, blendMode):
+        self.layers[index].blendMode = blendMode
+        self.invalidate(self.layers[index].buffer.tile_keys(), index)
+
+    def set_opacity(self, index, opacity):
+        self.layers[index].opacity = min(max(opacity, 0.0), 1.0)
+        self.invalidate(self.layers[index].buffer.tile_keys(), index)
+
+    def set_visible(self, index, visible):
+        self.layers[index].visible = visible
+        self.invalidate(self.layers[index].buffer.tile_keys(), index)
+
+    def update(self, rect=None):
+        """
+        Compose the stale tiles again, only those inside rect (x0, y0, x1, y1) when given.
+        """
+        size = self.composite.tileSize
+
+        # edits since the last update, only the tiles the layers report as written
+        for index, layer in enumerate(self.layers):
+            keys = layer.buffer.pop_dirty_tiles()
+            if keys:
+                self.invalidate(keys, index)
+
+        if rect == None:
+            keys = self.staleTiles
+        else:
+            x0, y0, x1, y1 = rect
+            keys = [key for key in self.staleTiles if x0 // size <= key[0] <= (x1 - 1) // size
+                    and y0 // size <= key[1] <= (y1 - 1) // size]
+
+        for key in list(keys):
+            self.compose_tile(key)
+            self.staleTiles.discard(key)
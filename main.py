@@ -1,138 +1,165 @@
+import argparse
 import math
+import os
+import time
+
+startTime = time.perf_counter()   # before the imports below, for --startup-time
+
+import numpy as np
 import pyglet
 import pyglet.gl as gl
 
 import algorithms as algo
+import autosave
+import brush
 import constants as const
-import export as exp
 import palette_manager as palet
+import project as proj
+import selection as sel
+from animation import Animation
+from history import History
+from layers import BLEND_MODES, Layer, LayerStack
+from pixel_buffer import IndexedPixelBuffer, PixelBuffer
+from renderer import FrameTextures, IconAtlas, LayerTexture, PixelGrid
 
 class Artist():
     def __init__(self) -> None:
         self.primaryColor = (0, 0, 0, 255)
         self.secondaryColor = (255, 0, 0, 255)
         self.mode = "pencil"
+        self.brush = brush.Brush()   # stamp of the pencil and the eraser
         self.palette = palet.read_hex_to_rgb("./palette_default.hex")
 
 class Canvas():
-    def __init__(self, width, height) -> None:
+    def __init__(self, width, height, animation=None, palette=None) -> None:
         self.width = width
         self.height = height
         self.origin = [0, 0]
         self.backgroundColor = (255, 255, 255, 255)
 
-        self.pixelMatrix = []
-        self.pixelBatchMatrix = []
-        self.previewMatrix = []
-        self.previewBatchMatrix = []
+        # with a palette (indexed mode) the layers store palette indices instead of colors
+        self.palette = palette
+        if animation == None and not palette == None:
+            animation = Animation([LayerStack(width, height, [Layer("Layer 1", IndexedPixelBuffer(width, height, palette))])])
+        self.animation = Animation([LayerStack(width, height)]) if animation == None else animation
+        self.previewBuffer = PixelBuffer(width, height, trackTouched=True)
+        self.previewShape = None    # cells of the shape tool's shape in the preview, see show_shape
+        self.strokeCoverage = None  # brush.StrokeCoverage of the pencil or eraser stroke being drawn
 
         self.mousePos = [0, 0]      # mouse coordinates on canvas
         self.beginningPos = [0, 0]  # beginning coordinates of action
         self.endPos = [0, 0]        # end coordinates of action
 
         self.gridOn = False
+        self.gridTileSize = None    # size of the custom tile grid, None for only the pixel grid
 
-    def add_pixel(self, pos, color, matrix, batch):
-        if matrix == "pixel":
-            matrixPosY = len(self.pixelMatrix) - 1 - pos[1]
+        self.selection = None       # selection.Selection of the active layer, in buffer coordinates
+        self.floating = None        # selection.FloatingSelection being moved, drawn over the layers
 
-            if 0 <= matrixPosY < const.CANVAS_SIZE_Y and 0 <= pos[0] < const.CANVAS_SIZE_X:
-                self.add_pixel_to_batch((pos[0], matrixPosY), color, matrix, batch)
-                self.pixelMatrix[matrixPosY][pos[0]] = color
-        elif matrix == "preview":
-            matrixPosY = len(self.previewMatrix) - 1 - pos[1]
-
-            if 0 <= matrixPosY < const.CANVAS_SIZE_Y and 0 <= pos[0] < const.CANVAS_SIZE_X:
-                self.add_pixel_to_batch((pos[0], matrixPosY), color, matrix, batch)
-                self.previewMatrix[matrixPosY][pos[0]] = color
-
-    def add_pixel_to_batch(self, pos, color, matrix, batch):
-        x = pos[0] + self.origin[0]                              # convert pixel position to canvas position
-        y = (self.height - pos[1]) + self.origin[1]
+    def add_pixel(self, pos, color, matrix):
+        matrixPosY = self.height - 1 - pos[1]
 
         if matrix == "pixel":
-            if not self.pixelBatchMatrix[pos[1]][pos[0]] == None:                              
-                self.pixelBatchMatrix[pos[1]][pos[0]].delete()   # delete pixel from batch before replacing it                 
-            
-            self.pixelBatchMatrix[pos[1]][pos[0]] = batch.add(4, pyglet.gl.GL_QUADS, None,   # add a pixel to the batch
-                ('v2f', [x, 
-                        y - 1, 
-                        x + 1, 
-                        y - 1, 
-                        x + 1, 
-                        y, 
-                        x, 
-                        y]),
-                ('c4B', (color[0], color[1], color[2], color[3], 
-                        color[0], color[1], color[2], color[3], 
-                        color[0], color[1], color[2], color[3], 
-                        color[0], color[1], color[2], color[3])))
+            if self.pixelBuffer.contains(pos[0], matrixPosY):
+                self.pixelBuffer.set_pixel(pos[0], matrixPosY, color)
         elif matrix == "preview":
-            #color = (0, 255, 0, 0) # debug color for testing batch transfer
-            if not self.previewBatchMatrix[pos[1]][pos[0]] == None:                              
-                self.previewBatchMatrix[pos[1]][pos[0]].delete()   # delete pixel from batch before replacing it                 
-            
-            self.previewBatchMatrix[pos[1]][pos[0]] = batch.add(4, pyglet.gl.GL_QUADS, None,   # add a pixel to the batch
-                ('v2f', [x, 
-                        y - 1, 
-                        x + 1, 
-                        y - 1, 
-                        x + 1, 
-                        y, 
-                        x, 
-                        y]),
-                ('c4B', (color[0], color[1], color[2], color[3], 
-                        color[0], color[1], color[2], color[3], 
-                        color[0], color[1], color[2], color[3], 
-                        color[0], color[1], color[2], color[3])))
+            if self.previewBuffer.contains(pos[0], matrixPosY):
+                self.previewBuffer.set_pixel(pos[0], matrixPosY, color)
+
+    def add_spans(self, spans, color, matrix):
+        # spans are (y, x0, x1) in canvas coordinates, x1 exclusive
+        buffer = self.pixelBuffer if matrix == "pixel" else self.previewBuffer
+        buffer.fill_spans([(self.height - 1 - y, x0, x1) for y, x0, x1 in spans], color)
 
     def color_pick(self, pos, artist, button):
-        matrixPosY = len(self.pixelMatrix) - 1 - pos[1]
-        if not self.pixelMatrix[matrixPosY][pos[0]] == (-1, -1, -1, -1):
+        # pick the visible color, from the composite of all layers
+        matrixPosY = self.height - 1 - pos[1]
+        if not self.layers.composite.contains(pos[0], matrixPosY):
+            return
+        self.layers.update((pos[0], matrixPosY, pos[0] + 1, matrixPosY + 1))
+        color = self.layers.composite.get_pixel(pos[0], matrixPosY)
+        if not color == None:
             if button == 0:
-                artist.primaryColor = self.pixelMatrix[matrixPosY][pos[0]]
+                artist.primaryColor = color
             elif button == 1:
-                artist.secondaryColor = self.pixelMatrix[matrixPosY][pos[0]]
+                artist.secondaryColor = color
 
     def delete_pixel(self, pos):
-        matrixPosY = len(self.pixelMatrix) - 1 - pos[1]
+        matrixPosY = self.height - 1 - pos[1]
+
+        if self.pixelBuffer.contains(pos[0], matrixPosY):
+            self.pixelBuffer.delete_pixel(pos[0], matrixPosY)
+
+    def begin_stroke(self):
+        # a new pencil or eraser stroke, which may paint every cell again
+        self.strokeCoverage = brush.StrokeCoverage()
+
+    def brush_cells(self, path, stamp):
+        """
+        Cells under the stamp along a path of canvas points that the stroke has not painted
+        yet, as buffer (xs, ys) arrays.
+        """
+        cover = stamp.cover(path[:, 0], self.height - 1 - path[:, 1], self.width, self.height)
+        if cover == None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        block, x0, y0 = cover
+        if self.strokeCoverage == None:
+            self.begin_stroke()
+        ys, xs = np.nonzero(self.strokeCoverage.claim(block, x0, y0))
+        return xs + x0, ys + y0
 
-        if 0 <= matrixPosY < const.CANVAS_SIZE_Y and 0 <= pos[0] < const.CANVAS_SIZE_X:
-            if not self.pixelBatchMatrix[matrixPosY][pos[0]] == None:                              
-                self.pixelBatchMatrix[matrixPosY][pos[0]].delete()
-                self.pixelBatchMatrix[matrixPosY][pos[0]] = None
-                self.pixelMatrix[matrixPosY][pos[0]] = (-1, -1, -1, -1)
-
-    def draw_ellipse(self, color, batch):
-        pixels = algo.ellipse(self.beginningPos, self.endPos)
-        for pixel in pixels:
-            self.add_pixel(pixel, color, "preview", batch)
-
-    def draw_point(self, color, batch):
-        self.add_pixel(self.mousePos, color, "preview", batch)
-
-    def draw_line(self, color, batch):
-        pixels = algo.bresenham_line(self.beginningPos, self.endPos)
-        for pixel in pixels:
-            self.add_pixel(pixel, color, "preview", batch)
+    def clear_preview(self):
+        self.previewBuffer.clear()
+        self.previewShape = None
 
-    def draw_rectangle(self, color, batch):
-        pixels = algo.rectangle(self.beginningPos, self.endPos)
-        for pixel in pixels:
-            self.add_pixel(pixel, color, "preview", batch)
+    def draw_ellipse(self, color, filled=False):
+        if filled:
+            self.show_shape(color, spans=algo.filled_ellipse(self.beginningPos, self.endPos))
+        else:
+            self.show_shape(color, points=algo.ellipse(self.beginningPos, self.endPos))
 
-    def erase_point(self):
-        self.delete_pixel(self.mousePos)
+    def draw_point(self, color):
+        self.add_pixel(self.mousePos, color, "preview")
 
-    def erase_line(self):
-        pixels = algo.bresenham_line(self.beginningPos, self.endPos)
-        for pixel in pixels:
-            self.delete_pixel(pixel)
+    def draw_line(self, color):
+        self.show_shape(color, points=algo.bresenham_line(self.beginningPos, self.endPos))
 
-    def fill(self, color, batch):
-        pixels = algo.flood_fill(self.mousePos, self.pixelMatrix)
-        for pixel in pixels:
-            self.add_pixel(pixel, color, "pixel", batch)
+    def draw_rectangle(self, color, filled=False):
+        if filled:
+            self.show_shape(color, spans=algo.filled_rectangle(self.beginningPos, self.endPos))
+        else:
+            self.show_shape(color, points=algo.rectangle(self.beginningPos, self.endPos))
+
+    def draw_stroke(self, points, color, stamp):
+        # pencil: the stamp along lines from beginningPos through the points, the stroke continues from the last one
+        xs, ys = self.brush_cells(algo.polyline(self.beginningPos, points), stamp)
+        self.previewBuffer.set_pixels(xs, ys, color)
+        self.beginningPos[0], self.beginningPos[1] = points[-1]
+
+    def erase_stroke(self, points, stamp):
+        xs, ys = self.brush_cells(algo.polyline(self.beginningPos, points), stamp)
+        self.pixelBuffer.delete_pixels(xs, ys)
+        self.beginningPos[0], self.beginningPos[1] = points[-1]
+
+    def fill(self, color):
+        matrixPosY = self.height - 1 - self.mousePos[1]
+
+        if self.pixelBuffer.contains(self.mousePos[0], matrixPosY):
+            # cells with the same color (or emptiness) as the clicked cell
+            fillable = self.pixelBuffer.color_mask(self.pixelBuffer.get_pixel(self.mousePos[0], matrixPosY))
+            spans = algo.flood_fill((self.mousePos[0], matrixPosY), fillable)
+            self.pixelBuffer.fill_spans(spans, color)
+
+    @property
+    def layers(self):
+        # the layers of the current frame
+        return self.animation.current()
+
+    @property
+    def pixelBuffer(self):
+        # the buffer of the active layer, everything is drawn on it
+        return self.layers.active().buffer
 
     def is_mouse_on_canvas(self, x, y):
         wWd2, wHd2 = const.WINDOW_START_WIDTH/2, const.WINDOW_START_HEIGHT/2
@@ -140,8 +167,41 @@ class Canvas():
             return True
         return False
 
+    def show_shape(self, color, points=None, spans=None):
+        """
+        Show the shape of a shape tool in the preview in place of the previous one, given as
+        (n, 2) points or (y, x0, x1) spans. Only the cells it gained or lost are written.
+        """
+        buffer = self.previewBuffer
+        if not points is None:
+            xs, ys = buffer.clip(points[:, 0], self.height - 1 - points[:, 1])
+            shape = ("cells", np.unique(ys * self.width + xs))
+        else:
+            shape = ("spans", [(self.height - 1 - y, max(x0, 0), min(x1, self.width)) for y, x0, x1 in spans
+                               if 0 <= self.height - 1 - y < self.height and x0 < self.width and x1 > 0])
+
+        previous = self.previewShape
+        if previous == None or not previous[0] == shape[0]:
+            buffer.clear()
+            previous = (shape[0], np.zeros(0, dtype=np.int64) if shape[0] == "cells" else [])
+
+        if shape[0] == "cells":
+            ys, xs = np.divmod(np.setdiff1d(previous[1], shape[1], assume_unique=True), self.width)
+            buffer.write_cells(xs, ys, 0, False)
+            ys, xs = np.divmod(np.setdiff1d(shape[1], previous[1], assume_unique=True), self.width)
+            buffer.set_pixels(xs, ys, color)
+        else:
+            ys, xs = algo.span_cells(algo.subtract_spans(previous[1], shape[1]))
+            buffer.write_cells(xs, ys, 0, False)
+            buffer.fill_spans(algo.subtract_spans(shape[1], previous[1]), color)
+
+        # the cells of the previous shapes are empty again, only the current one stays touched
+        buffer.trim_touched()
+        self.previewShape = shape
+
     def update_background(self):
-        self.canvasBgImage = pyglet.image.SolidColorImagePattern(self.backgroundColor).create_image(self.width, self.height)
+        # a single pixel stretched over the canvas, so the background costs the same at any canvas size
+        self.canvasBgImage = pyglet.image.SolidColorImagePattern(self.backgroundColor).create_image(1, 1)
 
         # remove gl interpolation for sharp canvas edges when zoomed
         canvasBgTexture = self.canvasBgImage.get_texture()
@@ -149,58 +209,42 @@ class Canvas():
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_NEAREST)
 
         self.canvasBgSprite = pyglet.sprite.Sprite(self.canvasBgImage, x=self.origin[0], y=self.origin[1])
+        self.canvasBgSprite.update(scale_x=self.width, scale_y=self.height)
 
         self.background = self.canvasBgSprite
 
 class ModeButton():
-    def __init__(self, x, y, baseBatch, batch, index = 0):
+    MODES = ("pencil", "eraser", "dropper", "line", "select", "rectangle", "ellipse", "fill", "wand", "")
+
+    def __init__(self, x, y, baseBatch, batch, atlas, index = 0):
         self.x = 14 + x * 28
         self.y = 14 + y * 28
-        self.mode = ""
+        self.mode = self.MODES[index]
         self.index = index
         self.hover = False
         self.color = (120, 120, 120, 255)
 
-        self.image = pyglet.image.SolidColorImagePattern(self.color).create_image(24, 24)
-        self.sprite = pyglet.sprite.Sprite(self.image, x=self.x, y=self.y, batch=baseBatch)
-
-        if self.index == 0:
-            self.mode = "pencil"
-            img = pyglet.image.load('./icons/pencil.png')
-            self.icon = pyglet.sprite.Sprite(img, x=self.x+4, y=self.y+4, batch=batch)
-        elif self.index == 1:
-            self.mode = "eraser"
-            img = pyglet.image.load('./icons/eraser.png')
-            self.icon = pyglet.sprite.Sprite(img, x=self.x+4, y=self.y+4, batch=batch)
-        elif self.index == 2:
-            self.mode = "dropper"
-            img = pyglet.image.load('./icons/dropper.png')
-            self.icon = pyglet.sprite.Sprite(img, x=self.x+4, y=self.y+4, batch=batch)
-        elif self.index == 3:
-            self.mode = "line"
-            img = pyglet.image.load('./icons/line.png')
-            self.icon = pyglet.sprite.Sprite(img, x=self.x+4, y=self.y+4, batch=batch)
-        elif self.index == 5:
-            self.mode = "rectangle"
-            img = pyglet.image.load('./icons/rect.png')
-            self.icon = pyglet.sprite.Sprite(img, x=self.x+4, y=self.y+4, batch=batch)
-        elif self.index == 6:
-            self.mode = "ellipse"
-            img = pyglet.image.load('./icons/ellipse.png')
-            self.icon = pyglet.sprite.Sprite(img, x=self.x+4, y=self.y+4, batch=batch)
-        elif self.index == 7:
-            self.mode = "fill"
-            img = pyglet.image.load('./icons/paint-bucket.png')
-            self.icon = pyglet.sprite.Sprite(img, x=self.x+4, y=self.y+4, batch=batch)
+        # everything comes from the toolbar atlas, so the buttons draw from one texture
+        self.sprite = pyglet.sprite.Sprite(atlas.region("white", 24, 24), x=self.x, y=self.y, batch=baseBatch)
+        self.sprite.color = self.color[:3]
+
+        if self.mode:
+            self.icon = pyglet.sprite.Sprite(atlas.region(self.mode), x=self.x+4, y=self.y+4, batch=batch)
 
 class PaletteButton():
-    def __init__(self, x, y, color, batch):
+    def __init__(self, x, y, color, batch, atlas):
         self.x = x
         self.y = y
         self.color = color
 
-        self.image = pyglet.image.SolidColorImagePattern(self.color).create_image(16, 16)
-        self.sprite = pyglet.sprite.Sprite(self.image, x=x, y=y, batch=batch)
+        # a white region of the atlas tinted with the color
+        self.sprite = pyglet.sprite.Sprite(atlas.region("white", 16, 16), x=x, y=y, batch=batch)
+        self.set_color(color)
+
+    def set_color(self, color):
+        self.color = color
+        self.sprite.color = color[:3]
+        self.sprite.opacity = color[3]
 
 class Window(pyglet.window.Window):
     def __init__(self, width, height, canvas, artist, *args, **kwargs):
@@ -214,71 +258,100 @@ class Window(pyglet.window.Window):
 
         self.init_canvas(canvas)
 
-        self.pixelBatch = pyglet.graphics.Batch()
-        self.previewBatch = pyglet.graphics.Batch()
+        self.history = History(const.HISTORY_MEMORY_BUDGET)
+        self.projectPath = const.FILENAME_DEFAULT + const.PROJECT_EXTENSION
+        self.importPath = None   # image being imported
+
+        self.dragPoints = []        # canvas positions of the drag events not drawn yet
+        self.dragButton = None
+        self.dragModifiers = 0
+
+        self.playing = False
+        self.playbackIndex = 0
+        self.onionSkinOn = False
+
+        self.measureStartup = False   # print the time to the first frame and quit
+
+        # checkpoints of the unsaved work, the journal of the last session is kept for ctrl+R
+        journalPath = autosave.claim(const.AUTOSAVE_JOURNAL)   # its own one when several instances run
+        self.autosave = autosave.Autosave(journalPath)
+        self.recoveryPath = autosave.set_aside(journalPath)
+        self.autosave.track(self.canvas.animation)
+        pyglet.clock.schedule_interval(self.autosave_checkpoint, const.AUTOSAVE_INTERVAL)
+
+        self.clipboard = None       # selection.FloatingSelection copied or cut
+        self.selectionGrab = None   # cell of the floating selection the mouse holds while moving it
+
         self.topToolbarBatch = pyglet.graphics.Batch()
         self.topToolbarIconBatch = pyglet.graphics.Batch()
+        self.atlas = IconAtlas(const.ICON_PATHS, const.ICON_ATLAS_CACHE)
 
         self.modeButtons = []
         self.init_modebuttons()
 
-        # pixel cursor
+        # pixel cursor, moved and hidden instead of created again
         self.pixelCursorImage = pyglet.image.SolidColorImagePattern(
                     (0,0,0,96)).create_image(
                     1,
                     1)
-        self.pixelCursorSprite = None
+        self.pixelCursorSprite = pyglet.sprite.Sprite(self.pixelCursorImage)
+        self.pixelCursorSprite.visible = False
 
         # shadow for pressing mode buttons
-        self.buttonShadowImage = pyglet.image.SolidColorImagePattern((0, 0, 0, 96)).create_image(24, 24)
-        self.buttonShadowSprite = pyglet.sprite.Sprite(self.buttonShadowImage, x=14, y=42)
+        self.buttonShadowSprite = pyglet.sprite.Sprite(self.atlas.region("white", 24, 24), x=14, y=42)
+        self.buttonShadowSprite.color = (0, 0, 0)
+        self.buttonShadowSprite.opacity = 96
 
         # shadow for palette
-        self.paletteShadowImage = pyglet.image.SolidColorImagePattern((0, 0, 0, 96)).create_image(16, 16)
-        self.paletteShadowSprite = pyglet.sprite.Sprite(self.paletteShadowImage, x=0, y=100) 
-
-        for y in range(0, const.CANVAS_SIZE_Y):
-            self.canvas.pixelMatrix.append([])
-            self.canvas.pixelBatchMatrix.append([])
-            self.canvas.previewMatrix.append([])
-            self.canvas.previewBatchMatrix.append([])
-            for _ in range(0, const.CANVAS_SIZE_X):
-                self.canvas.pixelMatrix[y].append((-1, -1, -1, -1))
-                self.canvas.pixelBatchMatrix[y].append(None)
-                self.canvas.previewMatrix[y].append((-1, -1, -1, -1))
-                self.canvas.previewBatchMatrix[y].append(None)
+        self.paletteShadowSprite = pyglet.sprite.Sprite(self.atlas.region("white", 16, 16), x=0, y=100)
+        self.paletteShadowSprite.color = (0, 0, 0)
+        self.paletteShadowSprite.opacity = 96
 
         self.init_artist(artist)
         self.init_camera()
         self.init_toolbar_backgrounds()
         self.init_palette()
+        self.init_color_display()
         self.set_color_display()
         self.set_app_icon()
         self.set_window_background_color()
+        self.init_labels()
         self.update_zoom_percentage_label()
         self.update_canvas_size_label()
+        self.update_layer_label()
+        if not self.recoveryPath == None:
+            self.set_caption(f"{const.APP_NAME} - unsaved work of the last session found, ctrl+R restores it")
 
-    def apply_preview(self):
-        for y in range(len(self.canvas.previewMatrix)):
-            for x in range(len(self.canvas.previewMatrix[y])):
-                if not self.canvas.previewMatrix[y][x] == (-1, -1, -1, -1):
-                    self.canvas.pixelMatrix[y][x] = self.canvas.previewMatrix[y][x]
-                    self.canvas.previewMatrix[y][x] = (-1, -1, -1, -1)
+    def anchor_selection(self):
+        # drop the floating selection into the active layer, its cells stay selected
+        floating = self.canvas.floating
+        if floating == None:
+            return
 
-                    canvasY = len(self.canvas.previewMatrix[y]) - 1 - y
-                    self.canvas.add_pixel((x, canvasY), self.canvas.pixelMatrix[y][x], "pixel", self.pixelBatch)
-                    self.canvas.previewBatchMatrix[y][x].delete()
-                    self.canvas.previewBatchMatrix[y][x] = None
+        recording = not self.history.recorder == None
+        self.history.begin(self.canvas.pixelBuffer)
+        sel.anchor(self.canvas.pixelBuffer, floating)
+        if not recording:
+            self.history.end()
 
-    def clear_preview(self):
-        for y in range(len(self.canvas.previewMatrix)):
-            for x in range(len(self.canvas.previewMatrix[y])):
-                if not self.canvas.previewMatrix[y][x] == (-1, -1, -1, -1):
-                    self.canvas.previewMatrix[y][x] = (-1, -1, -1, -1)
+        self.canvas.selection = floating.selection()
+        self.set_floating(None)
 
-                    canvasY = len(self.canvas.previewMatrix[y]) - 1 - y
-                    self.canvas.previewBatchMatrix[y][x].delete()
-                    self.canvas.previewBatchMatrix[y][x] = None
+    def apply_preview(self):
+        self.history.begin(self.canvas.pixelBuffer)   # no-op during a stroke, ended on release
+        self.canvas.pixelBuffer.merge(self.canvas.previewBuffer)
+        self.canvas.clear_preview()
+
+    def autosave_checkpoint(self, dt=0):
+        # not during a stroke, its cells are taken once it is finished
+        if not self.history.recorder == None:
+            return
+        error = self.autosave.checkpoint(self.canvas.animation, self.projectPath)
+        if not error == None:
+            self.set_caption(f"{const.APP_NAME} - autosave failed: {error}")
+
+    def clear_preview(self):
+        self.canvas.clear_preview()
 
     def convert_mouse_to_canvas_coordinates(self, x, y):
         # position of the mouse relative to window (0.0-1.0)
@@ -295,6 +368,66 @@ class Window(pyglet.window.Window):
 
         return mouseCanvasX, mouseCanvasY
 
+    def flush_drag(self):
+        """
+        Draw the drag events collected since the last frame. Pencil and eraser strokes go
+        through every collected point, the shape tools only draw the newest shape.
+        """
+        if not self.dragPoints:
+            return
+
+        points, self.dragPoints = self.dragPoints, []
+        button, modifiers = self.dragButton, self.dragModifiers
+        canvas = self.canvas
+
+        color = None
+        if button == pyglet.window.mouse.LEFT:
+            color = self.artist.primaryColor
+        elif button == pyglet.window.mouse.RIGHT:
+            color = self.artist.secondaryColor
+
+        # drop the points on the cell the stroke or shape is already at. Strokes continue from
+        # beginningPos, the shape and selection tools anchor there and last reached endPos.
+        last = canvas.beginningPos if self.artist.mode in ("pencil", "eraser") else canvas.endPos
+        points = [point for i, point in enumerate(points)
+                  if not list(point) == (last if i == 0 else list(points[i - 1]))]
+        if not points:
+            return
+        if not self.artist.mode in ("pencil", "eraser"):
+            canvas.endPos[0], canvas.endPos[1] = points[-1]
+
+        # also drags that entered the canvas after a press outside of it are undone as one entry
+        self.history.begin(canvas.pixelBuffer)
+
+        if self.artist.mode == "pencil":
+            if not color == None:
+                canvas.draw_stroke(points, color, self.artist.brush)
+        elif self.artist.mode in ("select", "wand"):
+            if button == pyglet.window.mouse.LEFT:
+                self.drag_selection(points[-1])
+        elif self.artist.mode == "eraser":
+            if button == pyglet.window.mouse.LEFT:
+                canvas.erase_stroke(points, self.artist.brush)
+        elif not color == None:
+            filled = modifiers & pyglet.window.key.MOD_SHIFT   # hold shift for a filled shape
+            if self.artist.mode == "line":
+                canvas.draw_line(color)
+            elif self.artist.mode == "rectangle":
+                canvas.draw_rectangle(color, filled)
+            elif self.artist.mode == "ellipse":
+                canvas.draw_ellipse(color, filled)
+
+    def drag_selection(self, point):
+        # move the floating selection along, or stretch a new rectangle selection
+        canvas = self.canvas
+        x, y = point[0], canvas.height - 1 - point[1]
+
+        if not self.selectionGrab == None and not canvas.floating == None:
+            self.move_floating(x - self.selectionGrab[0], y - self.selectionGrab[1])
+        elif self.artist.mode == "select":
+            start = (canvas.beginningPos[0], canvas.height - 1 - canvas.beginningPos[1])
+            canvas.selection = sel.rectangle(canvas.pixelBuffer, start, (x, y))
+
     def draw_bottom_toolbar_background(self):
         # set gl stuff
         gl.glViewport(0, 0, self.width, 20)
@@ -307,8 +440,8 @@ class Window(pyglet.window.Window):
         # draw background
         self.bottomToolbarBgSprite.draw()
 
-    def draw_grid():
-        pass
+    def draw_grid(self):
+        self.pixelGrid.draw(self.zoomLevel, self.canvas.gridTileSize)
 
     def draw_main_area(self):
         # set gl stuff
@@ -325,8 +458,43 @@ class Window(pyglet.window.Window):
         # draw blank canvas
         self.canvas.background.draw()
 
-        self.pixelBatch.draw()
-        self.previewBatch.draw()
+        if self.playing:
+            self.frameTextures.draw(self.playbackIndex, self.left, self.right, self.bottom, self.top)
+            return
+
+        # neighbouring frames faded under the current one, earlier ones tinted red, later ones green
+        if self.onionSkinOn:
+            animation = self.canvas.animation
+            for offset in range(1, const.ONION_SKIN_FRAMES + 1):
+                for index, color in ((animation.currentIndex - offset, (255, 128, 128)),
+                                     (animation.currentIndex + offset, (128, 255, 128))):
+                    if 0 <= index < len(animation.frames):
+                        self.frameTextures.build(animation, index)
+                        self.frameTextures.draw(index, self.left, self.right, self.bottom, self.top,
+                                                const.ONION_SKIN_OPACITY // offset, color)
+
+        # compose the changed tiles of the visible part of the canvas
+        x0, x1, y0, y1 = self.pixelTexture.visible_rect(self.left, self.right, self.bottom, self.top)
+        if x0 < x1 and y0 < y1:
+            self.canvas.layers.update((x0, y0, x1, y1))
+
+        self.pixelTexture.draw(self.left, self.right, self.bottom, self.top)
+        self.previewTexture.draw(self.left, self.right, self.bottom, self.top)
+        if not self.floatingTexture == None:
+            self.floatingTexture.draw(self.left, self.right, self.bottom, self.top)
+
+    def draw_selection(self):
+        # outline of the selected rectangle, or of the floating one
+        canvas = self.canvas
+        owner = canvas.selection if canvas.floating == None else canvas.floating
+        if owner == None:
+            return
+
+        x0, y0, x1, y1 = owner.rect
+        left, right = canvas.origin[0] + x0, canvas.origin[0] + x1
+        bottom, top = canvas.origin[1] + canvas.height - y1, canvas.origin[1] + canvas.height - y0
+        pyglet.graphics.draw(4, gl.GL_LINE_LOOP, ("v2f", (left, bottom, right, bottom, right, top, left, top)),
+                             ("c4B", const.SELECTION_COLOR * 4))
 
     def draw_top_toolbar_background(self):
         # set gl stuff
@@ -344,6 +512,141 @@ class Window(pyglet.window.Window):
         self.topToolbarBatch.draw()
         self.topToolbarIconBatch.draw()
 
+    def edit_layers(self, symbol, modifiers):
+        self.anchor_selection()
+        layers = self.canvas.layers
+        index = layers.activeIndex
+        shift = modifiers & pyglet.window.key.MOD_SHIFT
+
+        if symbol == pyglet.window.key.L:   # add a layer, remove the active one with shift
+            if shift:
+                layers.remove_layer(index)
+            else:
+                layers.add_layer()
+        elif symbol in (pyglet.window.key.PAGEUP, pyglet.window.key.PAGEDOWN):   # select, move with shift
+            step = 1 if symbol == pyglet.window.key.PAGEUP else -1
+            if shift:
+                layers.move_layer(index, index + step)
+            else:
+                layers.set_active(index + step)
+        elif symbol == pyglet.window.key.H:
+            layers.set_visible(index, not layers.active().visible)
+        elif symbol == pyglet.window.key.B:   # cycle through the blend modes
+            modes = list(BLEND_MODES)
+            layers.set_blend_mode(index, modes[(modes.index(layers.active().blendMode) + 1) % len(modes)])
+        elif symbol == pyglet.window.key.BRACKETLEFT:
+            layers.set_opacity(index, round(layers.active().opacity - 0.1, 1))
+        elif symbol == pyglet.window.key.BRACKETRIGHT:
+            layers.set_opacity(index, round(layers.active().opacity + 0.1, 1))
+
+        self.update_layer_label()
+
+    def export_finished(self, path, error):
+        # called from the export thread, hand the result over to the event loop
+        pyglet.app.platform_event_loop.post_event(self, "on_export_done", path, error)
+
+    def edit_brush(self, symbol):
+        # [ and ] change the size, B cycles through the shapes. The custom one is the copied selection.
+        stamp = self.artist.brush
+        if symbol == pyglet.window.key.BRACKETLEFT:
+            self.artist.brush = stamp.resized(stamp.size - 1)
+        elif symbol == pyglet.window.key.BRACKETRIGHT:
+            self.artist.brush = stamp.resized(stamp.size + 1)
+        else:
+            shapes = brush.SHAPES if not self.clipboard == None else brush.SHAPES[:-1]
+            shape = shapes[(shapes.index(stamp.shape) + 1) % len(shapes)] if stamp.shape in shapes else shapes[0]
+            if shape == "custom":
+                self.artist.brush = brush.Brush("custom", max(self.clipboard.mask.shape), self.clipboard.mask)
+            else:
+                self.artist.brush = brush.Brush(shape, stamp.size if not stamp.shape == "custom" else 1)
+        self.update_layer_label()
+
+    def edit_frames(self, symbol, modifiers):
+        animation = self.canvas.animation
+        self.anchor_selection()
+
+        if symbol == pyglet.window.key.F:   # add a copy of the current frame, remove it with shift
+            self.history.end()
+            if modifiers & pyglet.window.key.MOD_SHIFT:
+                animation.remove_frame(animation.currentIndex)
+            else:
+                animation.add_frame()
+            self.frameTextures.invalidate()
+            self.set_frame(animation.currentIndex)
+        elif symbol == pyglet.window.key.COMMA:
+            self.set_frame(animation.currentIndex - 1)
+        elif symbol == pyglet.window.key.PERIOD:
+            self.set_frame(animation.currentIndex + 1)
+
+    def edit_selection(self, symbol, modifiers):
+        """
+        Copy, cut, paste, delete, flip and rotate the selection. Flips and rotations lift
+        the selected cells out of the layer first, they are dropped back in with enter.
+        """
+        canvas = self.canvas
+        buffer = canvas.pixelBuffer
+        key = pyglet.window.key
+        recording = not self.history.recorder == None
+        self.history.begin(buffer)
+
+        if symbol == key.A:   # select all
+            self.anchor_selection()
+            canvas.selection = sel.Selection((0, 0, canvas.width, canvas.height))
+        elif symbol in (key.C, key.X) and not canvas.floating == None:
+            floating = canvas.floating
+            self.clipboard = sel.FloatingSelection(floating.pixels, floating.mask, floating.x, floating.y)
+            if symbol == key.X:   # its cells left the layer when it was lifted
+                self.set_floating(None)
+        elif symbol == key.C and not canvas.selection == None:
+            self.clipboard = sel.copy(buffer, canvas.selection)
+        elif symbol == key.X and not canvas.selection == None:
+            self.clipboard = sel.cut(buffer, canvas.selection)
+        elif symbol == key.V and modifiers & key.MOD_ACCEL and not self.clipboard == None:
+            self.anchor_selection()
+            clip = self.clipboard
+            self.set_floating(sel.FloatingSelection(clip.pixels, clip.mask, clip.x, clip.y))
+            canvas.selection = None
+            self.artist.mode = "select"
+        elif symbol == key.DELETE:
+            if canvas.floating == None and not canvas.selection == None:
+                sel.delete(buffer, canvas.selection)
+            self.set_floating(None)
+        elif symbol in (key.ENTER, key.RETURN, key.ESCAPE):   # escape also drops the selection
+            self.anchor_selection()
+            if symbol == key.ESCAPE:
+                canvas.selection = None
+        elif symbol in (key.H, key.V, key.R) and not modifiers & key.MOD_ACCEL:   # ctrl+V with nothing copied does nothing
+            self.lift_selection()
+            floating = canvas.floating
+            if not floating == None:
+                if symbol == key.H:
+                    floating.flip(1)
+                elif symbol == key.V:
+                    floating.flip(0)
+                else:   # clockwise, counterclockwise with shift
+                    floating.rotate(-1 if modifiers & key.MOD_SHIFT else 1)
+                self.set_floating(floating)
+
+        if not recording:
+            self.history.end()
+
+    def floating_position(self):
+        # world position of the bottom left corner of the floating selection
+        canvas = self.canvas
+        floating = canvas.floating
+        return canvas.origin[0] + floating.x, canvas.origin[1] + canvas.height - floating.y - floating.buffer.height
+
+    def import_finished(self, animation, error):
+        # called from the import thread, hand the result over to the event loop
+        pyglet.app.platform_event_loop.post_event(self, "on_import_done", animation, error)
+
+    def import_image(self, path):
+        # decoding happens in the background, the canvas is replaced once it is done
+        self.set_caption(f"{const.APP_NAME} - importing {os.path.basename(path)}...")
+        self.importPath = path
+        import image_import as imp   # imports PIL, which is not needed until then
+        imp.import_image_async(path, self.import_finished)
+
     def init_artist(self, artist):
         self.artist = artist
 
@@ -359,18 +662,48 @@ class Window(pyglet.window.Window):
     def init_canvas(self, canvas):
         self.canvas = canvas
 
-        self.canvas.origin[0] = self.width/2 - self.canvas.width/2
-        self.canvas.origin[1] = self.height/2 - self.canvas.height/2
+        # the canvas is centered on the middle of the window at its start size
+        self.canvas.origin[0] = const.WINDOW_START_WIDTH/2 - self.canvas.width/2
+        self.canvas.origin[1] = const.WINDOW_START_HEIGHT/2 - self.canvas.height/2
+
+        # allow zooming out until the whole canvas fits in the window
+        fit = max(self.canvas.width/const.WINDOW_START_WIDTH, self.canvas.height/const.WINDOW_START_HEIGHT)
+        self.zoomLimitHigh = max(const.ZOOM_LIMIT_HIGH, 2 ** math.ceil(math.log2(fit)))
 
         self.canvas.update_background()
 
+        self.pixelTexture = LayerTexture(self.canvas.layers.composite, self.canvas.origin[0], self.canvas.origin[1])
+        self.frameTextures = FrameTextures(self.canvas.origin[0], self.canvas.origin[1])
+        self.previewTexture = LayerTexture(self.canvas.previewBuffer, self.canvas.origin[0], self.canvas.origin[1])
+        self.pixelGrid = PixelGrid(self.canvas.origin[0], self.canvas.origin[1], self.canvas.width, self.canvas.height)
+        self.floatingTexture = None
+
+    def init_color_display(self):
+        # white squares tinted with the colors, so changing a color creates nothing new
+        self.paletteLeftColorSprite = pyglet.sprite.Sprite(self.atlas.region("white", 24, 24), x = 180, y = 22)
+        self.paletteRightColorSprite = pyglet.sprite.Sprite(self.atlas.region("white", 24, 24), x = 180 + 38, y = 22)
+
+    def init_labels(self):
+        # bottom toolbar labels, their text is changed in place by the update_*_label methods
+        def label(x, anchor_x):
+            return pyglet.text.Label("",
+                font_name=const.FONT_NAME,
+                font_size=const.FONT_SIZE,
+                x=x, y=0,
+                anchor_x=anchor_x, anchor_y='bottom', bold=const.FONT_BOLD)
+
+        self.zoomLabel = label(4, 'left')
+        self.layerLabel = label(64, 'left')
+        self.positionLabel = label(self.width/2, 'center')
+        self.sizeLabel = label(self.width-4, 'right')
+
     def init_modebuttons(self):
         cut = 5
         for i in range(0, 10):
             if i < cut:
-                self.modeButtons.append(ModeButton(i, 1, self.topToolbarBatch, self.topToolbarIconBatch, i))
+                self.modeButtons.append(ModeButton(i, 1, self.topToolbarBatch, self.topToolbarIconBatch, self.atlas, i))
             else:
-                self.modeButtons.append(ModeButton(i-cut, 0, self.topToolbarBatch, self.topToolbarIconBatch, i))
+                self.modeButtons.append(ModeButton(i-cut, 0, self.topToolbarBatch, self.topToolbarIconBatch, self.atlas, i))
 
     def init_palette(self):
         x, y = 180, 0
@@ -408,7 +741,7 @@ class Window(pyglet.window.Window):
                     xx = x + 92 + (index-2*cut)*16 + (index-2*cut)*4
                     yy = y + 12
 
-            self.paletteColors.append(PaletteButton(xx, yy, self.artist.palette[index], self.topToolbarBatch))
+            self.paletteColors.append(PaletteButton(xx, yy, self.artist.palette[index], self.topToolbarBatch, self.atlas))
 
 
     def init_toolbar_backgrounds(self):
@@ -424,18 +757,42 @@ class Window(pyglet.window.Window):
             self.width, const.WINDOW_BOTTOM_TOOLBAR_HEIGHT)
         self.bottomToolbarBgSprite = pyglet.sprite.Sprite(self.bottomToolbarBgImage, x=0, y=0)
 
+    def lift_selection(self):
+        # cut the selected cells out of the active layer into a floating selection
+        canvas = self.canvas
+        if not canvas.floating == None or canvas.selection == None:
+            return
+
+        recording = not self.history.recorder == None
+        self.history.begin(canvas.pixelBuffer)
+        self.set_floating(sel.cut(canvas.pixelBuffer, canvas.selection))
+        if not recording:
+            self.history.end()
+        canvas.selection = None
+
+    def move_floating(self, x, y):
+        # only the sprites of the floating selection move, nothing is composed or uploaded
+        floating = self.canvas.floating
+        if (floating.x, floating.y) == (x, y):
+            return
+        floating.x, floating.y = x, y
+        self.floatingTexture.move(*self.floating_position())
+
     def on_draw(self):
+        self.flush_drag()
         self.draw_main_area()
 
-        if not self.pixelCursorSprite == None:
+        if self.pixelCursorSprite.visible:
             self.pixelCursorSprite.draw()
 
-        if self.canvas.gridOn and self.zoomLevel < 0.5:
+        if self.canvas.gridOn:
             self.draw_grid()
+        self.draw_selection()
 
         self.draw_bottom_toolbar_background()
         self.zoomLabel.draw()
         self.sizeLabel.draw()
+        self.layerLabel.draw()
         if self.canvas.is_mouse_on_canvas(self.mousePos[0], self.mousePos[1]):
             self.positionLabel.draw()
 
@@ -445,66 +802,141 @@ class Window(pyglet.window.Window):
         self.paletteRightColorSprite.draw()
         self.buttonShadowSprite.draw()
         self.paletteShadowSprite.draw()
-        
+
+        # nothing is drawn again until something marks the window invalid
+        self.invalid = False
+
+        if self.measureStartup:
+            gl.glFinish()
+            print(f"startup: {(time.perf_counter() - startTime) * 1000:.1f} ms to the first frame", flush=True)
+            pyglet.app.exit()
+
+    def on_export_done(self, path, error):
+        if error == None:
+            if isinstance(path, list):   # full export
+                path = f"{path[0]} and {len(path) - 1} more"
+            self.set_caption(f"{const.APP_NAME} - exported {path}")
+        else:
+            self.set_caption(f"{const.APP_NAME} - export failed: {error}")
+
+    def on_file_drop(self, x, y, paths):
+        path = paths[0]
+        if path.lower().endswith(const.PROJECT_EXTENSION):
+            self.open_project(path)
+        else:
+            self.import_image(path)
+
+    def on_import_done(self, animation, error):
+        if not error == None:
+            self.set_caption(f"{const.APP_NAME} - import failed: {error}")
+            return
+
+        if self.playing:
+            self.toggle_playback()
+
+        proj.close_projects(self.canvas.animation.frames)
+        self.init_canvas(Canvas(animation.current().width, animation.current().height, animation))
+        self.invalid = True
+        self.history = History(const.HISTORY_MEMORY_BUDGET)
+        self.autosave.reset(self.canvas.animation)
+        # saving writes a project next to the image instead of overwriting it
+        self.projectPath = os.path.splitext(self.importPath)[0] + const.PROJECT_EXTENSION
+
+        self.update_canvas_size_label()
+        self.update_layer_label()
+        self.set_caption(f"{const.APP_NAME} - {os.path.basename(self.importPath)}")
 
     def on_key_press(self, symbol, modifiers):
+        self.invalid = True
         if symbol == pyglet.window.key._0:   # debug export
-            exp.export_image(self.canvas.pixelMatrix, const.CANVAS_SIZE_X, const.CANVAS_SIZE_Y)
+            import export as exp   # imports PIL, which is not needed until then
+            self.set_caption(f"{const.APP_NAME} - exporting...")
+            pixels = self.canvas.layers.snapshot()   # read on the export thread
+            if modifiers & pyglet.window.key.MOD_SHIFT:   # full export: PNG, indexed PNG, GIF and upscales
+                level = const.EXPORT_COMPRESS_LEVEL
+                targets = [exp.ExportTarget(compressLevel=level), exp.ExportTarget(indexed=True, compressLevel=level),
+                           exp.ExportTarget("GIF")]
+                targets += [exp.ExportTarget(scale=scale, compressLevel=level) for scale in const.EXPORT_SCALES]
+                exp.export_targets_async(pixels, targets, self.artist.palette, self.export_finished)
+            else:
+                exp.export_image_async(pixels, self.canvas.width, self.canvas.height, self.export_finished)
+        elif symbol == pyglet.window.key.S and modifiers & pyglet.window.key.MOD_ACCEL:
+            self.save_project()
+        elif symbol == pyglet.window.key.R and modifiers & pyglet.window.key.MOD_ACCEL:
+            if not self.recoveryPath == None:
+                self.restore_autosave()
+        elif symbol == pyglet.window.key.O and modifiers & pyglet.window.key.MOD_ACCEL:
+            if os.path.exists(self.projectPath):   # reopen the project from disk
+                self.open_project(self.projectPath)
+        elif symbol == pyglet.window.key.Z and modifiers & pyglet.window.key.MOD_ACCEL:
+            self.set_floating(None)   # the lift or paste is undone with it
+            self.canvas.selection = None
+            if modifiers & pyglet.window.key.MOD_SHIFT:
+                self.history.redo()
+            else:
+                self.history.undo()
+            self.frameTextures.invalidate()   # the stroke may have been on another frame
+        elif symbol == pyglet.window.key.Y and modifiers & pyglet.window.key.MOD_ACCEL:
+            self.set_floating(None)
+            self.canvas.selection = None
+            self.history.redo()
+            self.frameTextures.invalidate()
+        elif symbol == pyglet.window.key.SPACE:
+            self.toggle_playback()
+        elif symbol == pyglet.window.key.O:
+            self.onionSkinOn = not self.onionSkinOn
+        elif symbol in (pyglet.window.key.BRACKETLEFT, pyglet.window.key.BRACKETRIGHT, pyglet.window.key.B) \
+        and not modifiers & pyglet.window.key.MOD_ACCEL:
+            self.edit_brush(symbol)
+        elif symbol == pyglet.window.key.G:
+            self.toggle_grid(modifiers & pyglet.window.key.MOD_SHIFT)
+        elif symbol in (pyglet.window.key.DELETE, pyglet.window.key.ENTER, pyglet.window.key.RETURN, pyglet.window.key.ESCAPE) \
+        or modifiers & pyglet.window.key.MOD_ACCEL and symbol in (pyglet.window.key.A, pyglet.window.key.C,
+                                                                  pyglet.window.key.X, pyglet.window.key.V) \
+        or not modifiers & pyglet.window.key.MOD_ACCEL and symbol in (pyglet.window.key.H, pyglet.window.key.V,
+                                                                      pyglet.window.key.R):
+            self.edit_selection(symbol, modifiers)
+        elif symbol in (pyglet.window.key.COMMA, pyglet.window.key.PERIOD) \
+        or symbol == pyglet.window.key.F and modifiers & pyglet.window.key.MOD_ACCEL:
+            self.edit_frames(symbol, modifiers)
+        elif symbol in (pyglet.window.key.PAGEUP, pyglet.window.key.PAGEDOWN) \
+        or modifiers & pyglet.window.key.MOD_ACCEL and symbol in (pyglet.window.key.L, pyglet.window.key.H,
+                                                                  pyglet.window.key.B, pyglet.window.key.BRACKETLEFT,
+                                                                  pyglet.window.key.BRACKETRIGHT):
+            self.edit_layers(symbol, modifiers)
 
     def on_mouse_drag(self, x, y, dx, dy, button, modifiers):
+        self.invalid = True
         self.set_mouse_coordinates(x, y)
         self.update_pixel_cursor_position()
-        self.canvas.endPos[0], self.canvas.endPos[1] = self.convert_mouse_to_canvas_coordinates(x, y)
-
-        if abs(self.canvas.endPos[0] - self.canvas.beginningPos[0]) > 0 \
-        or abs(self.canvas.endPos[1] - self.canvas.beginningPos[1]) > 0:
-            if self.artist.mode == "pencil":
-                if button == pyglet.window.mouse.LEFT:
-                    self.canvas.draw_line(self.artist.primaryColor, self.previewBatch)
-                elif button == pyglet.window.mouse.RIGHT:
-                    self.canvas.draw_line(self.artist.secondaryColor, self.previewBatch)
-                self.canvas.beginningPos[0], self.canvas.beginningPos[1] = self.canvas.endPos[0], self.canvas.endPos[1]
-            elif self.artist.mode == "eraser":
-                if button == pyglet.window.mouse.LEFT:
-                    self.canvas.erase_line()
-                self.canvas.beginningPos[0], self.canvas.beginningPos[1] = self.canvas.endPos[0], self.canvas.endPos[1]
-            elif self.artist.mode == "line":
-                self.clear_preview()
-                if button == pyglet.window.mouse.LEFT:
-                    self.canvas.draw_line(self.artist.primaryColor, self.previewBatch)
-                elif button == pyglet.window.mouse.RIGHT:
-                    self.canvas.draw_line(self.artist.secondaryColor, self.previewBatch)
-            elif self.artist.mode == "rectangle":
-                self.clear_preview()
-                if button == pyglet.window.mouse.LEFT:
-                    self.canvas.draw_rectangle(self.artist.primaryColor, self.previewBatch)
-                elif button == pyglet.window.mouse.RIGHT:
-                    self.canvas.draw_rectangle(self.artist.secondaryColor, self.previewBatch)
-            elif self.artist.mode == "ellipse":
-                self.clear_preview()
-                if button == pyglet.window.mouse.LEFT:
-                    self.canvas.draw_ellipse(self.artist.primaryColor, self.previewBatch)
-                elif button == pyglet.window.mouse.RIGHT:
-                    self.canvas.draw_ellipse(self.artist.secondaryColor, self.previewBatch)
+
+        # only collected here, flush_drag draws them once per frame
+        self.dragButton, self.dragModifiers = button, modifiers
+        self.dragPoints.append(self.convert_mouse_to_canvas_coordinates(x, y))
 
     def on_mouse_press(self, x, y, button, modifiers):
+        self.invalid = True
         self.set_mouse_coordinates(x, y)
         if 48 < y < self.height - 80:   # inside main area
             if self.canvas.is_mouse_on_canvas(self.mousePos[0], self.mousePos[1]):   # inside canvas
+                self.history.begin(self.canvas.pixelBuffer)   # record everything this stroke changes
                 self.canvas.beginningPos[0], self.canvas.beginningPos[1] = self.canvas.mousePos[0], self.canvas.mousePos[1]
+                self.canvas.endPos[0], self.canvas.endPos[1] = self.canvas.mousePos[0], self.canvas.mousePos[1]
                 if self.artist.mode == "pencil":
+                    self.canvas.begin_stroke()
                     if button == pyglet.window.mouse.LEFT:
-                        self.canvas.draw_point(self.artist.primaryColor, self.previewBatch)
+                        self.canvas.draw_stroke([self.canvas.mousePos], self.artist.primaryColor, self.artist.brush)
                     elif button == pyglet.window.mouse.RIGHT:
-                        self.canvas.draw_point(self.artist.secondaryColor, self.previewBatch)
+                        self.canvas.draw_stroke([self.canvas.mousePos], self.artist.secondaryColor, self.artist.brush)
                 elif self.artist.mode == "eraser":
+                    self.canvas.begin_stroke()
                     if button == pyglet.window.mouse.LEFT:
-                        self.canvas.erase_point()
+                        self.canvas.erase_stroke([self.canvas.mousePos], self.artist.brush)
                 elif self.artist.mode == "line":
                     if button == pyglet.window.mouse.LEFT:
-                        self.canvas.draw_point(self.artist.primaryColor, self.previewBatch)
+                        self.canvas.draw_point(self.artist.primaryColor)
                     elif button == pyglet.window.mouse.RIGHT:
-                        self.canvas.draw_point(self.artist.secondaryColor, self.previewBatch)
+                        self.canvas.draw_point(self.artist.secondaryColor)
                 elif self.artist.mode == "dropper":
                     if button == pyglet.window.mouse.LEFT:
                         self.canvas.color_pick(self.canvas.mousePos, self.artist, 0)
@@ -513,20 +945,25 @@ class Window(pyglet.window.Window):
                     self.set_color_display()
                 elif self.artist.mode == "rectangle":
                     if button == pyglet.window.mouse.LEFT:
-                        self.canvas.draw_point(self.artist.primaryColor, self.previewBatch)
+                        self.canvas.draw_point(self.artist.primaryColor)
                     elif button == pyglet.window.mouse.RIGHT:
-                        self.canvas.draw_point(self.artist.secondaryColor, self.previewBatch)
+                        self.canvas.draw_point(self.artist.secondaryColor)
                 elif self.artist.mode == "fill":
                     if button == pyglet.window.mouse.LEFT:
-                        self.canvas.fill(self.artist.primaryColor, self.pixelBatch)
+                        self.canvas.fill(self.artist.primaryColor)
                     elif button == pyglet.window.mouse.RIGHT:
-                        self.canvas.fill(self.artist.secondaryColor, self.pixelBatch)
+                        self.canvas.fill(self.artist.secondaryColor)
+                elif self.artist.mode in ("select", "wand"):
+                    if button == pyglet.window.mouse.LEFT:
+                        self.press_selection()
         else:
             if y > self.height - 80:   # inside top toolbar
                 found = False
-                for box in self.paletteColors:
+                for index, box in enumerate(self.paletteColors):
                     if box.x < x < box.x + 16 and self.height - 80 + box.y < y < self.height - 80 + box.y + 16:
-                        if button == pyglet.window.mouse.LEFT:
+                        if button == pyglet.window.mouse.LEFT and modifiers & pyglet.window.key.MOD_ACCEL:
+                            self.set_palette_color(index, self.artist.primaryColor)   # ctrl+click: edit the entry
+                        elif button == pyglet.window.mouse.LEFT:
                             self.artist.primaryColor = box.color
                         elif button == pyglet.window.mouse.RIGHT:
                             self.artist.secondaryColor = box.color
@@ -541,6 +978,9 @@ class Window(pyglet.window.Window):
                 if found == False:
                     for box in self.modeButtons:
                         if box.x < x < box.x + 24 and self.height - 80 + box.y < y < self.height - 80 + box.y + 24:
+                            if not box.mode in ("select", "wand"):
+                                self.anchor_selection()
+                                self.canvas.selection = None
                             self.artist.mode = box.mode
 
                             # draw shadow on clicked item
@@ -550,27 +990,85 @@ class Window(pyglet.window.Window):
                             found = True
                             break
 
+    def on_close(self):
+        # the unsaved work is in the journal before the window goes, it is offered again on the next launch
+        self.autosave.close(self.canvas.animation, self.projectPath)
+        super().on_close()
+
+    def on_expose(self):
+        self.invalid = True
+
     def on_mouse_motion(self, x, y, dx, dy):
         self.set_mouse_coordinates(x, y)
-        self.update_pixel_cursor_position()
+
+        # only redraw when the cursor moved to another cell or left or entered the canvas
+        if self.update_pixel_cursor_position():
+            self.invalid = True
         if self.canvas.is_mouse_on_canvas(self.mousePos[0], self.mousePos[1]):
             self.update_coordinates_label()
 
     def on_mouse_release(self, x, y, button, modifiers):
+        self.invalid = True
+
         # apply preview layer to image layer
+        self.flush_drag()
         self.apply_preview()
+        self.history.end()
+        self.canvas.strokeCoverage = None   # the next stroke starts over, also when it starts off the canvas
 
         # remove shadow from palette item
         self.paletteShadowSprite.x = 0
         self.paletteShadowSprite.y = 100
 
     def on_mouse_scroll(self, x, y, dx, dy):
+        self.invalid = True
         self.zoom(x, y, dy)
         self.update_zoom_percentage_label()
 
     def on_resize(self, width, height):
+        self.invalid = True
         self.resize_content(width, height)
     
+    def open_project(self, path):
+        if self.playing:
+            self.toggle_playback()
+
+        try:
+            frames = proj.open_project(path)
+        except (OSError, ValueError) as error:
+            self.set_caption(f"{const.APP_NAME} - opening failed: {error}")
+            return
+        proj.close_projects(self.canvas.animation.frames)   # also when the same file was opened again
+        self.init_canvas(Canvas(frames[0].width, frames[0].height, Animation(frames)))
+        self.history = History(const.HISTORY_MEMORY_BUDGET)
+        self.autosave.reset(self.canvas.animation)
+        self.projectPath = path
+
+        self.update_canvas_size_label()
+        self.update_layer_label()
+        self.set_caption(f"{const.APP_NAME} - {os.path.basename(path)}")
+
+    def press_selection(self):
+        """
+        Pressing inside the selection lifts it and starts moving it, pressing outside drops
+        it and starts a new selection: a rectangle, or the wand's area of one color.
+        """
+        canvas = self.canvas
+        x, y = canvas.mousePos[0], canvas.height - 1 - canvas.mousePos[1]
+        owner = canvas.selection if canvas.floating == None else canvas.floating
+
+        self.selectionGrab = None
+        if self.artist.mode == "select" and not owner == None and owner.contains(x, y):
+            self.lift_selection()
+            self.selectionGrab = (x - canvas.floating.x, y - canvas.floating.y)
+            return
+
+        self.anchor_selection()
+        if self.artist.mode == "wand":
+            canvas.selection = sel.magic_wand(canvas.pixelBuffer, x, y)
+        else:
+            canvas.selection = sel.rectangle(canvas.pixelBuffer, (x, y), (x, y))
+
     def resize_content(self, width, height):
         fx = width/self.lastWidth
         fy = height/self.lastHeight
@@ -595,23 +1093,87 @@ class Window(pyglet.window.Window):
 
         # resize toolbars to match new window size
         self.init_toolbar_backgrounds()
+        self.positionLabel.x = width/2
+        self.sizeLabel.x = width-4
+
+    def restore_autosave(self):
+        # rebuild the canvas from the journal of the last session
+        if self.playing:
+            self.toggle_playback()
+
+        try:
+            recovered = autosave.recover(self.recoveryPath)
+            if recovered == None:
+                os.remove(self.recoveryPath)
+        except OSError as error:
+            self.set_caption(f"{const.APP_NAME} - restoring failed: {error}")
+            return
+        recoveryPath = self.recoveryPath
+        self.recoveryPath = None
+        if recovered == None:
+            self.set_caption(f"{const.APP_NAME} - nothing to restore")
+            return
+
+        frames, currentIndex, projectPath = recovered
+        animation = Animation(frames)
+        animation.currentIndex = min(currentIndex, len(frames) - 1)
+        proj.close_projects(self.canvas.animation.frames)
+        self.init_canvas(Canvas(frames[0].width, frames[0].height, animation))
+        self.history = History(const.HISTORY_MEMORY_BUDGET)
+        self.projectPath = projectPath
+
+        # still unsaved, written to this session's journal right away. The last session's one
+        # is kept until that journal holds all of it.
+        self.autosave.reset(self.canvas.animation)
+        self.autosave.replaces = recoveryPath
+        self.autosave.unsaved = True
+        self.autosave_checkpoint()
+
+        self.update_canvas_size_label()
+        self.update_layer_label()
+        self.set_caption(f"{const.APP_NAME} - {os.path.basename(projectPath)} (restored)")
 
     def run(self):
         # start the window
         pyglet.app.run()
 
+    def save_project(self):
+        try:
+            proj.save_project(self.canvas.animation.frames, self.projectPath)
+        except (OSError, ValueError) as error:
+            self.set_caption(f"{const.APP_NAME} - saving failed: {error}")
+            return
+        self.autosave.reset(self.canvas.animation)   # nothing is unsaved, the journal starts again with the next edit
+        self.set_caption(f"{const.APP_NAME} - {os.path.basename(self.projectPath)}")
+
     def set_app_icon(self):
-        self.icon = pyglet.image.load(const.APP_ICON_PATH)
+        self.icon = self.atlas.image_data("app")
         self.set_icon(self.icon)
 
     def set_color_display(self):
-        # left color display
-        self.paletteLeftColorImage = pyglet.image.SolidColorImagePattern(self.artist.primaryColor).create_image(24, 24)
-        self.paletteLeftColorSprite = pyglet.sprite.Sprite(self.paletteLeftColorImage, x = 180, y = 22)
-
-        # right color display
-        self.paletteRightColorImage = pyglet.image.SolidColorImagePattern(self.artist.secondaryColor).create_image(24, 24)
-        self.paletteRightColorSprite = pyglet.sprite.Sprite(self.paletteRightColorImage, x = 180 + 38, y = 22)
+        for sprite, color in ((self.paletteLeftColorSprite, self.artist.primaryColor),
+                              (self.paletteRightColorSprite, self.artist.secondaryColor)):
+            sprite.color = color[:3]
+            sprite.opacity = color[3]
+
+    def set_floating(self, floating):
+        # show a floating selection (again after it changed), or none
+        self.canvas.floating = floating
+        self.floatingTexture = None if floating == None else LayerTexture(floating.buffer, *self.floating_position())
+
+    def set_frame(self, index):
+        animation = self.canvas.animation
+        self.frameTextures.invalidate(animation.currentIndex)   # it may have been edited
+        animation.set_current(index)
+
+        self.pixelTexture = LayerTexture(self.canvas.layers.composite, self.canvas.origin[0], self.canvas.origin[1])
+        self.update_layer_label()
+
+    def set_label_text(self, label, text):
+        # changing the text lays the label out again, skip that when it stays the same
+        if not label.text == text:
+            label.text = text
+            self.invalid = True
 
     def set_mouse_coordinates(self, x, y):
         # position of the mouse relative to window (0.0-1.0)
@@ -626,38 +1188,87 @@ class Window(pyglet.window.Window):
         self.canvas.mousePos[0] = math.floor(self.mousePos[0] - const.WINDOW_START_WIDTH/2 + self.canvas.width/2)
         self.canvas.mousePos[1] = math.floor(self.mousePos[1] - const.WINDOW_START_HEIGHT/2 + self.canvas.height/2)
 
+    def set_palette_color(self, index, color):
+        self.artist.palette[index] = color
+        self.paletteColors[index].set_color(color)
+
+        # an indexed canvas only stores indices: the entry recolors every cell using it,
+        # the composites are rebuilt from the indices
+        palette = self.canvas.palette
+        if not palette == None and index < len(palette.colors):
+            palette.set_color(index, color)
+            layers = self.canvas.layers
+            for position, layer in enumerate(layers.layers):
+                layers.invalidate(layer.buffer.tile_keys(), position)
+            self.frameTextures.invalidate()
+
     def set_window_background_color(self):
         bg = const.WINDOW_BACKGROUND_COLOR
         gl.glClearColor(bg[0], bg[1], bg[2], bg[3])
 
+    def show_next_frame(self, dt):
+        self.playbackIndex = (self.playbackIndex + 1) % len(self.canvas.animation.frames)
+        self.invalid = True
+
+    def toggle_grid(self, nextTileSize=False):
+        # G shows or hides the grid, shift+G cycles through the tile grids and shows it
+        canvas = self.canvas
+        if not nextTileSize:
+            canvas.gridOn = not canvas.gridOn
+            return
+
+        sizes = (None,) + const.GRID_TILE_SIZES
+        canvas.gridTileSize = sizes[(sizes.index(canvas.gridTileSize) + 1) % len(sizes)]
+        canvas.gridOn = True
+
+    def toggle_playback(self):
+        if self.playing:
+            pyglet.clock.unschedule(self.show_next_frame)
+            self.playing = False
+            return
+
+        # upload every frame once, playback then only switches between them
+        animation = self.canvas.animation
+        self.frameTextures.invalidate(animation.currentIndex)
+        self.frameTextures.build_all(animation)
+
+        self.playbackIndex = animation.currentIndex
+        self.playing = True
+        pyglet.clock.schedule_interval(self.show_next_frame, 1/animation.fps)
+
     def update_coordinates_label(self):
         # set mouse coordinates label
-        self.positionLabel = pyglet.text.Label(f"({self.canvas.mousePos[0]}, {self.canvas.mousePos[1]})",
-                font_name=const.FONT_NAME,
-                font_size=const.FONT_SIZE,
-                x=self.width/2, y=0,
-                anchor_x='center', anchor_y='bottom', bold=const.FONT_BOLD)
+        self.set_label_text(self.positionLabel, f"({self.canvas.mousePos[0]}, {self.canvas.mousePos[1]})")
 
     def update_canvas_size_label(self):
-        self.sizeLabel = pyglet.text.Label(f"{self.canvas.width} x {self.canvas.height} px",
-                font_name=const.FONT_NAME,
-                font_size=const.FONT_SIZE,
-                x=self.width-4, y=0,
-                anchor_x='right', anchor_y='bottom', bold=const.FONT_BOLD)
+        self.set_label_text(self.sizeLabel, f"{self.canvas.width} x {self.canvas.height} px")
+
+    def update_layer_label(self):
+        layers = self.canvas.layers
+        layer = layers.active()
+        hidden = "" if layer.visible else ", hidden"
+        animation = self.canvas.animation
+        stamp = self.artist.brush
+        self.set_label_text(self.layerLabel,
+                f"Frame {animation.currentIndex + 1}/{len(animation.frames)}  {layer.name} ({layers.activeIndex + 1}/{len(layers.layers)}, {layer.blendMode}, "
+                f"{int(round(layer.opacity * 100))}%{hidden})  Brush {stamp.size} {stamp.shape}")
 
     def update_pixel_cursor_position(self):
-        if self.canvas.is_mouse_on_canvas(self.mousePos[0], self.mousePos[1]):
-            self.pixelCursorSprite = pyglet.sprite.Sprite(self.pixelCursorImage, x=self.canvas.origin[0]+self.canvas.mousePos[0],
-                                                        y=self.canvas.origin[1]+self.canvas.mousePos[1])
-        else:
-            self.pixelCursorSprite = None
+        # returns whether the cursor changed
+        sprite = self.pixelCursorSprite
+        visible = self.canvas.is_mouse_on_canvas(self.mousePos[0], self.mousePos[1])
+        position = (self.canvas.origin[0]+self.canvas.mousePos[0], self.canvas.origin[1]+self.canvas.mousePos[1])
+
+        if visible == sprite.visible and (not visible or position == (sprite.x, sprite.y)):
+            return False
+
+        sprite.visible = visible
+        if visible:
+            sprite.position = position
+        return True
 
     def update_zoom_percentage_label(self):
-        self.zoomLabel = pyglet.text.Label(f"{int(1/self.zoomLevel*100)}%",
-            font_name=const.FONT_NAME,
-            font_size=const.FONT_SIZE,
-            x=4, y=0,
-            anchor_x='left', anchor_y='bottom', bold=const.FONT_BOLD)
+        self.set_label_text(self.zoomLabel, f"{int(1/self.zoomLevel*100)}%")
 
     def zoom(self, x, y, dy):
         # get scale factor based on which direction the scroll was
@@ -670,7 +1281,7 @@ class Window(pyglet.window.Window):
         # if mouse is in main area
         if not y > self.height - 80 and not y < 20:
             # if zoomLevel is in the proper range
-            if const.ZOOM_LIMIT_LOW <= self.zoomLevel * factor <= const.ZOOM_LIMIT_HIGH:
+            if const.ZOOM_LIMIT_LOW <= self.zoomLevel * factor <= self.zoomLimitHigh:
                 # position of the mouse relative to window
                 mouseX = x/self.width
                 mouseY = y/self.height
@@ -707,9 +1318,41 @@ class Window(pyglet.window.Window):
                 self.bottom = mouseYInWorld - mouseY*self.zoomedHeight
                 self.top    = mouseYInWorld + (1 - mouseY)*self.zoomedHeight
 
+Window.register_event_type("on_export_done")
+Window.register_event_type("on_import_done")
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(prog=const.APP_NAME)
+    parser.add_argument("project", nargs="?", help=f"{const.PROJECT_EXTENSION} project to open, or a PNG or GIF to import")
+    parser.add_argument("--size", default=f"{const.CANVAS_SIZE_X}x{const.CANVAS_SIZE_Y}",
+                        help="size of a new canvas as WIDTHxHEIGHT")
+    parser.add_argument("--indexed", action="store_true",
+                        help="new canvas stores palette indices, editing the palette recolors it")
+    parser.add_argument("--startup-time", action="store_true",
+                        help="print the time from launch to the first frame and quit")
+    arguments = parser.parse_args()
+
+    try:
+        width, height = (int(n) for n in arguments.size.lower().split("x"))
+    except ValueError:
+        parser.error(f"invalid canvas size: {arguments.size}")
+    if not (0 < width <= const.CANVAS_SIZE_MAX and 0 < height <= const.CANVAS_SIZE_MAX):
+        parser.error(f"canvas size must be between 1 and {const.CANVAS_SIZE_MAX}")
+
+    return arguments.project, width, height, arguments.indexed, arguments.startup_time
+
 if __name__ == "__main__":
+    projectPath, canvasWidth, canvasHeight, indexed, measureStartup = parse_arguments()
+
     appArtist = Artist()
     appCanvas = Canvas(
-        const.CANVAS_SIZE_X, const.CANVAS_SIZE_Y)
+        canvasWidth, canvasHeight, palette=palet.Palette(appArtist.palette) if indexed else None)
     appWindow = Window(
-        const.WINDOW_START_WIDTH, const.WINDOW_START_HEIGHT, appCanvas, appArtist, resizable=True, caption=const.APP_NAME).run()
+        const.WINDOW_START_WIDTH, const.WINDOW_START_HEIGHT, appCanvas, appArtist, resizable=True, caption=const.APP_NAME,
+        file_drops=True)
+    appWindow.measureStartup = measureStartup
+    if not projectPath == None and projectPath.lower().endswith(const.PROJECT_EXTENSION):
+        appWindow.open_project(projectPath)
+    elif not projectPath == None:
+        appWindow.import_image(projectPath)
+    appWindow.run()
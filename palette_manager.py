@@ -1,3 +1,7 @@
+import functools
+
+import numpy as np
+
 def read_hex_to_rgb(filename):
     palette_colors = []
 
@@ -8,3 +12,101 @@ def read_hex_to_rgb(filename):
                 palette_colors.append((rgb[0], rgb[1], rgb[2], 255))
 
     return palette_colors
+
+class PaletteMapper():
+    """
+    Maps colors to the index of the nearest palette color. The answer for every color is
+    kept in a lookup table over the whole RGB cube that is filled in as colors are met,
+    so a remap only computes distances for colors no earlier remap has seen.
+    """
+    def __init__(self, palette, metric="rgb") -> None:
+        if len(palette) > 255:
+            raise ValueError("palettes are limited to 255 colors")
+        if not metric in ("rgb", "perceptual"):
+            raise ValueError(f"unknown color metric: {metric}")
+
+        self.palette = palette
+        self.metric = metric
+        self.paletteColors = _metric_space(np.array([color[:3] for color in palette], dtype=np.uint8), metric)
+        self.lookup = np.full(1 << 24, 255, dtype=np.uint8)   # 255 = not computed yet
+
+    def indices(self, pixels):
+        """
+        Nearest palette index for every pixel of an (..., 3 or 4) uint8 array, alpha is ignored.
+        """
+        rgb = pixels[..., :3].astype(np.int32)
+        keys = (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+        indices = self.lookup[keys]
+
+        unknown = indices == 255
+        if unknown.any():
+            # distinct new colors, marked in a bitmap over the cube (much cheaper than sorting)
+            needed = np.zeros(1 << 24, dtype=bool)
+            needed[keys[unknown]] = True
+            colors = np.flatnonzero(needed)
+
+            # |c - p|^2 = |c|^2 - 2 c.p + |p|^2, and |c|^2 does not change which p is closest
+            paletteNorms = (self.paletteColors ** 2).sum(axis=1)
+            for start in range(0, len(colors), 65536):   # bounds the size of the distance matrix
+                chunk = colors[start:start + 65536]
+                chunkRgb = np.stack(((chunk >> 16) & 255, (chunk >> 8) & 255, chunk & 255), axis=1).astype(np.uint8)
+                distances = paletteNorms - 2 * _metric_space(chunkRgb, self.metric) @ self.paletteColors.T
+                self.lookup[chunk] = distances.argmin(axis=1)
+            indices = self.lookup[keys]
+
+        return indices
+
+    def remap(self, pixels):
+        # pixels with every color replaced by its nearest palette color, alpha is kept
+        colors = np.array([color[:3] for color in self.palette], dtype=np.uint8)
+        result = pixels.copy()
+        result[..., :3] = colors[self.indices(pixels)]
+        return result
+
+class Palette():
+    """
+    The colors of an indexed canvas as a lookup table from index to RGBA. Index 255 is
+    reserved for empty cells. Changing an entry changes the color of every cell using it.
+    """
+    def __init__(self, colors, metric="rgb") -> None:
+        if len(colors) > 255:
+            raise ValueError("palettes are limited to 255 colors")
+
+        self.colors = list(colors)
+        self.metric = metric
+        self.table = np.zeros((256, 4), dtype=np.uint8)   # entries after the colors stay empty
+        self.table[:len(self.colors)] = self.colors
+
+    def indices(self, pixels):
+        # nearest palette index of (..., 4) RGBA pixels, empty for fully transparent ones
+        indices = get_mapper(self.colors, self.metric).indices(pixels)
+        return np.where(pixels[..., 3] == 0, 255, indices).astype(np.uint8)
+
+    def set_color(self, index, color):
+        self.colors[index] = tuple(color)
+        self.table[index] = color
+
+@functools.lru_cache(maxsize=8)
+def _cached_mapper(palette, metric):
+    return PaletteMapper(palette, metric)
+
+def get_mapper(palette, metric="rgb"):
+    """
+    PaletteMapper for the palette, shared by every caller that uses the same palette and metric.
+    """
+    return _cached_mapper(tuple(tuple(color) for color in palette), metric)
+
+def _metric_space(rgb, metric):
+    # colors as float coordinates in which euclidean distance is the metric: RGB or CIELAB
+    if metric == "rgb":
+        return rgb.astype(np.float32)
+
+    # sRGB -> linear RGB -> XYZ (D65) -> CIELAB
+    c = rgb.astype(np.float32) / 255
+    c = np.where(c > 0.04045, ((c + 0.055) / 1.055) ** 2.4, c / 12.92)
+    xyz = c @ np.array([[0.4124, 0.2126, 0.0193],
+                        [0.3576, 0.7152, 0.1192],
+                        [0.1805, 0.0722, 0.9505]], dtype=np.float32)
+    xyz /= np.array([0.95047, 1.0, 1.08883], dtype=np.float32)
+    f = np.where(xyz > 216 / 24389, np.cbrt(xyz), (24389 / 27 * xyz + 16) / 116)
+    return np.stack((116 * f[:, 1] - 16, 500 * (f[:, 0] - f[:, 1]), 200 * (f[:, 1] - f[:, 2])), axis=1)
@@ -0,0 +1,451 @@
+import numpy as np
+
+import constants as const
+
+EMPTY_INDEX = 255   # palette index of empty cells in indexed buffers
+
+class Tile():
+    def __init__(self, size, pixels=None, mask=None) -> None:
+        self.pixels = np.zeros((size, size, 4), dtype=np.uint8) if pixels is None else pixels
+        self.mask = np.zeros((size, size), dtype=bool) if mask is None else mask
+
+    def arrays(self):
+        # the arrays that hold the content, for storing and copying the tile
+        return self.pixels, self.mask
+
+    def set(self, index, pixels, mask):
+        # write colors and occupancy at index, any numpy index into the (size, size) grid
+        self.pixels[index] = pixels
+        self.mask[index] = mask
+
+class IndexedTile():
+    """
+    Tile of an indexed buffer: one palette index per cell, EMPTY_INDEX for empty cells.
+    pixels and mask are resolved through the palette whenever they are read.
+    """
+    def __init__(self, size, palette, indices=None) -> None:
+        self.palette = palette
+        self.indices = np.full((size, size), EMPTY_INDEX, dtype=np.uint8) if indices is None else indices
+
+    @property
+    def mask(self):
+        return self.indices != EMPTY_INDEX
+
+    @property
+    def pixels(self):
+        return self.palette.table[self.indices]
+
+    def arrays(self):
+        return (self.indices,)
+
+    def set(self, index, pixels, mask):
+        pixels = np.asarray(pixels, dtype=np.uint8)
+        if pixels.ndim == 0:   # 0 for cleared cells
+            pixels = np.broadcast_to(pixels, (4,))
+        self.indices[index] = np.where(mask, self.palette.indices(pixels), EMPTY_INDEX)
+
+class PixelBuffer():
+    """
+    RGBA pixel store with a separate occupancy mask, kept as a grid of square tiles.
+    A tile is only allocated when something is written to it. With a source (an open
+    project file), tiles of the source are decompressed the first time they are accessed.
+    Row 0 is the top row of the image, like in the exported PNG.
+    """
+    def __init__(self, width, height, trackTouched=False, tileSize=const.TILE_SIZE, source=None) -> None:
+        self.width = width
+        self.height = height
+
+        self.tileSize = tileSize
+        self.tilesX = -(-width // tileSize)
+        self.tilesY = -(-height // tileSize)
+        self.tiles = {}                 # (tx, ty) -> Tile, empty pixels are kept at (0, 0, 0, 0)
+        self.source = source
+        self.modifiedTiles = set()      # tiles written since the buffer was last saved
+
+        self.dirtyRect = None   # (x0, y0, x1, y1) changed since the last pop_dirty_rect, end exclusive
+        self.dirtyTiles = set()   # tiles changed since the last pop_dirty_tiles, only the written ones
+        self.dirtyListeners = []   # functions called with every rectangle marked dirty, for more than one consumer
+
+        # with trackTouched, the written cells are kept as a mask per tile, so clear and merge
+        # only visit those tiles and handle each of them with array operations
+        self.trackTouched = trackTouched
+        self.touched = {}   # (tx, ty) -> (tileSize, tileSize) bool array
+
+        self.recorder = None   # a history.StrokeRecorder that copies every tile before its first write
+
+    def cells_by_tile(self, xs, ys):
+        # group cell coordinates by tile: yields ((tx, ty), positions in xs/ys, local xs, local ys)
+        size = self.tileSize
+        keys = (ys // size) * self.tilesX + xs // size
+
+        if len(keys) > 0 and keys.min() == keys.max():
+            groups = [np.arange(len(keys))]
+        else:
+            order = np.argsort(keys, kind="stable")
+            groups = np.split(order, np.flatnonzero(np.diff(keys[order])) + 1)
+
+        for group in groups:
+            key = int(keys[group[0]])
+            yield (key % self.tilesX, key // self.tilesX), group, xs[group] % size, ys[group] % size
+
+    def clear(self):
+        if self.trackTouched:
+            if not self.touched:
+                return
+
+            self.record(self.touched)
+            for key, touched in self.touched.items():
+                tile = self.tiles.get(key)
+                if not tile == None:
+                    tile.set(slice(None) if touched.all() else touched, 0, False)
+            self.modifiedTiles.update(self.touched)
+            self.mark_tiles_dirty(self.touched)
+            self.touched = {}
+        else:
+            self.record(self.tile_keys())
+            self.modifiedTiles.update(self.tile_keys())
+            self.tiles = {}
+            self.source = None
+            self.mark_dirty(0, 0, self.width, self.height)
+
+    def clip(self, xs, ys):
+        # drop the coordinates that fall outside the buffer
+        inside = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+        return xs[inside], ys[inside]
+
+    def color_mask(self, color):
+        """
+        (height, width) bool array of the cells painted with color, or of the empty cells for None.
+        """
+        if color == None:
+            result = np.ones((self.height, self.width), dtype=bool)
+        else:
+            result = np.zeros((self.height, self.width), dtype=bool)
+
+        size = self.tileSize
+        for tx, ty in self.tile_keys():
+            tile = self.get_tile(tx, ty)
+            x0, y0 = tx * size, ty * size
+            w, h = min(size, self.width - x0), min(size, self.height - y0)
+
+            if color == None:
+                result[y0:y0 + h, x0:x0 + w] = ~tile.mask[:h, :w]
+            else:
+                result[y0:y0 + h, x0:x0 + w] = tile.mask[:h, :w] & np.all(tile.pixels[:h, :w] == color, axis=2)
+
+        return result
+
+    def contains(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def delete_pixel(self, x, y):
+        tile = self.get_tile(x // self.tileSize, y // self.tileSize)
+        if tile == None:
+            return
+
+        self.record([(x // self.tileSize, y // self.tileSize)])
+        tile.set((y % self.tileSize, x % self.tileSize), 0, False)
+        self.modifiedTiles.add((x // self.tileSize, y // self.tileSize))
+        self.mark_dirty(x, y, x + 1, y + 1)
+
+    def delete_pixels(self, xs, ys):
+        xs, ys = self.clip(xs, ys)
+        self.write_cells(xs, ys, 0, False)
+
+    def fill_spans(self, spans, color):
+        """
+        Write one color over (row, x0, x1) spans, x1 exclusive, clipped to the buffer. The spans
+        of every row of tiles become one mask, so each tile is written once; tiles the spans
+        cover completely are filled whole.
+        """
+        spans = np.asarray(spans, dtype=np.int64).reshape(-1, 3)
+        ys, x0s, x1s = spans[:, 0], np.maximum(spans[:, 1], 0), np.minimum(spans[:, 2], self.width)
+        inside = (ys >= 0) & (ys < self.height) & (x0s < x1s)
+        ys, x0s, x1s = ys[inside], x0s[inside], x1s[inside]
+        if len(ys) == 0:
+            return
+
+        size = self.tileSize
+        order = np.argsort(ys, kind="stable")
+        ys, x0s, x1s = ys[order], x0s[order], x1s[order]
+        tileRows = ys // size
+        bounds = np.flatnonzero(np.diff(tileRows)) + 1
+        written = []
+
+        for group in np.split(np.arange(len(ys)), bounds):
+            ty = int(tileRows[group[0]])
+
+            # spans of the tile row as a mask, counted up from their ends so overlapping spans still work
+            edges = np.zeros((size, self.tilesX * size + 1), dtype=np.int16)
+            np.add.at(edges, (ys[group] % size, x0s[group]), 1)
+            np.add.at(edges, (ys[group] % size, x1s[group]), -1)
+            covered = (np.cumsum(edges[:, :-1], axis=1, dtype=np.int16) > 0).reshape(size, self.tilesX, size)
+
+            for tx in np.flatnonzero(covered.any(axis=(0, 2))).tolist():
+                cells = covered[:, tx, :]
+                index = slice(None) if cells.all() else cells
+                self.record([(tx, ty)])
+                self.get_tile(tx, ty, create=True).set(index, color, True)
+                self.touch((tx, ty), index)
+                self.modifiedTiles.add((tx, ty))
+                written.append((tx, ty))
+
+        self.mark_dirty(int(x0s.min()), int(ys[0]), int(x1s.max()), int(ys[-1]) + 1, written)
+
+    def get_cells(self, xs, ys):
+        # colors and occupancy of many cells at once, as (n, 4) and (n,) arrays
+        pixels = np.zeros((len(xs), 4), dtype=np.uint8)
+        mask = np.zeros(len(xs), dtype=bool)
+
+        for key, group, localXs, localYs in self.cells_by_tile(xs, ys):
+            tile = self.get_tile(*key)
+            if not tile == None:
+                pixels[group] = tile.pixels[localYs, localXs]
+                mask[group] = tile.mask[localYs, localXs]
+
+        return pixels, mask
+
+    def get_pixel(self, x, y):
+        tile = self.get_tile(x // self.tileSize, y // self.tileSize)
+        if tile == None or not tile.mask[y % self.tileSize, x % self.tileSize]:
+            return None
+        return tuple(int(c) for c in tile.pixels[y % self.tileSize, x % self.tileSize])
+
+    def get_tile(self, tx, ty, create=False):
+        tile = self.tiles.get((tx, ty))
+
+        if tile == None and not self.source == None and self.source.has_tile(tx, ty):
+            tile = self.make_tile(*self.source.load_tile(tx, ty))
+            self.tiles[(tx, ty)] = tile
+
+        if tile == None and create:
+            tile = self.make_tile()
+            self.tiles[(tx, ty)] = tile
+
+        return tile
+
+    def make_tile(self, *arrays):
+        # a new tile, empty or from the arrays a source returned
+        return Tile(self.tileSize, *arrays)
+
+    def mark_dirty(self, x0, y0, x1, y1, keys=None):
+        # keys: the tiles written inside the rectangle, all of them when not given
+        if keys == None:
+            size = self.tileSize
+            keys = [(tx, ty) for ty in range(y0 // size, (y1 - 1) // size + 1)
+                    for tx in range(x0 // size, (x1 - 1) // size + 1)]
+        self.dirtyTiles.update(keys)
+
+        if self.dirtyRect == None:
+            self.dirtyRect = (x0, y0, x1, y1)
+        else:
+            rect = self.dirtyRect
+            self.dirtyRect = (min(rect[0], x0), min(rect[1], y0), max(rect[2], x1), max(rect[3], y1))
+
+        for listener in self.dirtyListeners:
+            listener(x0, y0, x1, y1)
+
+    def mark_dirty_cells(self, xs, ys, keys=None):
+        self.mark_dirty(int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1, keys)
+
+    def mark_tiles_dirty(self, keys):
+        # the tiles, and the rectangle around them clipped to the buffer
+        size = self.tileSize
+        txs, tys = [key[0] for key in keys], [key[1] for key in keys]
+        self.mark_dirty(min(txs) * size, min(tys) * size, min((max(txs) + 1) * size, self.width),
+                        min((max(tys) + 1) * size, self.height), keys)
+
+    def merge(self, other):
+        # copy every painted pixel of another buffer of the same size on top of this one, a tile at a time
+        keys = list(other.touched) if other.trackTouched else other.tile_keys()
+        written = []
+        for key in keys:
+            otherTile = other.get_tile(*key)
+            if otherTile == None:
+                continue
+            cells = otherTile.mask & other.touched[key] if other.trackTouched else otherTile.mask
+            if not cells.any():
+                continue
+
+            if not other.tileSize == self.tileSize:
+                ys, xs = np.nonzero(cells)
+                self.write_cells(xs + key[0] * other.tileSize, ys + key[1] * other.tileSize, otherTile.pixels[cells], True)
+                continue
+
+            self.record([key])
+            if cells.all():   # whole tiles are copied as they are
+                self.get_tile(*key, create=True).set(slice(None), otherTile.pixels, True)
+            else:
+                self.get_tile(*key, create=True).set(cells, otherTile.pixels[cells], True)
+            self.touch(key, cells)
+            self.modifiedTiles.add(key)
+            written.append(key)
+
+        if written:
+            self.mark_tiles_dirty(written)
+
+    def new_like(self, source=None):
+        # empty buffer of the same kind and size
+        return PixelBuffer(self.width, self.height, tileSize=self.tileSize, source=source)
+
+    def pop_dirty_rect(self):
+        rect = self.dirtyRect
+        self.dirtyRect = None
+        return rect
+
+    def pop_dirty_tiles(self):
+        keys = self.dirtyTiles
+        self.dirtyTiles = set()
+        return keys
+
+    def read(self, x0, y0, x1, y1):
+        """
+        Copy of a rectangle as (height, width, 4) pixels and (height, width) mask arrays.
+        """
+        pixels = np.zeros((y1 - y0, x1 - x0, 4), dtype=np.uint8)
+        mask = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+
+        size = self.tileSize
+        for ty in range(y0 // size, (y1 - 1) // size + 1):
+            for tx in range(x0 // size, (x1 - 1) // size + 1):
+                tile = self.get_tile(tx, ty)
+                if tile == None:
+                    continue
+
+                # overlap of the tile and the rectangle, in buffer coordinates
+                left, right = max(x0, tx * size), min(x1, tx * size + size)
+                top, bottom = max(y0, ty * size), min(y1, ty * size + size)
+
+                pixels[top - y0:bottom - y0, left - x0:right - x0] = \
+                    tile.pixels[top - ty * size:bottom - ty * size, left - tx * size:right - tx * size]
+                mask[top - y0:bottom - y0, left - x0:right - x0] = \
+                    tile.mask[top - ty * size:bottom - ty * size, left - tx * size:right - tx * size]
+
+        return pixels, mask
+
+    def record(self, keys):
+        # hand the tiles at keys to the recorder before they are written
+        if not self.recorder == None:
+            self.recorder.record(self, keys)
+
+    def restore_tile(self, key, arrays):
+        # put back a tile as the history kept it, None for no tile
+        if arrays == None and (self.source == None or not self.source.has_tile(*key)):
+            self.tiles.pop(key, None)
+        else:
+            self.tiles[key] = self.make_tile() if arrays == None else self.make_tile(*arrays)
+
+        self.modifiedTiles.add(key)
+        x0, y0 = key[0] * self.tileSize, key[1] * self.tileSize
+        self.mark_dirty(x0, y0, min(x0 + self.tileSize, self.width), min(y0 + self.tileSize, self.height))
+
+    def set_pixel(self, x, y, color):
+        self.record([(x // self.tileSize, y // self.tileSize)])
+
+        tile = self.get_tile(x // self.tileSize, y // self.tileSize, create=True)
+        tile.set((y % self.tileSize, x % self.tileSize), color, True)
+        self.touch((x // self.tileSize, y // self.tileSize), (y % self.tileSize, x % self.tileSize))
+        self.modifiedTiles.add((x // self.tileSize, y // self.tileSize))
+        self.mark_dirty(x, y, x + 1, y + 1)
+
+    def set_pixels(self, xs, ys, color):
+        xs, ys = self.clip(xs, ys)
+        self.write_cells(xs, ys, color, True)
+
+    def tile_keys(self):
+        # every tile that has content, loaded or still in the source
+        keys = set(self.tiles)
+        if not self.source == None:
+            keys.update(self.source.tile_keys())
+        return keys
+
+    def trim_touched(self):
+        # forget the touched cells that are empty again, so only the current content is tracked
+        for key in list(self.touched):
+            tile = self.tiles.get(key)
+            if tile == None or not tile.mask.any():
+                del self.touched[key]
+            else:
+                self.touched[key] = tile.mask.copy()
+
+    def touch(self, key, index):
+        # mark the cells at index of a tile as written, any numpy index into the (size, size) grid
+        if self.trackTouched:
+            if not key in self.touched:
+                self.touched[key] = np.zeros((self.tileSize, self.tileSize), dtype=bool)
+            self.touched[key][index] = True
+
+    def write_rect(self, x0, y0, pixels, mask):
+        """
+        Write a dense block of (height, width, 4) pixels and (height, width) mask with its top
+        left cell at (x0, y0). Tiles that would stay empty are not created.
+        """
+        height, width = mask.shape
+
+        size = self.tileSize
+        for ty in range(y0 // size, (y0 + height - 1) // size + 1):
+            for tx in range(x0 // size, (x0 + width - 1) // size + 1):
+                # overlap of the tile and the block, in buffer coordinates
+                left, right = max(x0, tx * size), min(x0 + width, tx * size + size)
+                top, bottom = max(y0, ty * size), min(y0 + height, ty * size + size)
+
+                blockMask = mask[top - y0:bottom - y0, left - x0:right - x0]
+                self.record([(tx, ty)])
+                tile = self.get_tile(tx, ty, create=blockMask.any())
+                if tile == None:
+                    continue
+
+                index = (slice(top - ty * size, bottom - ty * size), slice(left - tx * size, right - tx * size))
+                tile.set(index, pixels[top - y0:bottom - y0, left - x0:right - x0], blockMask)
+                self.touch((tx, ty), index)
+                self.modifiedTiles.add((tx, ty))
+
+        self.mark_dirty(x0, y0, x0 + width, y0 + height)
+
+    def write_cells(self, xs, ys, pixels, mask):
+        """
+        Write colors and occupancy to in-bounds cells. pixels is one color or an (n, 4) array,
+        mask one bool or an (n,) array.
+        """
+        if len(xs) == 0:
+            return
+
+        perCellPixels = np.ndim(pixels) == 2
+        perCellMask = np.ndim(mask) == 1
+
+        written = []
+        for key, group, localXs, localYs in self.cells_by_tile(xs, ys):
+            painting = mask[group].any() if perCellMask else mask
+            self.record([key])
+            tile = self.get_tile(*key, create=painting)
+            if tile == None:   # clearing cells of a tile that was never painted
+                continue
+
+            tile.set((localYs, localXs), pixels[group] if perCellPixels else pixels,
+                     mask[group] if perCellMask else mask)
+            self.touch(key, (localYs, localXs))
+            self.modifiedTiles.add(key)
+            written.append(key)
+
+        self.mark_dirty_cells(xs, ys, written)
+
+class IndexedPixelBuffer(PixelBuffer):
+    """
+    PixelBuffer that stores one palette index per cell instead of RGBA and occupancy.
+    Colors written to it are mapped to the nearest palette color, colors read from it
+    are looked up in the palette, so changing a palette entry recolors every cell using it.
+    """
+    def __init__(self, width, height, palette, trackTouched=False, tileSize=const.TILE_SIZE, source=None) -> None:
+        super().__init__(width, height, trackTouched, tileSize, source)
+        self.palette = palette   # a palette_manager.Palette
+
+    def make_tile(self, *arrays):
+        if len(arrays) == 2:   # RGBA tile, from a project file
+            pixels, mask = arrays
+            tile = IndexedTile(self.tileSize, self.palette)
+            tile.set(slice(None), pixels, mask)
+            return tile
+        return IndexedTile(self.tileSize, self.palette, *arrays)
+
+    def new_like(self, source=None):
+        return IndexedPixelBuffer(self.width, self.height, self.palette, tileSize=self.tileSize, source=source)
@@ -0,0 +1,271 @@
+import hashlib
+import mmap
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from animation import StoredSource
+from layers import BLEND_MODES, Layer, LayerStack
+from pixel_buffer import PixelBuffer
+
+# file layout: header, then per layer of every frame a layer header and its tile index (one
+# entry per tile, row by row), then the compressed tile blobs. Identical blobs are stored once.
+MAGIC = b"PIX31PRJ"
+VERSION = 3
+HEADER = struct.Struct("<8sIIIIII")   # magic, version, width, height, tile size, frame count, layer count
+LAYER_HEADER = struct.Struct("<I64s?fB")   # frame, name, visible, opacity, blend mode
+INDEX_ENTRY = np.dtype([("offset", "<u8"), ("length", "<u4")])   # length 0 = empty tile
+BLEND_MODE_NAMES = list(BLEND_MODES)
+
+class LayerSource():
+    """
+    The tiles of one layer in an open project file, decompressed on request.
+    """
+    def __init__(self, project, position, index) -> None:
+        self.project = project
+        self.position = position   # index of the layer in the file
+        self.index = index
+
+    def has_tile(self, tx, ty):
+        return self.index["length"][ty * self.project.tilesX + tx] > 0
+
+    def blob(self, tx, ty):
+        offset, length = self.index[ty * self.project.tilesX + tx]
+        data = self.project.map[offset:offset + length]
+        if not len(data) == length:
+            raise ValueError(f"tile {tx}, {ty} lies past the end of the mapped {self.project.path}")
+        return data
+
+    def load_tile(self, tx, ty):
+        return decode_tile(self.blob(tx, ty), self.project.tileSize)
+
+    def tile_keys(self):
+        keys = np.flatnonzero(self.index["length"])
+        return [(int(key % self.project.tilesX), int(key // self.project.tilesX)) for key in keys]
+
+class ProjectFile():
+    """
+    An open project file. The file is memory-mapped and a tile is only decompressed
+    when the pixel buffer of its layer asks for it.
+    """
+    def __init__(self, path) -> None:
+        self.path = path
+        self.reopen()
+        try:
+            self.read_headers()
+        except (struct.error, IndexError, ValueError) as error:
+            self.close()
+            raise ValueError(f"{path} is not a valid version {VERSION} pix31 project ({error})") from error
+
+    def read_headers(self):
+        magic, version, self.width, self.height, self.tileSize, self.frameCount, layerCount = \
+            HEADER.unpack_from(self.map, 0)
+        if not magic == MAGIC or not version == VERSION:
+            raise ValueError("unknown format or version")
+        if self.width == 0 or self.height == 0 or self.tileSize == 0 or self.frameCount == 0:
+            raise ValueError("no pixels or no frames")
+
+        self.tilesX = -(-self.width // self.tileSize)
+        self.tilesY = -(-self.height // self.tileSize)
+
+        self.layers = []   # (frame, name, visible, opacity, blend mode, LayerSource)
+        for position in range(layerCount):
+            offset = self.layer_offset(position)
+            frame, name, visible, opacity, blendMode = LAYER_HEADER.unpack_from(self.map, offset)
+            if frame >= self.frameCount:
+                raise ValueError(f"layer {position} is in frame {frame} of {self.frameCount}")
+            index = np.frombuffer(self.map, dtype=INDEX_ENTRY, count=self.tilesX * self.tilesY,
+                                  offset=offset + LAYER_HEADER.size).copy()
+            self.layers.append((frame, name.rstrip(b"\0").decode("utf-8", "ignore"), visible, opacity,
+                                BLEND_MODE_NAMES[blendMode], LayerSource(self, position, index)))
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def reopen(self):
+        # open and map the file, also again after close
+        self.file = open(self.path, "rb")
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:   # empty file
+            self.file.close()
+            raise
+
+    def remap(self):
+        # map the file again, after tiles were appended to it
+        self.map.close()
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def layer_offset(self, position):
+        return HEADER.size + position * (LAYER_HEADER.size + self.tilesX * self.tilesY * INDEX_ENTRY.itemsize)
+
+def decode_tile(data, size):
+    data = np.frombuffer(zlib.decompress(data), dtype=np.uint8)
+    pixels = data[:size * size * 4].reshape(size, size, 4).copy()
+    mask = np.unpackbits(data[size * size * 4:], count=size * size).reshape(size, size).astype(bool)
+    return pixels, mask
+
+def encode_tile(tile):
+    return zlib.compress(tile.pixels.tobytes() + np.packbits(tile.mask).tobytes())
+
+def open_project(path):
+    """
+    The frames of the project file at path, each a LayerStack backed by the file.
+    Opening only reads the headers and the indexes.
+    """
+    project = ProjectFile(path)
+
+    frames = [[] for _ in range(project.frameCount)]
+    for frame, name, visible, opacity, blendMode, source in project.layers:
+        layer = Layer(name, PixelBuffer(project.width, project.height, tileSize=project.tileSize, source=source))
+        layer.visible = visible
+        layer.opacity = opacity
+        layer.blendMode = blendMode
+        frames[frame].append(layer)
+
+    return [LayerStack(project.width, project.height, layers) for layers in frames]
+
+def save_project(frames, path):
+    """
+    Save the frames (LayerStacks) to path. When every layer was opened from (or last saved to)
+    the same position in the same file, only the tiles changed since then are appended and
+    the headers and indexes are rewritten in place. The file is rewritten completely when
+    frames or layers were added, removed or reordered, or once more than half of it is stale
+    tile data.
+    """
+    layers = [(frame, layer) for frame, stack in enumerate(frames) for layer in stack.layers]
+    sources = [_file_source(layer.buffer) for _, layer in layers]
+    project = sources[0].project if isinstance(sources[0], LayerSource) else None
+
+    if not project == None and os.path.abspath(project.path) == os.path.abspath(path) \
+    and len(project.layers) == len(sources) and project.frameCount == len(frames) \
+    and all(isinstance(source, LayerSource) and source.project == project and source.position == position
+            and project.layers[position][0] == frame
+            for position, (source, (frame, _)) in enumerate(zip(sources, layers))):
+        if _save_modified_tiles(layers, project):
+            return
+
+    _save_all_tiles(frames, layers, path)
+
+def close_projects(frames):
+    # close the project files the layers of the frames read their tiles from
+    projects = set(_file_source(layer.buffer).project for stack in frames for layer in stack.layers
+                   if not _file_source(layer.buffer) == None)
+    for project in projects:
+        project.close()
+    return projects
+
+def _file_source(buffer):
+    # the LayerSource unchanged tiles are read from, also for layers of frozen frames
+    source = buffer.source
+    if isinstance(source, StoredSource):
+        source = source.base
+    return source if isinstance(source, LayerSource) else None
+
+def _layer_header(frame, layer):
+    return LAYER_HEADER.pack(frame, layer.name.encode("utf-8")[:64], layer.visible, layer.opacity,
+                             BLEND_MODE_NAMES.index(layer.blendMode))
+
+def _save_all_tiles(frames, layers, path):
+    stack = frames[0]
+    tileSize = stack.layers[0].buffer.tileSize
+    tilesX = -(-stack.width // tileSize)
+    tilesY = -(-stack.height // tileSize)
+    indexes = [np.zeros(tilesX * tilesY, dtype=INDEX_ENTRY) for _ in layers]
+    offset = HEADER.size + len(layers) * (LAYER_HEADER.size + indexes[0].nbytes)
+    written = {}   # blob digest -> index entry, for tiles shared between layers or frames
+
+    temporaryPath = path + ".tmp"
+    with open(temporaryPath, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, stack.width, stack.height, tileSize, len(frames), len(layers)))
+        for (frame, layer), index in zip(layers, indexes):
+            f.write(_layer_header(frame, layer))
+            f.write(index.tobytes())   # placeholder, written again once the offsets are known
+
+        for (_, layer), index in zip(layers, indexes):
+            for (tx, ty), blob in _tile_blobs(layer.buffer):
+                digest = hashlib.blake2b(blob, digest_size=16).digest()
+                if not digest in written:
+                    f.write(blob)
+                    written[digest] = (offset, len(blob))
+                    offset += len(blob)
+                index[ty * tilesX + tx] = written[digest]
+
+        f.seek(HEADER.size)
+        for (frame, layer), index in zip(layers, indexes):
+            f.write(_layer_header(frame, layer))
+            f.write(index.tobytes())
+
+    # tiles still only in the old file are read from it above, it can be closed now
+    projects = close_projects(frames)
+    try:
+        os.replace(temporaryPath, path)
+    except OSError:
+        for project in projects:   # the layers still read from them
+            project.reopen()
+        os.remove(temporaryPath)
+        raise
+
+    # layers of frozen frames keep their stored tiles and read the others from the new file
+    project = ProjectFile(path)
+    for (_, layer), (_, _, _, _, _, source) in zip(layers, project.layers):
+        if isinstance(layer.buffer.source, StoredSource):
+            layer.buffer.source.base = source
+        else:
+            layer.buffer.source = source
+        layer.buffer.modifiedTiles.clear()
+
+def _save_modified_tiles(layers, project):
+    with open(project.path, "r+b") as f:
+        end = f.seek(0, os.SEEK_END)
+
+        # appended blobs leave the old versions behind, compact instead when too much is stale
+        live = sum(int(_file_source(layer.buffer).index["length"].sum()) for _, layer in layers)
+        if end - project.layer_offset(len(layers)) > 2 * max(live, 1):
+            return False
+
+        for position, (frame, layer) in enumerate(layers):
+            buffer = layer.buffer
+            index = _file_source(buffer).index
+
+            for tx, ty in sorted(buffer.modifiedTiles):
+                tile = buffer.tiles.get((tx, ty))
+                if tile == None and isinstance(buffer.source, StoredSource) and (tx, ty) in buffer.source.digests:
+                    tile = buffer.source.store.tiles[buffer.source.digests[(tx, ty)]]
+                if tile == None or not tile.mask.any():
+                    index[ty * buffer.tilesX + tx] = (0, 0)
+                    continue
+                blob = encode_tile(tile)
+                f.write(blob)
+                index[ty * buffer.tilesX + tx] = (end, len(blob))
+                end += len(blob)
+
+            f.seek(project.layer_offset(position))
+            f.write(_layer_header(frame, layer))
+            f.write(index.tobytes())
+            f.seek(end)
+
+    project.remap()
+    for _, layer in layers:
+        layer.buffer.modifiedTiles.clear()
+    return True
+
+def _tile_blobs(buffer):
+    # ((tx, ty), compressed tile) of every tile with content, without loading tiles into the buffer
+    source = buffer.source
+    for key in sorted(buffer.tile_keys(), key=lambda key: (key[1], key[0])):
+        tile = buffer.tiles.get(key)
+        fileSource = source
+        if isinstance(source, StoredSource) and not key in source.digests:
+            fileSource = source.base
+        if tile == None and isinstance(fileSource, LayerSource):
+            yield key, fileSource.blob(*key)   # unchanged, copy it as it is
+            continue
+
+        if tile == None:
+            tile = buffer.make_tile(*source.load_tile(*key))
+        if tile.mask.any():
+            yield key, encode_tile(tile)
@@ -0,0 +1,294 @@
+import hashlib
+import math
+import os
+
+import numpy as np
+import pyglet
+import pyglet.gl as gl
+
+import constants as const
+
+class IconAtlas():
+    """
+    The toolbar icons and a white square packed into one texture. Sprites tint regions of
+    the white square for the solid colored boxes of the toolbar, so the whole toolbar draws
+    from one texture. The packed pixels are cached on disk and only rebuilt when an icon
+    file changed, so a launch decodes no image files.
+    """
+    def __init__(self, paths, cachePath, whiteSize=24) -> None:
+        # paths: name -> image file
+        key = repr([(name, path, os.path.getmtime(path), os.path.getsize(path)) for name, path in sorted(paths.items())]
+                   + [whiteSize])
+
+        try:
+            with np.load(cachePath) as cache:
+                if not str(cache["key"]) == key:
+                    raise ValueError("stale icon atlas")
+                pixels, boxes = cache["pixels"], cache["boxes"]
+        except (OSError, KeyError, ValueError):
+            pixels, boxes = self.pack(paths, whiteSize)
+            try:
+                os.makedirs(os.path.dirname(cachePath) or ".", exist_ok=True)
+                with open(cachePath, "wb") as f:
+                    np.savez(f, key=key, pixels=pixels, boxes=boxes)
+            except OSError:
+                pass   # read-only location, the atlas is packed again next time
+
+        self.pixels = pixels   # rows bottom to top, like pyglet images
+        self.texture = pyglet.image.ImageData(pixels.shape[1], pixels.shape[0], "RGBA", pixels.tobytes()).get_texture()
+        self.boxes = {name: tuple(int(n) for n in box) for name, box in zip(["white"] + sorted(paths), boxes)}
+
+    def image_data(self, name):
+        # the pixels of an icon as an image of its own, e.g. for the window icon
+        x, width, height = self.boxes[name]
+        return pyglet.image.ImageData(width, height, "RGBA", np.ascontiguousarray(self.pixels[:height, x:x + width]).tobytes())
+
+    def pack(self, paths, whiteSize):
+        # white square first, then the icons side by side with a pixel of space between them
+        images = [np.full((whiteSize, whiteSize, 4), 255, dtype=np.uint8)]
+        for name in sorted(paths):
+            image = pyglet.image.load(paths[name]).get_image_data()
+            data = image.get_data("RGBA", image.width * 4)
+            images.append(np.frombuffer(data, dtype=np.uint8).reshape(image.height, image.width, 4))
+
+        pixels = np.zeros((max(image.shape[0] for image in images), sum(image.shape[1] + 1 for image in images), 4), dtype=np.uint8)
+        boxes = []
+        x = 0
+        for image in images:
+            height, width = image.shape[:2]
+            pixels[:height, x:x + width] = image
+            boxes.append((x, width, height))
+            x += width + 1
+
+        return pixels, np.array(boxes)
+
+    def region(self, name, width=None, height=None):
+        # texture region of an icon, or of the bottom left corner of it
+        x, boxWidth, boxHeight = self.boxes[name]
+        return self.texture.get_region(x, 0, boxWidth if width == None else width, boxHeight if height == None else height)
+
+class PixelGrid():
+    """
+    Lines between the pixels of the canvas and, with a tile size, darker lines between
+    tiles of that size. The lines shown at a zoom level are one vertex list, built once
+    for the canvas and drawn with a single call, however many pixels are visible.
+    """
+    def __init__(self, x, y, width, height) -> None:
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.vertexLists = {}   # (pixel lines shown, tile size or None) -> VertexList
+
+    def draw(self, zoomLevel, tileSize=None):
+        # zoomLevel: canvas pixels per screen pixel. Lines closer than GRID_MIN_SPACING screen pixels are left out.
+        showPixels = 1 / zoomLevel >= const.GRID_MIN_SPACING
+        if not tileSize == None and tileSize / zoomLevel < const.GRID_MIN_SPACING:
+            tileSize = None
+        if not showPixels and tileSize == None:
+            return
+
+        key = (showPixels, tileSize)
+        if not key in self.vertexLists:
+            self.vertexLists[key] = self.build(showPixels, tileSize)
+
+        gl.glEnable(gl.GL_BLEND)
+        gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
+        self.vertexLists[key].draw(gl.GL_LINES)
+
+    def build(self, showPixels, tileSize):
+        xs, ys, colors = [], [], []
+        if showPixels:
+            columns, rows = np.arange(self.width + 1), np.arange(self.height + 1)
+            if not tileSize == None:   # those are drawn by the tile lines
+                columns, rows = columns[columns % tileSize > 0], rows[rows % tileSize > 0]
+            xs.append(columns)
+            ys.append(rows)
+            colors.append((len(columns) + len(rows), const.GRID_COLOR))
+        if not tileSize == None:
+            # tiles start at the top left corner, like the tiles of the image
+            columns, rows = np.arange(0, self.width + 1, tileSize), np.arange(0, self.height + 1, tileSize)
+            xs.append(columns)
+            ys.append(rows)
+            colors.append((len(columns) + len(rows), const.GRID_TILE_COLOR))
+
+        # every line from one side of the canvas to the other, verticals before horizontals
+        lines = []
+        for columns, rows in zip(xs, ys):
+            x = self.x + columns
+            y = self.y + self.height - rows
+            lines.append(np.stack((x, np.full_like(x, self.y), x, np.full_like(x, self.y + self.height)), axis=1))
+            lines.append(np.stack((np.full_like(y, self.x), y, np.full_like(y, self.x + self.width), y), axis=1))
+        coordinates = np.concatenate(lines).astype(np.float32).ravel()
+        colorData = np.concatenate([np.tile(color, 2 * count) for count, color in colors]).astype(np.uint8)
+
+        count = len(coordinates) // 2
+        return pyglet.graphics.vertex_list(count, ("v2f/static", coordinates.tolist()), ("c4B/static", colorData.tolist()))
+
+class LayerTexture():
+    """
+    Draws a PixelBuffer as a grid of nearest-filtered RGBA textures, one per chunk of
+    RENDER_CHUNK_SIZE pixels. Only chunks that intersect the camera are uploaded and drawn,
+    and a chunk is only re-uploaded after it was changed. Chunks that never had content
+    get no texture at all.
+    """
+    def __init__(self, buffer, x, y) -> None:
+        self.buffer = buffer
+        self.x = x
+        self.y = y
+
+        self.chunkSize = const.RENDER_CHUNK_SIZE
+        self.sprites = {}          # (cx, cy) -> Sprite of the chunk texture
+        self.dirtyChunks = set()   # chunks changed since their last upload
+
+        self.buffer.mark_dirty(0, 0, buffer.width, buffer.height)   # upload the initial content when visible
+
+    def collect_dirty_chunks(self):
+        rect = self.buffer.pop_dirty_rect()
+        if rect == None:
+            return
+
+        x0, y0, x1, y1 = rect
+        size = self.chunkSize
+        for cy in range(y0 // size, (y1 - 1) // size + 1):
+            for cx in range(x0 // size, (x1 - 1) // size + 1):
+                self.dirtyChunks.add((cx, cy))
+
+    def draw(self, left, right, bottom, top):
+        # left/right/bottom/top: the camera rectangle in world coordinates
+        self.collect_dirty_chunks()
+
+        size = self.chunkSize
+        x0, x1, y0, y1 = self.visible_rect(left, right, bottom, top)
+        if x0 >= x1 or y0 >= y1:
+            return
+
+        for cy in range(y0 // size, (y1 - 1) // size + 1):
+            for cx in range(x0 // size, (x1 - 1) // size + 1):
+                if (cx, cy) in self.dirtyChunks:
+                    self.upload(cx, cy)
+                    self.dirtyChunks.discard((cx, cy))
+
+                sprite = self.sprites.get((cx, cy))
+                if not sprite == None:
+                    sprite.draw()
+
+    def move(self, x, y):
+        # place the texture elsewhere, nothing is uploaded again
+        for sprite in self.sprites.values():
+            sprite.update(x=sprite.x + x - self.x, y=sprite.y + y - self.y)
+        self.x = x
+        self.y = y
+
+    def upload(self, cx, cy):
+        size = self.chunkSize
+        x0, y0 = cx * size, cy * size
+        x1, y1 = min(x0 + size, self.buffer.width), min(y0 + size, self.buffer.height)
+
+        pixels, mask = self.buffer.read(x0, y0, x1, y1)
+
+        sprite = self.sprites.get((cx, cy))
+        if sprite == None:
+            if not mask.any():
+                return
+
+            texture = pyglet.image.Texture.create(x1 - x0, y1 - y0, min_filter=gl.GL_NEAREST, mag_filter=gl.GL_NEAREST)
+            sprite = pyglet.sprite.Sprite(texture, x=self.x + x0, y=self.y + self.buffer.height - y1)
+            self.sprites[(cx, cy)] = sprite
+
+        # buffer rows go top to bottom, texture rows bottom to top
+        region = np.ascontiguousarray(pixels[::-1])
+        image = pyglet.image.ImageData(x1 - x0, y1 - y0, "RGBA", region.tobytes())
+        sprite.image.blit_into(image, 0, 0, 0)
+
+    def visible_rect(self, left, right, bottom, top):
+        # the part of the buffer inside the camera rectangle, as buffer columns and rows
+        x0 = max(0, math.floor(left - self.x))
+        x1 = min(self.buffer.width, math.ceil(right - self.x))
+        y0 = max(0, math.floor(self.buffer.height - (top - self.y)))
+        y1 = min(self.buffer.height, math.ceil(self.buffer.height - (bottom - self.y)))
+        return x0, x1, y0, y1
+
+class FrameTextures():
+    """
+    Uploaded composites of animation frames, for playback and onion skins. Playback only
+    swaps which sprites are drawn. Chunks with the same content in several frames share
+    one texture, so frames that barely differ cost little more than one.
+    """
+    def __init__(self, x, y) -> None:
+        self.x = x
+        self.y = y
+
+        self.chunkSize = const.RENDER_CHUNK_SIZE
+        self.textures = {}   # content digest -> Texture
+        self.users = {}      # content digest -> number of sprites drawing its texture
+        self.frames = {}     # frame index -> list of Sprites
+        self.digests = {}    # frame index -> content digests of its sprites
+
+    def build(self, animation, index):
+        self._build(animation, index)
+        self._prune()
+
+    def _build(self, animation, index):
+        if index in self.frames:
+            return
+
+        composite = animation.compose(index)
+        size = self.chunkSize
+        chunks = sorted(set((tx * composite.tileSize // size, ty * composite.tileSize // size)
+                            for tx, ty in composite.tile_keys()))
+
+        sprites = []
+        digests = []
+        for cx, cy in chunks:
+            x0, y0 = cx * size, cy * size
+            x1, y1 = min(x0 + size, composite.width), min(y0 + size, composite.height)
+            pixels, mask = composite.read(x0, y0, x1, y1)
+            if not mask.any():
+                continue
+
+            # buffer rows go top to bottom, texture rows bottom to top
+            region = np.ascontiguousarray(pixels[::-1]).tobytes()
+            digest = hashlib.blake2b(region, digest_size=16, person=f"{x1 - x0}x{y1 - y0}".encode()).digest()
+
+            texture = self.textures.get(digest)
+            if texture == None:
+                texture = pyglet.image.Texture.create(x1 - x0, y1 - y0, min_filter=gl.GL_NEAREST, mag_filter=gl.GL_NEAREST)
+                texture.blit_into(pyglet.image.ImageData(x1 - x0, y1 - y0, "RGBA", region), 0, 0, 0)
+                self.textures[digest] = texture
+
+            sprites.append(pyglet.sprite.Sprite(texture, x=self.x + x0, y=self.y + composite.height - y1))
+            digests.append(digest)
+            self.users[digest] = self.users.get(digest, 0) + 1
+
+        animation.freeze(index)
+        self.frames[index] = sprites
+        self.digests[index] = digests
+
+    def build_all(self, animation):
+        for index in range(len(animation.frames)):
+            self._build(animation, index)
+        self._prune()
+
+    def _prune(self):
+        # drop textures no frame uses anymore
+        for digest in [digest for digest, users in self.users.items() if users == 0]:
+            del self.users[digest]
+            del self.textures[digest]
+
+    def draw(self, index, left, right, bottom, top, opacity=255, color=(255, 255, 255)):
+        # left/right/bottom/top: the camera rectangle in world coordinates
+        for sprite in self.frames.get(index, ()):
+            if sprite.x < right and sprite.x + sprite.width > left and sprite.y < top and sprite.y + sprite.height > bottom:
+                sprite.opacity = opacity
+                sprite.color = color
+                sprite.draw()
+
+    def invalidate(self, index=None):
+        # frames that changed, all of them without index. Their textures are kept for reuse
+        # until the next build.
+        for index in list(self.frames) if index == None else [index]:
+            for sprite in self.frames.pop(index, ()):
+                sprite.delete()
+            for digest in self.digests.pop(index, ()):
+                self.users[digest] -= 1
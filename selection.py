@@ -0,0 +1,121 @@
+import numpy as np
+
+import algorithms as algo
+from pixel_buffer import PixelBuffer
+
+class Selection():
+    """
+    Selected cells of a buffer: their bounding rectangle (x0, y0, x1, y1), end exclusive,
+    and a (height, width) mask of the selected cells inside it. Rows count from the top.
+    """
+    def __init__(self, rect, mask=None) -> None:
+        x0, y0, x1, y1 = rect
+        self.rect = rect
+        self.mask = np.ones((y1 - y0, x1 - x0), dtype=bool) if mask is None else mask
+
+    def contains(self, x, y):
+        x0, y0, x1, y1 = self.rect
+        return x0 <= x < x1 and y0 <= y < y1 and bool(self.mask[y - y0, x - x0])
+
+class FloatingSelection():
+    """
+    Cells lifted out of a buffer, moved, flipped and rotated as whole arrays before they
+    are dropped back in. (x, y) is the buffer position of the top left cell of the block.
+    The block is kept in a PixelBuffer of its own, so it can be drawn while it floats.
+    """
+    def __init__(self, pixels, mask, x, y) -> None:
+        self.x = x
+        self.y = y
+        self.set_block(pixels, mask)
+
+    @property
+    def rect(self):
+        return (self.x, self.y, self.x + self.buffer.width, self.y + self.buffer.height)
+
+    def contains(self, x, y):
+        x0, y0, x1, y1 = self.rect
+        return x0 <= x < x1 and y0 <= y < y1
+
+    def flip(self, axis):
+        # axis 0 flips top and bottom, axis 1 left and right
+        self.set_block(np.flip(self.pixels, axis), np.flip(self.mask, axis))
+
+    def rotate(self, turns=1):
+        # quarter turns clockwise, around the middle of the block
+        width, height = self.buffer.width, self.buffer.height
+        self.set_block(np.rot90(self.pixels, -turns), np.rot90(self.mask, -turns))
+        if turns % 2:   # rounded toward zero, so turning back returns to the same place
+            self.x += int((width - height) / 2)
+            self.y += int((height - width) / 2)
+
+    def selection(self):
+        return Selection(self.rect, self.mask.copy())
+
+    def set_block(self, pixels, mask):
+        self.pixels = np.ascontiguousarray(pixels)
+        self.mask = np.ascontiguousarray(mask)
+        self.buffer = PixelBuffer(mask.shape[1], mask.shape[0])
+        self.buffer.write_rect(0, 0, self.pixels, self.mask)
+
+def anchor(buffer, floating):
+    # drop the selected cells of a floating selection into the buffer, the others are kept
+    write_block(buffer, floating.x, floating.y, floating.pixels, floating.mask, floating.mask)
+
+def copy(buffer, selection):
+    # the selected cells as a floating selection at their place, the buffer is not changed
+    x0, y0, x1, y1 = selection.rect
+    pixels, mask = buffer.read(x0, y0, x1, y1)
+    mask &= selection.mask
+    pixels[~mask] = 0
+    return FloatingSelection(pixels, mask, x0, y0)
+
+def cut(buffer, selection):
+    floating = copy(buffer, selection)
+    delete(buffer, selection)
+    return floating
+
+def delete(buffer, selection):
+    x0, y0, x1, y1 = selection.rect
+    write_block(buffer, x0, y0, np.zeros((y1 - y0, x1 - x0, 4), dtype=np.uint8), np.zeros((y1 - y0, x1 - x0), dtype=bool),
+                selection.mask)
+
+def magic_wand(buffer, x, y):
+    """
+    The cells connected to (x, y) that have its color (or are empty like it), found by the
+    flood fill of the paint bucket.
+    """
+    fillable = buffer.color_mask(buffer.get_pixel(x, y))
+    ys, xs = algo.span_cells(algo.flood_fill((x, y), fillable))
+
+    x0, y0 = int(xs.min()), int(ys.min())
+    mask = np.zeros((int(ys.max()) + 1 - y0, int(xs.max()) + 1 - x0), dtype=bool)
+    mask[ys - y0, xs - x0] = True
+    return Selection((x0, y0, x0 + mask.shape[1], y0 + mask.shape[0]), mask)
+
+def rectangle(buffer, corner, other):
+    # the cells between two corners (both included), clipped to the buffer. None when nothing is left.
+    x0, x1 = max(min(corner[0], other[0]), 0), min(max(corner[0], other[0]) + 1, buffer.width)
+    y0, y1 = max(min(corner[1], other[1]), 0), min(max(corner[1], other[1]) + 1, buffer.height)
+    if x0 >= x1 or y0 >= y1:
+        return None
+    return Selection((x0, y0, x1, y1))
+
+def write_block(buffer, x0, y0, pixels, mask, where):
+    """
+    Write the cells of a (height, width) block where where is True, with its top left cell at
+    (x0, y0). The part outside the buffer is dropped. A fully selected block is written
+    as a rectangle, tile by tile.
+    """
+    height, width = where.shape
+    left, top = max(x0, 0), max(y0, 0)
+    right, bottom = min(x0 + width, buffer.width), min(y0 + height, buffer.height)
+    if left >= right or top >= bottom:
+        return
+
+    block = (slice(top - y0, bottom - y0), slice(left - x0, right - x0))
+    if where[block].all():
+        buffer.write_rect(left, top, pixels[block], mask[block])
+        return
+
+    ys, xs = np.nonzero(where[block])
+    buffer.write_cells(xs + left, ys + top, pixels[block][ys, xs], mask[block][ys, xs])
@@ -0,0 +1,190 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import constants as const
+import project as proj
+
+_executor = None   # worker processes for folder thumbnails, started on first use
+
+class MipPyramid():
+    """
+    Downscaled copies of a PixelBuffer, every level half the size of the one before down
+    to a single pixel, for navigators and thumbnails. The levels are kept up to date from
+    the rectangles the buffer marks dirty; only the part of every level under them is
+    computed again. Levels below baseLevel are not kept, baseLevel itself is read from the
+    buffer in bands of rows, so the full size image is never copied at once.
+    """
+    def __init__(self, buffer, baseLevel=1) -> None:
+        self.buffer = buffer
+        self.baseLevel = max(baseLevel, 1)
+
+        self.levels = {}   # level -> (height, width, 4) uint8 array, row 0 at the top
+        level = self.baseLevel
+        while True:
+            width, height = level_size(buffer.width, buffer.height, level)
+            self.levels[level] = np.zeros((height, width, 4), dtype=np.uint8)
+            if width == 1 and height == 1:
+                break
+            level += 1
+
+        self.dirtyRect = (0, 0, buffer.width, buffer.height)   # in buffer coordinates, end exclusive
+        buffer.dirtyListeners.append(self.mark_dirty)
+
+    def close(self):
+        # stop following the buffer
+        self.buffer.dirtyListeners.remove(self.mark_dirty)
+
+    def mark_dirty(self, x0, y0, x1, y1):
+        if self.dirtyRect == None:
+            self.dirtyRect = (x0, y0, x1, y1)
+        else:
+            rect = self.dirtyRect
+            self.dirtyRect = (min(rect[0], x0), min(rect[1], y0), max(rect[2], x1), max(rect[3], y1))
+
+    def thumbnail(self, size):
+        """
+        The smallest level whose larger side fits in size (a power of two), as a copy.
+        """
+        if size < 1 or not size & (size - 1) == 0:
+            raise ValueError(f"thumbnail size must be a power of two, not {size}")
+
+        level = level_for(self.buffer.width, self.buffer.height, size)
+        if level == 0:
+            pixels, _ = self.buffer.read(0, 0, self.buffer.width, self.buffer.height)
+            return pixels
+
+        self.update()
+        return self.levels[max(level, self.baseLevel)].copy()
+
+    def update(self):
+        rect = self.dirtyRect
+        if rect == None:
+            return
+        self.dirtyRect = None
+
+        # the base level straight from the buffer, blocks of the whole factor at once
+        factor = 2 ** self.baseLevel
+        x0, y0 = rect[0] // factor * factor, rect[1] // factor * factor
+        x1, y1 = min(-(-rect[2] // factor) * factor, self.buffer.width), min(-(-rect[3] // factor) * factor, self.buffer.height)
+        band = max(const.TILE_SIZE // factor, 1) * factor
+
+        base = self.levels[self.baseLevel]
+        for top in range(y0, y1, band):
+            bottom = min(top + band, y1)
+            pixels, _ = self.buffer.read(x0, top, x1, bottom)
+            base[top // factor:-(-bottom // factor), x0 // factor:-(-x1 // factor)] = downsample(pixels, factor)
+
+        # every further level from the one before it
+        x0, y0, x1, y1 = x0 // factor, y0 // factor, -(-x1 // factor), -(-y1 // factor)
+        for level in range(self.baseLevel + 1, len(self.levels) + self.baseLevel):
+            above = self.levels[level - 1]
+            x0, y0 = x0 // 2 * 2, y0 // 2 * 2
+            x1, y1 = min(-(-x1 // 2) * 2, above.shape[1]), min(-(-y1 // 2) * 2, above.shape[0])
+
+            self.levels[level][y0 // 2:-(-y1 // 2), x0 // 2:-(-x1 // 2)] = downsample(above[y0:y1, x0:x1])
+            x0, y0, x1, y1 = x0 // 2, y0 // 2, -(-x1 // 2), -(-y1 // 2)
+
+def cached_thumbnail(path, size=const.THUMBNAIL_SIZE, cacheDirectory=const.THUMBNAIL_CACHE):
+    """
+    project_thumbnail, kept in cacheDirectory as long as the project file does not change.
+    """
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}|{size}"
+    cachePath = os.path.join(cacheDirectory, hashlib.blake2b(key.encode(), digest_size=16).hexdigest() + ".npy")
+
+    try:
+        return np.load(cachePath)
+    except (OSError, ValueError):
+        pass
+
+    thumbnail = project_thumbnail(path, size)
+
+    # written under another name first, so other processes never read half a file
+    os.makedirs(cacheDirectory, exist_ok=True)
+    temporaryPath = f"{cachePath}.{os.getpid()}.tmp"
+    with open(temporaryPath, "wb") as f:
+        np.save(f, thumbnail)
+    os.replace(temporaryPath, cachePath)
+    return thumbnail
+
+def downsample(pixels, factor=2):
+    """
+    Alpha-aware box filter: every factor x factor block of the (height, width, 4) pixels
+    becomes one pixel. Colors are averaged weighted by their alpha, so empty pixels do not
+    darken the edges of shapes, and alpha is the mean of the block. Blocks cut off by the
+    right or bottom edge only average the pixels they have.
+    """
+    height, width = pixels.shape[:2]
+    outHeight, outWidth = -(-height // factor), -(-width // factor)
+
+    padded = np.zeros((outHeight * factor, outWidth * factor, 4), dtype=np.int64)
+    padded[:height, :width] = pixels
+    alpha = padded[:, :, 3]
+
+    def blocks(array):
+        return array.reshape(outHeight, factor, outWidth, factor, *array.shape[2:]).sum(axis=(1, 3))
+
+    alphaSum = blocks(alpha)
+    colorSum = blocks(padded[:, :, :3] * alpha[:, :, None])
+    rows = np.minimum(factor, height - np.arange(outHeight) * factor)
+    columns = np.minimum(factor, width - np.arange(outWidth) * factor)
+    count = rows[:, None] * columns[None, :]
+
+    result = np.zeros((outHeight, outWidth, 4), dtype=np.uint8)
+    weights = np.maximum(alphaSum, 1)[:, :, None]
+    result[:, :, :3] = (colorSum + weights // 2) // weights
+    result[:, :, 3] = (alphaSum + count // 2) // count
+    return result
+
+def folder_thumbnails_async(directory, size=const.THUMBNAIL_SIZE, callback=None):
+    """
+    cached_thumbnail of every project in directory, on a pool of worker processes.
+    callback(path, thumbnail, error) is called from a background thread as each one is done.
+    Returns path -> future.
+    """
+    global _executor
+    if _executor == None:
+        _executor = ProcessPoolExecutor()
+
+    futures = {}
+    for filename in sorted(os.listdir(directory)):
+        if not filename.lower().endswith(const.PROJECT_EXTENSION):
+            continue
+
+        path = os.path.join(directory, filename)
+        future = _executor.submit(cached_thumbnail, path, size)
+        if not callback == None:
+            def done(future, path=path):
+                error = future.exception()
+                callback(path, None if error else future.result(), error)
+            future.add_done_callback(done)
+        futures[path] = future
+
+    return futures
+
+def level_for(width, height, size):
+    # smallest pyramid level whose larger side fits in size
+    level = 0
+    while max(level_size(width, height, level)) > size:
+        level += 1
+    return level
+
+def level_size(width, height, level):
+    return -(-width // 2 ** level), -(-height // 2 ** level)
+
+def project_thumbnail(path, size=const.THUMBNAIL_SIZE):
+    """
+    Thumbnail of the first frame of a project file, as a (height, width, 4) array.
+    Only the pyramid level of the thumbnail is computed.
+    """
+    frames = proj.open_project(path)
+    stack = frames[0]
+    try:
+        stack.update()
+        composite = stack.composite
+        return MipPyramid(composite, level_for(composite.width, composite.height, size)).thumbnail(size)
+    finally:
+        stack.layers[0].buffer.source.project.close()